@@ -0,0 +1,91 @@
+"""
+Compare exact DBSCAN against the IVF radius-graph path on embedding matrices.
+
+Usage:
+    PYTHONPATH=src python benchmarks/ann_clustering.py --sizes 2000 10000 20000
+    PYTHONPATH=src python benchmarks/ann_clustering.py --features features.npy
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+from sklearn.metrics import adjusted_rand_score
+
+from photorank.neighbor_index import EXACT, IVF, dbscan_labels, radius_graph
+
+
+def synthetic_embeddings(n, dim=2048, bursts=None, spread=0.35, seed=0):
+    """Non-negative, ResNet-like vectors grouped into bursts of near-identical shots"""
+    rng = np.random.default_rng(seed)
+    bursts = bursts or max(1, n // 6)
+    centers = np.abs(rng.normal(size=(bursts, dim))).astype(np.float32)
+    assignment = rng.integers(0, bursts, n)
+    noise = rng.normal(scale=spread, size=(n, dim)).astype(np.float32)
+    return np.maximum(centers[assignment] + noise, 0.0)
+
+
+def pair_recall(exact_graph, approx_graph):
+    """Fraction of true eps-neighbour pairs that the approximate graph found"""
+    exact_pairs = exact_graph.nnz
+    found = exact_graph.multiply(approx_graph > 0).nnz
+    return found / exact_pairs if exact_pairs else 1.0
+
+
+def run(features, eps, min_samples, nprobe):
+    started = time.perf_counter()
+    exact_labels = dbscan_labels(features, eps, min_samples, kind=EXACT)
+    exact_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    approx_graph = radius_graph(features, eps, kind=IVF, nprobe=nprobe)
+    approx_labels = DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed').fit_predict(approx_graph)
+    approx_seconds = time.perf_counter() - started
+
+    recall = pair_recall(radius_graph(features, eps, kind=EXACT), approx_graph)
+    return {
+        'n': int(len(features)),
+        'dim': int(features.shape[1]),
+        'eps': eps,
+        'min_samples': min_samples,
+        'nprobe': nprobe,
+        'exact_seconds': round(exact_seconds, 4),
+        'ivf_seconds': round(approx_seconds, 4),
+        'speedup': round(exact_seconds / approx_seconds, 2),
+        'adjusted_rand_index': round(float(adjusted_rand_score(exact_labels, approx_labels)), 4),
+        'neighbor_pair_recall': round(float(recall), 4),
+        'exact_clusters': int(len(set(exact_labels)) - (1 if -1 in exact_labels else 0)),
+        'ivf_clusters': int(len(set(approx_labels)) - (1 if -1 in approx_labels else 0)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 10000])
+    parser.add_argument('--dim', type=int, default=2048)
+    parser.add_argument('--features', help='.npy feature matrix to use instead of synthetic data')
+    parser.add_argument('--eps', type=float, default=0.3)
+    parser.add_argument('--min-samples', type=int, default=2)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    if args.features:
+        datasets = [np.load(args.features).astype(np.float32)]
+    else:
+        datasets = [synthetic_embeddings(n, dim=args.dim) for n in args.sizes]
+
+    results = []
+    for features in datasets:
+        result = run(features, args.eps, args.min_samples, args.nprobe)
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
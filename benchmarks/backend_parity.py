@@ -0,0 +1,101 @@
+"""
+Check inference backends against the fp32 eager baseline on real photos.
+
+Embeds and scores the same images with each backend and reports how far
+the embeddings drift (1 - cosine similarity), how much quality scores
+move, and whether the ranking changes: image pairs that swap order, and
+clusters (DBSCAN on the baseline embeddings) whose order or recommended
+photo differs.
+
+Usage:
+    PYTHONPATH=src python benchmarks/backend_parity.py --images photos/
+    PYTHONPATH=src python benchmarks/backend_parity.py --images photos/ --classifier lite \\
+        --backends torchscript static_int8 --calibration 16 --output parity.json
+"""
+import argparse
+import json
+import os
+import time
+
+from photorank.inference import BACKENDS, EAGER, STATIC_INT8, TORCHSCRIPT, parity_report
+from photorank.neighbor_index import dbscan_labels
+from photorank.photo_classifier import PhotoClassifier
+from photorank.photo_classifier_lite import PhotoClassifierLite
+
+CLASSIFIERS = {'full': PhotoClassifier, 'lite': PhotoClassifierLite}
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.heic')
+
+
+def image_paths(directory, limit=None):
+    paths = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                   if f.lower().endswith(IMAGE_EXTENSIONS))
+    return paths[:limit] if limit else paths
+
+
+def embed(classifier_cls, backend, paths, calibration):
+    classifier = classifier_cls(prefetch_workers=0, backend=backend, calibration_images=calibration)
+    started = time.perf_counter()
+    classifier.warm_up()
+    compile_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    result = classifier.embed_and_score(paths)
+    return result, compile_seconds, time.perf_counter() - started
+
+
+def clusters(result, eps, min_samples):
+    """Baseline DBSCAN clusters as lists of image indices"""
+    groups = {}
+    for idx, label in zip(result.kept, dbscan_labels(result.features, eps, min_samples)):
+        if label != -1:
+            groups.setdefault(int(label), []).append(idx)
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', required=True, help='directory of photos to compare on')
+    parser.add_argument('--classifier', choices=sorted(CLASSIFIERS), default='full')
+    parser.add_argument('--backends', nargs='+', choices=[b for b in BACKENDS if b != EAGER],
+                        default=[TORCHSCRIPT, STATIC_INT8])
+    parser.add_argument('--calibration', type=int, default=16,
+                        help='photos used to calibrate static_int8 (0 for synthetic input)')
+    parser.add_argument('--limit', type=int, help='use at most this many photos')
+    parser.add_argument('--eps', type=float, default=0.3)
+    parser.add_argument('--min-samples', type=int, default=2)
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    paths = image_paths(args.images, args.limit)
+    calibration = paths[:args.calibration] or None
+    classifier_cls = CLASSIFIERS[args.classifier]
+
+    baseline, _, baseline_seconds = embed(classifier_cls, EAGER, paths, None)
+    groups = clusters(baseline, args.eps, args.min_samples)
+
+    results = []
+    for backend in args.backends:
+        try:
+            candidate, compile_seconds, seconds = embed(classifier_cls, backend, paths, calibration)
+        except RuntimeError as e:
+            result = {'backend': backend, 'error': str(e)}
+        else:
+            result = {
+                'backend': backend,
+                'classifier': args.classifier,
+                'clusters': len(groups),
+                'compile_seconds': round(compile_seconds, 3),
+                'seconds': round(seconds, 3),
+                'baseline_seconds': round(baseline_seconds, 3),
+                'speedup': round(baseline_seconds / seconds, 2) if seconds else None,
+                **parity_report(baseline, candidate, groups),
+            }
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""
+Benchmark the clustering and ranking pipeline, stage by stage, on synthetic photo sets.
+
+Generates bursts of near-identical shots at the requested size and format
+(JPEG, PNG, HEIC), then for each classifier times every stage on its own:
+load (file read), decode, preprocess, feature extraction, sharpness,
+quality scoring, DBSCAN and JSON serialization, followed by an end-to-end
+cluster_images run. Each run happens in a fresh process so peak RSS is
+its own. Results are JSON; pass an earlier results file to --compare to
+see the change per stage.
+
+Usage:
+    PYTHONPATH=src python benchmarks/pipeline.py --count 64 --size 4032x3024
+    PYTHONPATH=src python benchmarks/pipeline.py --formats jpeg heic --classifiers lite \\
+        --output after.json --compare before.json
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+CLASSIFIERS = ('full', 'lite')
+FORMATS = {'jpeg': ('JPEG', '.jpg'), 'png': ('PNG', '.png'), 'heic': ('HEIF', '.heic')}
+STAGES = ('load', 'decode', 'preprocess', 'features', 'sharpness', 'quality', 'dbscan', 'json')
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def synthetic_photo(rng, base, size, shot):
+    """One shot of a burst: the base scene, shifted, re-exposed and sometimes blurred"""
+    dx, dy = rng.integers(-size[0] // 50, size[0] // 50 + 1, 2)
+    img = base.transform(size, Image.AFFINE, (1, 0, dx, 0, 1, dy), resample=Image.BILINEAR)
+    img = Image.eval(img, lambda v, gain=rng.uniform(0.85, 1.15): min(255, int(v * gain)))
+    if shot % 3:
+        img = img.filter(ImageFilter.GaussianBlur(radius=float(rng.uniform(0.5, 3.0)) * size[0] / 1000))
+    return img
+
+
+def synthetic_set(directory, count, size, fmt, burst=4, seed=0):
+    """Write `count` photos in bursts of `burst` to `directory`, reusing an earlier complete set"""
+    pil_format, ext = FORMATS[fmt]
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, f"{i:05d}{ext}") for i in range(count)]
+    if all(os.path.exists(p) for p in paths):
+        return paths
+    if fmt == 'heic':
+        from photorank import image_io  # noqa: F401  registers the HEIF plugin
+
+    rng = np.random.default_rng(seed)
+    for start in range(0, count, burst):
+        # Smooth colour field plus texture, so both the model and sharpness have something to see
+        coarse = rng.integers(0, 256, (9, 12, 3), dtype=np.uint8)
+        base = Image.fromarray(coarse).resize(size, Image.BICUBIC)
+        texture = Image.fromarray(rng.integers(0, 256, (size[1] // 8, size[0] // 8), dtype=np.uint8))
+        base = Image.blend(base, texture.resize(size, Image.NEAREST).convert('RGB'), 0.25)
+        for shot, path in enumerate(paths[start:start + burst]):
+            synthetic_photo(rng, base, size, shot).save(path, pil_format)
+    return paths
+
+
+def summarize(durations, items):
+    """Totals, throughput and per-call latency percentiles for one stage"""
+    durations = np.asarray(durations, dtype=np.float64)
+    total = float(durations.sum())
+    return {
+        'calls': int(len(durations)),
+        'items': int(items),
+        'seconds': round(total, 4),
+        'items_per_second': round(items / total, 2) if total else None,
+        'p50_ms': round(float(np.percentile(durations, 50)) * 1000, 3),
+        'p95_ms': round(float(np.percentile(durations, 95)) * 1000, 3),
+    }
+
+
+def build_classifier(name, batch_size):
+    if name == 'lite':
+        from photorank.photo_classifier_lite import PhotoClassifierLite
+        return PhotoClassifierLite(batch_size=batch_size)
+    from photorank.photo_classifier import PhotoClassifier
+    return PhotoClassifier(batch_size=batch_size)
+
+
+def response_payload(ranked_clusters, records):
+    """The /cluster response shape, built from PhotoRecords as the app does"""
+    clusters, unclustered = [], []
+    for cluster_id, ranked in ranked_clusters.items():
+        photos = [dict(records[filename].to_dict(), score=float(score)) for filename, score in ranked]
+        if cluster_id == -1:
+            unclustered.extend(photos)
+        else:
+            clusters.append({'id': int(cluster_id), 'photos': photos, 'recommendedPhoto': photos[0]})
+    return {'clusters': clusters, 'unclustered': unclustered}
+
+
+def run(classifier_name, paths, batch_size, eps, min_samples):
+    """Time each stage in isolation, then the whole pipeline; runs in its own process"""
+    import torch
+    from photorank.embed_score import combine_quality_score, rank_clusters_by_score
+    from photorank.image_io import MODEL_DECODE_SIDE, load_reduced
+    from photorank.neighbor_index import dbscan_labels
+    from photorank.photo_registry import PhotoRecord
+
+    classifier = build_classifier(classifier_name, batch_size)
+    classifier.warm_up()
+    rss_after_warm_up = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = {stage: [] for stage in STAGES}
+    clock = time.perf_counter
+
+    features, scores = [], []
+    with torch.no_grad():
+        for start in range(0, len(paths), batch_size):
+            tensors, images = [], []
+            for path in paths[start:start + batch_size]:
+                started = clock()
+                with open(path, 'rb') as f:
+                    data = f.read()
+                timings['load'].append(clock() - started)
+
+                started = clock()
+                img = load_reduced(io.BytesIO(data), MODEL_DECODE_SIDE)
+                timings['decode'].append(clock() - started)
+                images.append(img)
+
+                started = clock()
+                tensors.append(classifier.transform(img))
+                timings['preprocess'].append(clock() - started)
+
+            batch = torch.stack(tensors).to(classifier.device)
+            started = clock()
+            batch_features, _ = classifier._forward(batch, score=False)
+            timings['features'].append(clock() - started)
+
+            started = clock()
+            sharpness = classifier.sharpness.score([classifier.sharpness.proxy(img) for img in images])
+            timings['sharpness'].append(clock() - started)
+
+            started = clock()
+            confidence = classifier.confidence_batch(batch, batch_features).cpu().numpy()
+            scores.extend(combine_quality_score(c, s, classifier.sharpness.midpoint) for c, s in zip(confidence, sharpness))
+            timings['quality'].append(clock() - started)
+            features.append(batch_features.flatten(1).cpu().numpy())
+
+    features = np.concatenate(features)
+    started = clock()
+    labels = dbscan_labels(features, eps, min_samples)
+    timings['dbscan'].append(clock() - started)
+
+    filenames = [os.path.basename(p) for p in paths]
+    ranked = rank_clusters_by_score(labels, filenames, scores)
+    records = {filename: PhotoRecord.from_file(str(uuid.uuid4()), filename, path)
+               for filename, path in zip(filenames, paths)}
+    payload = response_payload(ranked, records)
+    started = clock()
+    body = json.dumps(payload)
+    timings['json'].append(clock() - started)
+
+    stages = {stage: summarize(durations, len(paths)) for stage, durations in timings.items()}
+
+    started = clock()
+    result = classifier.cluster_images([(os.path.basename(p), p) for p in paths], eps=eps, min_samples=min_samples)
+    end_to_end = clock() - started
+    classifier.prefetch.close()
+
+    return {
+        'classifier': classifier_name,
+        'images': len(paths),
+        'clusters': len([label for label in result if label != -1]),
+        'response_bytes': len(body),
+        'stages': stages,
+        'end_to_end_seconds': round(end_to_end, 4),
+        'end_to_end_images_per_second': round(len(paths) / end_to_end, 2),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb_after_warm_up': round(rss_after_warm_up / 1024, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_isolated(*args):
+    """run() in a fresh spawned process, so peak RSS covers that run alone"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run, *args).result()
+
+
+def environment():
+    import torch
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+    }
+
+
+def compare(results, baseline_path):
+    """Print the change in throughput and p95 latency against an earlier results file"""
+    with open(baseline_path) as f:
+        baseline = {(r['classifier'], r['format']): r for r in json.load(f)['results']}
+    for result in results:
+        before = baseline.get((result['classifier'], result['format']))
+        if before is None:
+            continue
+        for stage, after_stage in result['stages'].items():
+            before_stage = before['stages'].get(stage)
+            if not before_stage or not before_stage['items_per_second'] or not after_stage['items_per_second']:
+                continue
+            throughput = after_stage['items_per_second'] / before_stage['items_per_second'] - 1
+            p95 = after_stage['p95_ms'] / before_stage['p95_ms'] - 1 if before_stage['p95_ms'] else 0.0
+            print(f"{result['classifier']:>4} {result['format']:>4} {stage:>10}: "
+                  f"throughput {throughput:+.1%}, p95 {p95:+.1%}")
+        change = before['end_to_end_seconds'] / result['end_to_end_seconds'] - 1
+        print(f"{result['classifier']:>4} {result['format']:>4} {'end-to-end':>10}: throughput {change:+.1%}, "
+              f"peak RSS {result['peak_rss_mb'] - before['peak_rss_mb']:+.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=32, help='photos per set')
+    parser.add_argument('--size', type=parse_size, default=(4032, 3024), help='WIDTHxHEIGHT of each photo')
+    parser.add_argument('--formats', nargs='+', choices=sorted(FORMATS), default=['jpeg'])
+    parser.add_argument('--classifiers', nargs='+', choices=CLASSIFIERS, default=list(CLASSIFIERS))
+    parser.add_argument('--burst', type=int, default=4, help='near-identical shots per scene')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--eps', type=float, default=0.3)
+    parser.add_argument('--min-samples', type=int, default=2)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'photorank-bench'),
+                        help='where synthetic sets are generated and reused')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    parser.add_argument('--compare', help='earlier results JSON to compare against')
+    args = parser.parse_args()
+
+    results = []
+    for fmt in args.formats:
+        directory = os.path.join(args.data_dir, f"{fmt}-{args.size[0]}x{args.size[1]}-b{args.burst}-n{args.count}")
+        started = time.perf_counter()
+        paths = synthetic_set(directory, args.count, args.size, fmt, burst=args.burst)
+        print(f"{fmt}: {len(paths)} photos ready in {time.perf_counter() - started:.1f}s")
+        for name in args.classifiers:
+            result = run_isolated(name, paths, args.batch_size, args.eps, args.min_samples)
+            result.update(format=fmt, width=args.size[0], height=args.size[1],
+                          mean_file_bytes=int(np.mean([os.path.getsize(p) for p in paths])))
+            print(json.dumps(result))
+            results.append(result)
+
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'batch_size': args.batch_size, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Compare the two-tier (perceptual-hash prefilter) clustering strategy with the all-deep path.
+
+Clusters the same photos with PhotoClassifier.cluster_images under each
+strategy and reports wall time, how many photos went through ResNet50,
+and how far the two-tier result departs from the deep one: adjusted Rand
+index of the cluster assignments, photos whose cluster differs, and
+clusters whose recommended photo changed. Uses synthetic bursts (see
+pipeline.py) unless --images points at a directory of real photos.
+
+Usage:
+    PYTHONPATH=src python benchmarks/prefilter.py --count 64 --burst 8
+    PYTHONPATH=src python benchmarks/prefilter.py --images photos/ --output prefilter.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from sklearn.metrics import adjusted_rand_score
+
+from pipeline import environment, parse_size, synthetic_set
+from photorank.perceptual import DEEP, TWO_TIER, hash_groups, hash_images
+from photorank.photo_classifier import PhotoClassifier
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.heic')
+
+
+def partition(ranked_clusters):
+    """filename -> the set of filenames it is clustered with (itself alone for noise), and recommendations"""
+    together, recommended = {}, {}
+    for label, ranked in ranked_clusters.items():
+        filenames = [filename for filename, _ in ranked]
+        for filename in filenames:
+            together[filename] = frozenset([filename] if label == -1 else filenames)
+            if label != -1:
+                recommended[filename] = filenames[0]
+    return together, recommended
+
+
+def agreement(deep, two_tier):
+    """How closely the two-tier clusters and recommendations match the deep ones"""
+    deep_together, deep_recommended = partition(deep)
+    tier_together, tier_recommended = partition(two_tier)
+    filenames = sorted(deep_together)
+    labels = {}
+    deep_ids = [labels.setdefault(('deep', deep_together[f]), len(labels)) for f in filenames]
+    tier_ids = [labels.setdefault(('tier', tier_together.get(f, frozenset([f]))), len(labels)) for f in filenames]
+    regrouped = sum(deep_together[f] != tier_together.get(f) for f in filenames)
+    # A deep cluster's pick counts as kept when the two-tier cluster holding it recommends it too
+    picks = set(deep_recommended.values())
+    changed = sum(tier_recommended.get(pick) != pick for pick in picks)
+    return {
+        'adjusted_rand_index': round(float(adjusted_rand_score(deep_ids, tier_ids)), 4),
+        'photos_regrouped': int(regrouped),
+        'recommendations_changed': int(changed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', help='directory of photos to use instead of synthetic bursts')
+    parser.add_argument('--count', type=int, default=64, help='synthetic photos')
+    parser.add_argument('--size', type=parse_size, default=(2016, 1512), help='WIDTHxHEIGHT of synthetic photos')
+    parser.add_argument('--burst', type=int, default=8, help='near-identical shots per synthetic scene')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--eps', type=float, default=0.3)
+    parser.add_argument('--min-samples', type=int, default=2)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'photorank-bench'),
+                        help='where synthetic sets are generated and reused')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    if args.images:
+        paths = sorted(os.path.join(args.images, f) for f in os.listdir(args.images)
+                       if f.lower().endswith(IMAGE_EXTENSIONS))
+    else:
+        directory = os.path.join(args.data_dir, f"jpeg-{args.size[0]}x{args.size[1]}-b{args.burst}-n{args.count}")
+        paths = synthetic_set(directory, args.count, args.size, 'jpeg', burst=args.burst)
+    images = [(os.path.basename(p), p) for p in paths]
+
+    started = time.perf_counter()
+    dhashes, phashes, hashed = hash_images(paths)
+    hash_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    groups, ambiguous = hash_groups(dhashes, phashes)
+    group_seconds = time.perf_counter() - started
+
+    # No cache, so neither strategy benefits from the other's embeddings
+    classifier = PhotoClassifier(batch_size=args.batch_size, prefetch_workers=0)
+    classifier.warm_up()
+    classifier._load_ranker()
+    classifier.ranker._load_model()
+
+    results = {}
+    clusters = {}
+    for strategy in (DEEP, TWO_TIER):
+        started = time.perf_counter()
+        clusters[strategy] = classifier.cluster_images(images, eps=args.eps, min_samples=args.min_samples,
+                                                       strategy=strategy)
+        results[strategy] = {
+            'seconds': round(time.perf_counter() - started, 3),
+            'clusters': len([label for label in clusters[strategy] if label != -1]),
+        }
+    deep_count = len(images) - len(hashed) + sum(
+        bool(ambiguous[pos]) or groups[pos] == pos for pos in range(len(hashed)))
+    results[DEEP]['deep_images'] = len(images)
+    results[TWO_TIER].update(
+        deep_images=int(deep_count),
+        hash_groups=len(set(groups.tolist())),
+        ambiguous=int(ambiguous.sum()),
+        hash_seconds=round(hash_seconds, 3),
+        group_seconds=round(group_seconds, 4),
+        speedup=round(results[DEEP]['seconds'] / results[TWO_TIER]['seconds'], 2),
+        **agreement(clusters[DEEP], clusters[TWO_TIER]),
+    )
+    report = {'images': len(images), 'results': results}
+    print(json.dumps(report))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), **report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ import './App.css';
 import PhotoUpload from './components/PhotoUpload';
 import ClusterView from './components/ClusterView';
 import PhotoModal from './components/PhotoModal';
-import { apiService, Photo, ClusteringResult } from './services/api';
+import { apiService, Photo, ClusteringResult, JobStatus } from './services/api';
 
 function App() {
   const [clusteringResult, setClusteringResult] = useState<ClusteringResult | null>(null);
@@ -11,14 +11,16 @@ function App() {
   const [selectedPhoto, setSelectedPhoto] = useState<Photo | null>(null);
   const [isModalOpen, setIsModalOpen] = useState(false);
   const [error, setError] = useState<string | null>(null);
+  const [progress, setProgress] = useState<JobStatus | null>(null);
 
   const handleUploadComplete = async () => {
     setIsProcessing(true);
     setError(null);
+    setProgress(null);
     
     try {
       console.log('Processing photos for clustering...');
-      const result = await apiService.processPhotos();
+      const result = await apiService.processPhotos(setProgress);
       setClusteringResult(result);
       console.log('Clustering complete:', result);
     } catch (err) {
@@ -77,6 +79,11 @@ function App() {
               <p className="text-gray-500">
                 This may take a few minutes depending on the number of photos
               </p>
+              {progress?.stage && progress.stages[progress.stage] && (
+                <p className="text-gray-500 mt-2">
+                  {progress.message} {progress.stages[progress.stage].done} / {progress.stages[progress.stage].total}
+                </p>
+              )}
             </section>
           )}
 
@@ -63,7 +63,7 @@ const ClusterView: React.FC<ClusterViewProps> = ({
               </p>
               <div className="flex items-center space-x-4">
                 <img
-                  src={cluster.recommendedPhoto.url}
+                  src={cluster.recommendedPhoto.previewUrl ?? cluster.recommendedPhoto.url}
                   alt={cluster.recommendedPhoto.filename}
                   className="w-24 h-24 object-cover rounded-lg"
                   onClick={() => onPhotoClick?.(cluster.recommendedPhoto!)}
@@ -34,7 +34,7 @@ const PhotoGrid: React.FC<PhotoGridProps> = ({
           onClick={() => onPhotoClick?.(photo)}
         >
           <img
-            src={photo.url}
+            src={photo.thumbnailUrl ?? photo.url}
             alt={photo.filename}
             className="w-full h-48 object-cover"
             loading="lazy"
@@ -46,7 +46,7 @@ const PhotoModal: React.FC<PhotoModalProps> = ({ photo, isOpen, onClose }) => {
           <div className="flex flex-col lg:flex-row gap-6">
             <div className="flex-1">
               <img
-                src={photo.url}
+                src={photo.previewUrl ?? photo.url}
                 alt={photo.filename}
                 className="w-full h-auto max-h-96 object-contain rounded-lg"
               />
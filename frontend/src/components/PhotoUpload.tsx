@@ -31,14 +31,10 @@ const PhotoUpload: React.FC<PhotoUploadProps> = ({ onUploadComplete }) => {
 
       console.log(`Uploading ${imageFiles.length} images...`);
       
-      // Simulate progress (since we don't have actual progress from the API yet)
-      const progressInterval = setInterval(() => {
-        setUploadProgress(prev => Math.min(prev + 10, 90));
-      }, 200);
-
-      const result = await apiService.uploadPhotos(imageFiles);
+      const result = await apiService.uploadPhotos(imageFiles, (uploadedBytes, totalBytes) => {
+        setUploadProgress(Math.round((uploadedBytes / Math.max(totalBytes, 1)) * 100));
+      });
       
-      clearInterval(progressInterval);
       setUploadProgress(100);
       
       console.log('Upload successful:', result);
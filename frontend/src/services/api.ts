@@ -9,14 +9,41 @@ const API_BASE_URL = process.env.NODE_ENV === 'production'
 const apiClient = axios.create({
     baseURL: API_BASE_URL,
     timeout: 30000, // 30 seconds for image processing
+    // Send the session cookie too, for browsers that allow it across sites
+    withCredentials: true,
     headers: {
         'Content-Type': 'multipart/form-data',
     },
 });
 
+// The backend names this browser's workspace in a response header; it is echoed on every
+// request, so the session holds even where third-party cookies are blocked
+const SESSION_HEADER = 'X-Photorank-Session';
+const SESSION_STORAGE_KEY = 'photorankSession';
+
+const storedSession = (): string | null => {
+    try {
+        return window.localStorage.getItem(SESSION_STORAGE_KEY);
+    } catch {
+        return null;  // Storage disabled; the cookie is all there is
+    }
+};
+
+const storeSession = (sessionId: string) => {
+    try {
+        window.localStorage.setItem(SESSION_STORAGE_KEY, sessionId);
+    } catch {
+        // Storage disabled
+    }
+};
+
 // Add request interceptor for debugging
 apiClient.interceptors.request.use(
     (config) => {
+        const sessionId = storedSession();
+        if (sessionId) {
+            config.headers.set(SESSION_HEADER, sessionId);
+        }
         console.log(`Making ${config.method?.toUpperCase()} request to: ${config.baseURL}${config.url}`);
         return config;
     },
@@ -29,6 +56,10 @@ apiClient.interceptors.request.use(
 // Add response interceptor for debugging
 apiClient.interceptors.response.use(
     (response) => {
+        const sessionId = response.headers[SESSION_HEADER.toLowerCase()];
+        if (sessionId) {
+            storeSession(sessionId);
+        }
         console.log(`Response from ${response.config.url}:`, response.status);
         console.log('Response data:', response.data);
         return response;
@@ -43,7 +74,12 @@ export interface Photo {
     id: string;
     filename: string;
     url: string;
+    previewUrl?: string;
+    thumbnailUrl?: string;
+    width?: number;
+    height?: number;
     score?: number;
+    duplicateOf?: string | null;  // Exact or near copy of this photo id; skipped by the models
 }
 
 export interface Cluster {
@@ -57,36 +93,197 @@ export interface ClusteringResult {
     unclustered: Photo[];
 }
 
+export interface ResultPage<T> {
+    items: T[];
+    nextCursor: string | null;
+    clusterCount: number;
+    unclusteredCount: number;
+}
+
+export interface StageProgress {
+    done: number;
+    total: number;
+    seconds: number;
+    throughput: number | null;
+}
+
+export interface JobStatus {
+    jobId: string;
+    status: 'queued' | 'processing' | 'completed' | 'error';
+    message: string;
+    stage: string | null;
+    stages: Record<string, StageProgress>;
+    error: string | null;
+}
+
+const STATUS_POLL_INTERVAL_MS = 1000;
+// Files above this size go through the resumable chunked API; smaller ones share multipart requests
+const RESUMABLE_THRESHOLD_BYTES = 8 * 1024 * 1024;
+const UPLOAD_BATCH_BYTES = 32 * 1024 * 1024;
+const UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024;
+const UPLOAD_RETRIES = 3;
+// Clusters and unclustered photos fetched per /cluster request
+const RESULT_PAGE_SIZE = 100;
+
+export type UploadProgress = (uploadedBytes: number, totalBytes: number) => void;
+
+// Split small files into multipart batches of at most UPLOAD_BATCH_BYTES
+const uploadBatches = (files: File[]): File[][] => {
+    const batches: File[][] = [];
+    let current: File[] = [];
+    let currentBytes = 0;
+    for (const file of files) {
+        if (current.length && currentBytes + file.size > UPLOAD_BATCH_BYTES) {
+            batches.push(current);
+            current = [];
+            currentBytes = 0;
+        }
+        current.push(file);
+        currentBytes += file.size;
+    }
+    if (current.length) {
+        batches.push(current);
+    }
+    return batches;
+};
+
+const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
+
+// Photo URLs from the backend are paths on the API server, e.g. /photos/<id>/renditions/small
+const resolveUrl = (url?: string) => (url && url.startsWith('/') ? `${API_BASE_URL}${url}` : url);
+
+const resolvePhoto = (photo: Photo): Photo => ({
+    ...photo,
+    url: resolveUrl(photo.url)!,
+    previewUrl: resolveUrl(photo.previewUrl),
+    thumbnailUrl: resolveUrl(photo.thumbnailUrl),
+});
+
+const resolveResult = (result: ClusteringResult): ClusteringResult => ({
+    clusters: result.clusters.map(cluster => ({
+        ...cluster,
+        photos: cluster.photos.map(resolvePhoto),
+        recommendedPhoto: cluster.recommendedPhoto && resolvePhoto(cluster.recommendedPhoto),
+    })),
+    unclustered: result.unclustered.map(resolvePhoto),
+});
+
 class ApiService {
-    async uploadPhotos(files: File[]): Promise<{ message: string; photoCount: number }> {
-        const formData = new FormData();
-        files.forEach(file => {
-            formData.append('photos', file);
-        });
+    async uploadPhotos(files: File[], onProgress?: UploadProgress): Promise<{ message: string; photoCount: number }> {
+        const totalBytes = files.reduce((sum, file) => sum + file.size, 0);
+        let uploadedBytes = 0;
+        let photoCount = 0;
+        const advance = (bytes: number) => {
+            uploadedBytes += bytes;
+            onProgress?.(uploadedBytes, totalBytes);
+        };
 
         try {
-            const response = await apiClient.post('/upload', formData);
-            return response.data;
+            // Bounded multipart requests for small files, so a big selection never hits the request size limit
+            for (const batch of uploadBatches(files.filter(file => file.size <= RESUMABLE_THRESHOLD_BYTES))) {
+                const formData = new FormData();
+                batch.forEach(file => {
+                    formData.append('photos', file);
+                });
+                const response = await apiClient.post('/upload', formData);
+                photoCount += response.data.photoCount;
+                advance(batch.reduce((sum, file) => sum + file.size, 0));
+            }
+            for (const file of files.filter(file => file.size > RESUMABLE_THRESHOLD_BYTES)) {
+                await this.uploadResumable(file, advance);
+                photoCount += 1;
+            }
         } catch (error) {
             console.error('Upload error:', error);
             throw new Error('Failed to upload photos');
         }
+        return { message: `Successfully uploaded ${photoCount} photos`, photoCount };
+    }
+
+    // Send one large file in chunks, resuming from the server's offset after a failed chunk
+    private async uploadResumable(file: File, advance: (bytes: number) => void): Promise<Photo> {
+        const created = await apiClient.post('/uploads', { filename: file.name, size: file.size }, {
+            headers: { 'Content-Type': 'application/json' },
+        });
+        const uploadUrl: string = created.data.uploadUrl;
+        let offset = 0;
+        let failures = 0;
+        while (true) {
+            try {
+                const response = await apiClient.patch(uploadUrl, file.slice(offset, offset + UPLOAD_CHUNK_BYTES), {
+                    headers: { 'Content-Type': 'application/offset+octet-stream', 'Upload-Offset': String(offset) },
+                });
+                advance(response.data.offset - offset);
+                offset = response.data.offset;
+                failures = 0;
+                if (response.data.complete) {
+                    return resolvePhoto(response.data.photo);
+                }
+            } catch (error) {
+                if (++failures > UPLOAD_RETRIES) {
+                    throw error;
+                }
+                await sleep(STATUS_POLL_INTERVAL_MS * failures);
+                // Ask where the upload stands and carry on from there
+                const status = await apiClient.get(uploadUrl);
+                advance(status.data.offset - offset);
+                offset = status.data.offset;
+            }
+        }
     }
 
-    async processPhotos(): Promise<ClusteringResult> {
+    async processPhotos(onProgress?: (status: JobStatus) => void): Promise<ClusteringResult> {
+        let status: JobStatus;
         try {
             const response = await apiClient.post('/process');
-            return response.data;
+            const jobId: string = response.data.jobId;
+            // Processing runs in the background; poll until the job finishes
+            do {
+                await sleep(STATUS_POLL_INTERVAL_MS);
+                status = await this.getJobStatus(jobId);
+                onProgress?.(status);
+            } while (status.status === 'queued' || status.status === 'processing');
         } catch (error) {
             console.error('Processing error:', error);
             throw new Error('Failed to process photos');
         }
+
+        if (status.status === 'error') {
+            throw new Error(status.message || 'Failed to process photos');
+        }
+        return this.getClusteringResults();
+    }
+
+    async getJobStatus(jobId: string): Promise<JobStatus> {
+        const response = await apiClient.get(`/status/${jobId}`);
+        return response.data;
+    }
+
+    // One page of clusters, or of unclustered photos; pass the previous page's nextCursor to continue
+    async getResultPage<T>(section: 'clusters' | 'unclustered', cursor: string | null = null,
+                           limit: number = RESULT_PAGE_SIZE): Promise<ResultPage<T>> {
+        const path = section === 'clusters' ? '/cluster' : '/cluster/unclustered';
+        const response = await apiClient.get(path, { params: { limit, cursor } });
+        const { nextCursor, clusterCount, unclusteredCount } = response.data;
+        return { items: response.data[section], nextCursor, clusterCount, unclusteredCount };
     }
 
     async getClusteringResults(): Promise<ClusteringResult> {
         try {
-            const response = await apiClient.get('/cluster');
-            return response.data;
+            const clusters: Cluster[] = [];
+            const unclustered: Photo[] = [];
+            let cursor: string | null = null;
+            do {
+                const page: ResultPage<Cluster> = await this.getResultPage<Cluster>('clusters', cursor);
+                clusters.push(...page.items);
+                cursor = page.nextCursor;
+            } while (cursor);
+            do {
+                const page: ResultPage<Photo> = await this.getResultPage<Photo>('unclustered', cursor);
+                unclustered.push(...page.items);
+                cursor = page.nextCursor;
+            } while (cursor);
+            return resolveResult({ clusters, unclustered });
         } catch (error) {
             console.error('Get results error:', error);
             throw new Error('Failed to get clustering results');
@@ -96,7 +293,7 @@ class ApiService {
     async getPhoto(photoId: string): Promise<Photo> {
         try {
             const response = await apiClient.get(`/photos/${photoId}`);
-            return response.data;
+            return resolvePhoto(response.data);
         } catch (error) {
             console.error('Get photo error:', error);
             throw new Error('Failed to get photo');
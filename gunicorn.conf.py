@@ -0,0 +1,41 @@
+"""
+Gunicorn settings for the PhotoRank backend.
+
+The app, and with it the model weights, is imported once in the master
+before workers are forked, so adding workers shares the weights instead of
+loading another copy per worker. Each worker then runs a warm-up batch
+before it takes requests, so no request pays for model loading.
+
+The embedding cache and store are not shared between workers: each worker
+claims its own worker-N directory under the cache root with a file lock,
+and a restarted worker takes over the files its predecessor left.
+
+Sessions (uploads, duplicates, clustering results) and job status are
+shared through PHOTORANK_SESSION_BACKEND. The default, memory, keeps
+them in each worker, so it needs WEB_CONCURRENCY=1; with more workers
+use sqlite (workers on one host, which also share UPLOAD_FOLDER) or
+redis (any number of hosts, with UPLOAD_FOLDER on shared storage and
+PHOTORANK_SECRET_KEY set). A job runs in the worker that accepted
+/process and saves its progress to the backend, so any worker can
+answer /status and stream it; the clusterer a job leaves behind for
+the next one stays in that worker.
+"""
+import os
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 120
+preload_app = True
+
+# Read by photorank.app at import time, which preload_app runs in the master
+os.environ.setdefault('PHOTORANK_PRELOAD_MODELS', '1')
+
+
+def post_worker_init(worker):
+    if os.environ.get('PHOTORANK_WARMUP', '1') != '1':
+        return
+    # The module that defined the app, whatever import path gunicorn used
+    sys.modules[worker.wsgi.import_name].warm_up()
@@ -1,16 +1,37 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory, stream_with_context
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
+import logging
 import os
+import threading
+import time
 import uuid
 from datetime import datetime
 from .photo_classifier import PhotoClassifier
+from .embedding_cache import default_cache_dir, file_content_hash
+from .embedding_store import default_store_dtype
+from .jobs import FINISHED_STATES, JobQueue, sse_event
+from . import metrics, model_registry
+from .inference import default_backend
+from .metrics import log_event, timed
+from .perceptual import CLUSTER_STRATEGIES, default_cluster_strategy
+from .prefetch import default_kind, default_workers
+from .photo_registry import UPLOAD_FORMATS, PhotoRecord
+from .renditions import RENDITION_SIZES, RenditionStore
+from .results import CLUSTERS, DEFAULT_PAGE_SIZE, UNCLUSTERED, SerializedResults, StaleCursor, content_encodings, media_types
+from .sessions import QuotaExceeded, SessionManager, build_backend, load_secret
+from .uploads import IngestQueue, OffsetMismatch, ResumableUploads, StreamingRequest, save_upload
 from .utils import load_images, display_clusters
-from PIL import Image
-import io
-import base64
 
 app = Flask(__name__)
+# Hosts like Render end TLS at a proxy; trust its X-Forwarded-* headers so request.is_secure
+# and URLs reflect what the browser sees. PHOTORANK_PROXY_HOPS=0 when serving directly
+PROXY_HOPS = int(os.environ.get('PHOTORANK_PROXY_HOPS', 1))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS, x_host=PROXY_HOPS)
+# Multipart file parts are written straight to disk as they arrive
+app.request_class = StreamingRequest
 # Enable CORS for frontend with specific origins
 CORS(app, 
      origins=[
@@ -18,42 +39,167 @@ CORS(app,
          'http://localhost:3000'  # For local development
      ],
      supports_credentials=True,
-     allow_headers=['Content-Type', 'Authorization'],
-     methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS']
+     allow_headers=['Content-Type', 'Authorization', 'Upload-Offset', 'X-Photorank-Session'],
+     expose_headers=['Location', 'Upload-Offset', 'Upload-Length', 'X-Photorank-Session'],
+     methods=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
 )
 
 # Configuration
 UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'heic'}
-MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 100 * 1024 * 1024))  # 100MB max file size
+MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 100 * 1024 * 1024))  # 100MB max request size
+# Largest single file accepted through the resumable upload API
+MAX_UPLOAD_SIZE = int(os.environ.get('PHOTORANK_MAX_UPLOAD_SIZE', 1024 * 1024 * 1024))
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+# Same filesystem as the uploads, so a finished part is moved into place with a rename
+app.config['UPLOAD_SPOOL_FOLDER'] = os.path.abspath(os.path.join(UPLOAD_FOLDER, 'incoming'))
+# Embeddings and quality scores are cached on the persistent disk between /process calls
+CACHE_FOLDER = default_cache_dir()
+# 'exact', 'ivf' or 'auto' (exact until the library outgrows brute-force search)
+NEIGHBOR_INDEX = os.environ.get('PHOTORANK_NEIGHBOR_INDEX', 'auto')
+# Images decoded and preprocessed ahead of the model by 'thread' or 'process' workers
+PREFETCH_WORKERS = default_workers()
+PREFETCH_KIND = default_kind()
+# 'global', 'multiscale' or 'tiled' Laplacian-variance sharpness
+SHARPNESS_MODE = os.environ.get('PHOTORANK_SHARPNESS', 'global')
+# How the models run: eager, torchscript, static_int8 or onnx
+INFERENCE_BACKEND = default_backend()
+# 'deep' embeds every photo; 'two_tier' groups bursts by perceptual hash first (per request via /process)
+CLUSTER_STRATEGY = default_cluster_strategy()
+# Clustered photos' features are kept by photo id, as 'float32', 'float16' or 'int8' rows
+EMBEDDING_DTYPE = default_store_dtype()
+
+# JSON log lines on stderr; PHOTORANK_LOG_SAMPLE thins out routine events
+metrics.configure_logging()
+
+# Load model weights at import time. Under gunicorn with preload_app that is
+# the master, so forked workers share one copy of the weights
+PRELOAD_MODELS = os.environ.get('PHOTORANK_PRELOAD_MODELS', '0') == '1'
+if PRELOAD_MODELS:
+    model_registry.preload()
 
 # Create upload folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(app.config['UPLOAD_SPOOL_FOLDER'], exist_ok=True)
+resumable_uploads = ResumableUploads(os.path.join(UPLOAD_FOLDER, 'resumable'), MAX_UPLOAD_SIZE)
+
+# Thumbnails and previews are generated once per upload and cached next to the uploads
+renditions = RenditionStore(os.path.join(UPLOAD_FOLDER, 'renditions'))
+# Rendition URLs embed the photo id, so their content never changes
+RENDITION_MAX_AGE = 365 * 24 * 60 * 60
 
-# Global variables to store uploaded photos and results
-uploaded_photos = []
-clustering_results = None
 classifier = None  # Initialize lazily to save memory
-processing_status = {"status": "idle", "message": "Ready to process photos"}
+classifier_lock = threading.Lock()
+# Ids of photos ingest could not embed; sets are safe to update from several threads
+unembeddable = set()
+
+def discard_photos(session_id, photo_ids):
+    """Remove what an evicted session's photos left outside its upload directory"""
+    for photo_id in photo_ids:
+        renditions.remove(photo_id)
+        unembeddable.discard(photo_id)
+    if classifier is not None and classifier.store is not None and photo_ids:
+        with classifier_lock:
+            classifier.store.delete(photo_ids)
+            classifier.store.flush()
+
+# Each session (a cookie, or the X-Photorank-Session header) has its own photos,
+# duplicates, results and upload directory, mirrored to PHOTORANK_SESSION_BACKEND
+sessions = SessionManager(build_backend(root=UPLOAD_FOLDER), os.path.join(UPLOAD_FOLDER, 'sessions'),
+                          on_evict=discard_photos, secret=load_secret(os.path.join(UPLOAD_FOLDER, '.secret_key')))
+SESSION_COOKIE = 'photorank_session'
+SESSION_HEADER = 'X-Photorank-Session'
+# The frontend is served from another site, so the cookie must be SameSite=None, which browsers
+# only accept with Secure. Plain-HTTP development (FLASK_ENV=development) falls back to Lax
+SECURE_COOKIES = os.environ.get('PHOTORANK_SECURE_COOKIES',
+                                '0' if os.environ.get('FLASK_ENV') == 'development' else '1') == '1'
+
+def share_job(job):
+    """Save a job's state to the session backend, so /status works on every worker"""
+    try:
+        sessions.save_job(job.owner, job.id, job.to_dict())
+    except Exception as e:
+        log_event('job_save_failed', logging.WARNING, job=job.id, error=str(e))
+
+# Background workers run /process jobs so uploads and health checks are never blocked
+job_queue = JobQueue(workers=int(os.environ.get('PHOTORANK_JOB_WORKERS', 1)), on_change=share_job)
+
+metrics.registry.gauge('photorank_photos', 'Uploaded photos held in memory', sessions.loaded_photos)
+metrics.registry.gauge('photorank_sessions', 'Sessions known to the session backend', lambda: len(sessions))
+metrics.registry.gauge('photorank_jobs_active', 'Processing jobs queued or running', job_queue.active)
+metrics.registry.gauge('photorank_models_loaded', 'Models loaded in this process',
+                       lambda: len(model_registry.loaded_models()))
+metrics.registry.gauge('photorank_ingest_pending', 'Uploaded photos waiting for background preprocessing',
+                       lambda: ingest_queue.pending())
+SSE_KEEPALIVE_SECONDS = 15
+# How often a stream polls the session backend for a job running on another worker
+SSE_POLL_SECONDS = 1
+# Neighbours /photos/<id>/similar returns by default and at most
+SIMILAR_DEFAULT_K = 10
+SIMILAR_MAX_K = 100
+# Seconds a client waits before asking again for a photo still being embedded
+SIMILAR_RETRY_AFTER = 2
+STAGE_MESSAGES = {
+    'features': 'Extracting features...',
+    'clustering': 'Clustering images...',
+    'ranking': 'Ranking photos...'
+}
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def image_to_base64(image):
-    """Convert PIL Image to base64 string"""
-    buffer = io.BytesIO()
-    image.save(buffer, format='JPEG')
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    return f"data:image/jpeg;base64,{img_str}"
+def current_workspace(create=True):
+    """
+    The requesting session's workspace, from the session cookie or the
+    X-Photorank-Session header; a new session is started when there is
+    none (or it expired) and `create` is set, else None.
+    """
+    if 'workspace' not in g:
+        session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+        workspace = sessions.get(session_id) if session_id else None
+        if workspace is None and create:
+            workspace = sessions.create()
+            log_event('session_started', session=workspace.id)
+        if workspace is None:
+            return None
+        g.workspace = workspace
+    return g.workspace
+
+def photo_dict(workspace, photo):
+    """A photo's JSON, with rendition URLs that load without the session (e.g. in <img> tags)"""
+    return photo.to_dict(token=sessions.media_token(workspace.id, photo.id))
+
+def upload_path(workspace, filename):
+    """Unique location in the session's upload directory for a file called `filename`"""
+    os.makedirs(workspace.directory, exist_ok=True)
+    return os.path.join(workspace.directory, f"{uuid.uuid4()}_{filename}")
+
+def register_upload(workspace, filename, filepath, content_hash=None):
+    """
+    Validate a stored upload from its header, register it in the session
+    and queue its preprocessing. Content already stored is not kept twice;
+    `content_hash` is the file's SHA-256 when it was computed while the
+    upload streamed in. QuotaExceeded when the session is full.
+    """
+    try:
+        # Only the header is read here; the image is decoded in the background
+        record = PhotoRecord.from_file(str(uuid.uuid4()), filename, filepath, formats=UPLOAD_FORMATS)
+        record.content_hash = content_hash or file_content_hash(filepath)
+        sessions.add_photo(workspace, record)
+    except Exception:
+        os.remove(filepath)
+        raise
+    if record.duplicate_of is not None:
+        log_event('duplicate_upload', filename=filename, duplicate_of=record.duplicate_of)
+    ingest_queue.submit(record, workspace.duplicates)
+    return record
 
 @app.route('/upload', methods=['POST'])
 def upload_photos():
-    global uploaded_photos
-    
+    """Multipart upload of one or more photos; each part streams to disk while it is received"""
     if 'photos' not in request.files:
         return jsonify({'error': 'No photos provided'}), 400
     
@@ -62,207 +208,490 @@ def upload_photos():
     if not files or files[0].filename == '':
         return jsonify({'error': 'No files selected'}), 400
     
+    workspace = current_workspace()
     uploaded_count = 0
+    rejected = None
     
     for file in files:
         if file and allowed_file(file.filename):
             try:
-                # Generate unique filename
+                # Parts are already on disk; this only moves them into place
                 filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4()}_{filename}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                
-                # Save file
-                file.save(filepath)
-                
-                # Load image and convert to base64
-                image = Image.open(filepath)
-                
-                # Create photo object
-                photo = {
-                    'id': str(uuid.uuid4()),
-                    'filename': filename,
-                    'url': image_to_base64(image),
-                    'filepath': filepath,
-                    'image': image
-                }
-                
-                uploaded_photos.append(photo)
+                filepath = upload_path(workspace, filename)
+                content_hash = save_upload(file, filepath)
+                register_upload(workspace, filename, filepath, content_hash)
                 uploaded_count += 1
                 
+            except QuotaExceeded as e:
+                rejected = str(e)
+                continue
             except Exception as e:
-                print(f"Error processing {file.filename}: {str(e)}")
+                metrics.count_error('upload')
+                log_event('upload_failed', logging.WARNING, filename=file.filename, error=str(e))
                 continue
     
-    return jsonify({
+    if rejected and not uploaded_count:
+        return jsonify({'error': rejected}), 413
+    
+    body = {
         'message': f'Successfully uploaded {uploaded_count} photos',
         'photoCount': uploaded_count
-    })
+    }
+    if rejected:
+        body['error'] = rejected
+    return jsonify(body)
 
-@app.route('/process', methods=['POST'])
-def process_photos():
-    global uploaded_photos, clustering_results, classifier, processing_status
+def get_classifier():
+    """Initialize the classifier lazily to save memory"""
+    global classifier
+    if classifier is None:
+        # Use full version for Starter plan
+        classifier = PhotoClassifier(cache_dir=CACHE_FOLDER, incremental=True,
+                                     neighbor_index=NEIGHBOR_INDEX,
+                                     prefetch_workers=PREFETCH_WORKERS, prefetch=PREFETCH_KIND,
+                                     sharpness_mode=SHARPNESS_MODE, backend=INFERENCE_BACKEND,
+                                     cluster_strategy=CLUSTER_STRATEGY,
+                                     store_dir=os.path.join(CACHE_FOLDER, 'embeddings'), store_dtype=EMBEDDING_DTYPE)
+        log_event('classifier_ready', backend=INFERENCE_BACKEND)
+    return classifier
+
+def precompute_embeddings(records):
+    """Embed freshly uploaded photos so /process finds them cached and /similar finds them stored"""
+    with classifier_lock:
+        photo_classifier = get_classifier()
+        with timed('ingest', len(records)):
+            photo_classifier.store_features([(record.id, record.filepath) for record in records])
+        # So /similar stops waiting for photos the model could not read
+        unembeddable.update(record.id for record in records if record.id not in photo_classifier.store)
+
+# Renditions, and embeddings unless PHOTORANK_INGEST_PRECOMPUTE=0, are made as photos land
+INGEST_PRECOMPUTE = os.environ.get('PHOTORANK_INGEST_PRECOMPUTE', '1') == '1'
+# Photos are submitted with their session's duplicate index
+ingest_queue = IngestQueue(renditions, embed=precompute_embeddings if INGEST_PRECOMPUTE else None)
+
+def warm_up():
+    """Build the classifier and run a dummy batch; gunicorn calls this as each worker boots"""
+    started = time.perf_counter()
+    with timed('warm_up'):
+        get_classifier().warm_up()
+    log_event('warmed_up', seconds=round(time.perf_counter() - started, 3))
+
+def run_processing(job, workspace, photos, strategy=None):
+    """Cluster and rank a snapshot of a session's photos on a background worker"""
+    log_event('job_started', job=job.id, session=workspace.id, photos=len(photos),
+              strategy=strategy or CLUSTER_STRATEGY)
     
-    print("=== PROCESS ENDPOINT CALLED ===")
-    print(f"Uploaded photos count: {len(uploaded_photos)}")
+    def report(stage, done, total):
+        if stage != job.stage:
+            job.update(message=STAGE_MESSAGES.get(stage, stage))
+        job.progress(stage, done, total)
     
-    if not uploaded_photos:
-        print("ERROR: No photos uploaded")
-        return jsonify({'error': 'No photos uploaded'}), 400
+    # Photos that arrived faster than the ingest queue are checked for duplicates here
+    for photo in photos:
+        if photo.perceptual_hash is None:
+            try:
+                with timed('dedup'):
+                    workspace.duplicates.flag(photo)
+            except Exception as e:
+                log_event('dedup_failed', logging.WARNING, filename=photo.filename, error=str(e))
+    # Hashes and duplicate flags set since upload, for other workers that load the session
+    sessions.save_photos(workspace, photos)
+    distinct, duplicates = workspace.duplicates.partition(photos)
+    log_event('duplicates_skipped', job=job.id, photos=len(photos) - len(distinct))
     
-    try:
-        processing_status = {"status": "processing", "message": "Initializing classifier..."}
-        print("Starting photo processing...")
+    # Runs share the classifier's models, so they take turns; each session keeps its own clusterer
+    with classifier_lock:
+        job.update(message="Initializing classifier...")
+        photo_classifier = get_classifier()
         
-        # Initialize classifier lazily to save memory
-        if classifier is None:
-            print("Initializing PhotoClassifier...")
-            # Use full version for Starter plan
-            classifier = PhotoClassifier()
-            print("PhotoClassifier initialized successfully")
+        # Pass ids and file paths; the classifier decodes each image only while it is being processed,
+        # and results come back keyed by id, so photos sharing a filename stay apart
+        images = [(photo.id, photo.filepath) for photo in distinct]
         
-        processing_status = {"status": "processing", "message": "Extracting features..."}
-        # Extract images for clustering (only use the image data, not the full photo object)
-        images = [(photo['filename'], photo['image']) for photo in uploaded_photos]
-        print(f"Extracted {len(images)} images for clustering")
-        
-        processing_status = {"status": "processing", "message": "Clustering images..."}
         # Perform clustering
-        print("Starting clustering...")
-        cluster_groups = classifier.cluster_images(images)
-        print(f"Clustering completed. Found {len(cluster_groups)} groups")
-        
-        # Convert results to frontend format
-        clusters = []
-        unclustered = []
+        cluster_groups = photo_classifier.cluster_images(images, progress=report, strategy=strategy,
+                                                         owner=workspace)
         
-        for cluster_id, ranked_images in cluster_groups.items():
-            if cluster_id == -1:  # Unclustered images
-                for filename, score in ranked_images:
-                    photo = next((p for p in uploaded_photos if p['filename'] == filename), None)
-                    if photo:
-                        unclustered.append({
-                            'id': photo['id'],
-                            'filename': photo['filename'],
-                            'url': photo['url'],
-                            'score': float(score) if score is not None else None
+        # Near copies (bursts, edits) are ranked against their original, so they get their own
+        # quality score; exact copies have the same pixels and share the original's
+        by_id = {photo.id: photo for photo in distinct}
+        near_copies = [copy for original_id, copies in duplicates.items() for copy in copies
+                       if copy.content_hash != by_id[original_id].content_hash]
+        with timed('copy_scoring', len(near_copies)):
+            copy_scores = photo_classifier.score_images([(copy.id, copy.filepath) for copy in near_copies])
+    
+    # Encoded once here; /cluster requests only splice and send the bytes
+    with timed('serialization', len(photos)):
+        token = lambda photo_id: sessions.media_token(workspace.id, photo_id)
+        results = SerializedResults(format_results(cluster_groups, distinct, duplicates, copy_scores, token),
+                                    version=job.id)
+        results.prepare()
+    log_event('job_finished', job=job.id, clusters=results.cluster_count, unclustered=results.unclustered_count)
+    
+    sessions.save_results(workspace, results)
+    return {'clusterCount': results.cluster_count, 'unclusteredCount': results.unclustered_count}
+
+def format_results(cluster_groups, photos, duplicates=None, copy_scores=None, token=None):
+    """
+    Convert ranked clusters to the frontend's format. `duplicates` maps a
+    photo id to copies that skipped the clustering model; they join that
+    photo's cluster with their score in `copy_scores` (by photo id), or
+    the photo's own score when they have none there (exact copies). An
+    unclustered photo with copies forms a cluster. Ranked clusters are
+    keyed by photo id, and each cluster's photos are ordered best first.
+    `token(photo_id)`, if given, signs each photo's rendition URLs.
+    """
+    duplicates = duplicates or {}
+    copy_scores = copy_scores or {}
+    token = token or (lambda photo_id: None)
+    photos_by_id = {photo.id: photo for photo in photos}
+    # Convert results to frontend format
+    clusters = []
+    unclustered = []
+    next_cluster_id = max((int(c) for c in cluster_groups), default=-1) + 1
+    
+    def with_copies(photo, score):
+        score = float(score) if score is not None else None
+        return [dict(photo.to_dict(token(photo.id)), score=score)] + [
+            dict(copy.to_dict(token(copy.id)), score=copy_scores.get(copy.id, score))
+            for copy in duplicates.get(photo.id, [])]
+    
+    def best_first(photo_objs):
+        # Stable, so exact copies stay next to their original
+        return sorted(photo_objs, key=lambda p: p['score'] if p['score'] is not None else float('-inf'), reverse=True)
+    
+    for cluster_id, ranked_images in cluster_groups.items():
+        if cluster_id == -1:  # Unclustered images
+            for photo_id, score in ranked_images:
+                photo = photos_by_id.get(photo_id)
+                if photo:
+                    photo_objs = best_first(with_copies(photo, score))
+                    if len(photo_objs) == 1:
+                        unclustered.append(photo_objs[0])
+                    else:
+                        clusters.append({
+                            'id': next_cluster_id,
+                            'photos': photo_objs,
+                            'recommendedPhoto': photo_objs[0]
                         })
-            else:  # Clustered images
-                cluster_photos = []
-                recommended_photo = None
-                
-                for filename, score in ranked_images:
-                    photo = next((p for p in uploaded_photos if p['filename'] == filename), None)
-                    if photo:
-                        photo_obj = {
-                            'id': photo['id'],
-                            'filename': photo['filename'],
-                            'url': photo['url'],
-                            'score': float(score) if score is not None else None
-                        }
-                        cluster_photos.append(photo_obj)
-                        
-                        # First photo is the recommended one
-                        if not recommended_photo:
-                            recommended_photo = photo_obj
-                
-                clusters.append({
-                    'id': int(cluster_id),
-                    'photos': cluster_photos,
-                    'recommendedPhoto': recommended_photo
-                })
-        
-        clustering_results = {
-            'clusters': clusters,
-            'unclustered': unclustered
-        }
-        
-        processing_status = {"status": "completed", "message": "Processing completed successfully"}
-        
-        # Debug: Print the structure to see what might be causing issues - UPDATED
-        print("Debug - Clustering results structure:")
-        print(f"Number of clusters: {len(clusters)}")
-        print(f"Number of unclustered: {len(unclustered)}")
-        
-        # Ensure no PIL Image objects are in the response
-        def clean_for_json(obj):
-            if isinstance(obj, dict):
-                return {k: clean_for_json(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [clean_for_json(item) for item in obj]
-            elif hasattr(obj, '__dict__'):  # Check if it's a PIL Image or similar object
-                return str(obj)
-            else:
-                return obj
-        
-        cleaned_results = clean_for_json(clustering_results)
-        print("Debug - Cleaned clustering_results:", cleaned_results)
-        
-        print("About to create JSON response...")
-        try:
-            response = jsonify(cleaned_results)
-            print("Debug - JSON response created successfully")
-            print(f"Response size: {len(str(cleaned_results))} characters")
-            return response
-        except Exception as json_error:
-            print(f"Debug - JSON serialization error: {json_error}")
-            import traceback
-            traceback.print_exc()
-            # Return a simplified response without the problematic data
-            simplified_results = {
-                'clusters': [{'id': c['id'], 'photoCount': len(c['photos'])} for c in clusters],
-                'unclustered': [{'id': p['id'], 'filename': p['filename']} for p in unclustered]
-            }
-            print("Returning simplified results")
-            return jsonify(simplified_results)
-        
+                        next_cluster_id += 1
+        else:  # Clustered images
+            cluster_photos = []
+            
+            for photo_id, score in ranked_images:
+                photo = photos_by_id.get(photo_id)
+                if photo:
+                    cluster_photos.extend(with_copies(photo, score))
+            cluster_photos = best_first(cluster_photos)
+            
+            clusters.append({
+                'id': int(cluster_id),
+                'photos': cluster_photos,
+                # First photo is the recommended one
+                'recommendedPhoto': cluster_photos[0] if cluster_photos else None
+            })
+    
+    return {
+        'clusters': clusters,
+        'unclustered': unclustered
+    }
+
+@app.route('/uploads', methods=['POST'])
+def create_resumable_upload():
+    """Start a chunked, resumable upload of one file declared as {filename, size}"""
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename', '')))
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'Unsupported file type'}), 400
+    size = data.get('size')
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return jsonify({'error': 'size must be the file size in bytes'}), 400
+    try:
+        workspace = current_workspace()
+        # Refused up front rather than after the whole file has been sent
+        sessions.check_quota(workspace, size)
+        upload = resumable_uploads.create(filename, size, owner=workspace.id)
+    except (ValueError, QuotaExceeded) as e:
+        return jsonify({'error': str(e)}), 413
+    return resumable_response(upload, 201)
+
+def owned_upload(upload_id):
+    """A resumable upload started by the requesting session, or None"""
+    upload = resumable_uploads.get(upload_id)
+    workspace = current_workspace(create=False)
+    if upload is None or workspace is None or upload.get('owner') != workspace.id:
+        return None
+    return upload
+
+def resumable_response(upload, status=200, photo=None):
+    body = {
+        'uploadId': upload['id'],
+        'uploadUrl': f"/uploads/{upload['id']}",
+        'offset': upload['offset'],
+        'size': upload['size'],
+        'complete': upload['offset'] == upload['size'],
+    }
+    if photo is not None:
+        body['photo'] = photo
+    response = jsonify(body)
+    response.status_code = status
+    response.headers['Location'] = body['uploadUrl']
+    response.headers['Upload-Offset'] = str(upload['offset'])
+    response.headers['Upload-Length'] = str(upload['size'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_resumable_upload(upload_id):
+    """Where an upload stands, so an interrupted client knows the offset to resume from"""
+    upload = owned_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return resumable_response(upload)
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def append_resumable_upload(upload_id):
+    """Append the request body at the Upload-Offset header; the last chunk registers the photo"""
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    if owned_upload(upload_id) is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    try:
+        upload = resumable_uploads.append(upload_id, offset, request.stream)
+    except KeyError:
+        return jsonify({'error': 'Upload not found'}), 404
+    except OffsetMismatch as e:
+        response = jsonify({'error': str(e), 'offset': e.offset})
+        response.status_code = 409
+        response.headers['Upload-Offset'] = str(e.offset)
+        return response
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 413
+    
+    if upload['offset'] < upload['size']:
+        return resumable_response(upload)
+    
+    workspace = current_workspace()
+    filepath = upload_path(workspace, upload['filename'])
+    resumable_uploads.finish(upload_id, filepath)
+    try:
+        record = register_upload(workspace, upload['filename'], filepath)
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
-        print(f"Error processing photos: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        processing_status = {"status": "error", "message": f"Processing failed: {str(e)}"}
-        return jsonify({'error': 'Failed to process photos'}), 500
+        metrics.count_error('upload')
+        log_event('upload_failed', logging.WARNING, filename=upload['filename'], error=str(e))
+        return jsonify({'error': 'Not a supported image'}), 415
+    return resumable_response(upload, 201, photo=photo_dict(workspace, record))
 
-@app.route('/cluster', methods=['GET'])
-def get_clustering_results():
-    global clustering_results
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_resumable_upload(upload_id):
+    if owned_upload(upload_id) is None or not resumable_uploads.abort(upload_id):
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'message': 'Upload cancelled'})
+
+@app.route('/process', methods=['POST'])
+def process_photos():
+    """Queue a clustering job and return its id right away; {"strategy": ...} picks the clustering strategy"""
+    workspace = current_workspace()
+    photos = workspace.photos.snapshot()
+    
+    if not photos:
+        return jsonify({'error': 'No photos uploaded'}), 400
+    
+    strategy = (request.get_json(silent=True) or {}).get('strategy') or CLUSTER_STRATEGY
+    if strategy not in CLUSTER_STRATEGIES:
+        return jsonify({'error': f'Unknown cluster strategy: {strategy}'}), 400
+    
+    job = job_queue.submit(run_processing, workspace, photos, strategy,
+                           description=f"Cluster {len(photos)} photos", owner=workspace.id)
+    return jsonify({
+        'jobId': job.id,
+        'status': job.status,
+        'statusUrl': f"/status/{job.id}",
+        'streamUrl': f"/status/{job.id}/stream"
+    }), 202
+
+def results_response(section, default_limit=None):
+    """
+    Serve the session's latest results from their cached encoding: the whole result,
+    or with ?limit= one page of `section` and a nextCursor for the next.
+    JSON or msgpack by Accept, compressed by Accept-Encoding, and 304 when
+    the client's ETag still matches.
+    """
+    workspace = current_workspace(create=False)
+    results = workspace.results if workspace is not None else None
     
-    if clustering_results is None:
+    if results is None:
         return jsonify({'error': 'No clustering results available'}), 404
     
-    return jsonify(clustering_results)
+    media_type = request.accept_mimetypes.best_match(media_types()) or media_types()[0]
+    encoding = next((e for e in content_encodings() if request.accept_encodings[e]), None)
+    limit = request.args.get('limit', default_limit, type=int)
+    try:
+        with timed('serialization'):
+            body, etag, applied = results.body(media_type, section, request.args.get('cursor'), limit, encoding)
+    except StaleCursor as e:
+        return jsonify({'error': str(e)}), 410
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    response = Response(body, mimetype=media_type)
+    if applied:
+        response.content_encoding = applied
+    response.vary.update(['Accept', 'Accept-Encoding'])
+    response.set_etag(etag)
+    # Results change with every job, so clients revalidate each time; unchanged ones cost a 304
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/cluster', methods=['GET'])
+def get_clustering_results():
+    """Clustering results; ?limit=&cursor= pages through the clusters"""
+    return results_response(CLUSTERS)
+
+@app.route('/cluster/unclustered', methods=['GET'])
+def get_unclustered_results():
+    """Unclustered photos of the latest results, a page at a time with ?limit=&cursor="""
+    return results_response(UNCLUSTERED, default_limit=DEFAULT_PAGE_SIZE)
+
+def session_photos():
+    """The requesting session's photo registry; None when it has no session"""
+    workspace = current_workspace(create=False)
+    return workspace.photos if workspace is not None else None
+
+def find_photo(photo_id):
+    """A photo of the requesting session, or None; other sessions' photos are never found"""
+    photos = session_photos()
+    return photos.get(photo_id) if photos is not None else None
+
+def media_photo(photo_id):
+    """
+    The photo a file or rendition request is for: by the signed ?token= its
+    URL carries, since <img> requests can't send the session header, else
+    from the requesting session
+    """
+    token = request.args.get('token')
+    if token:
+        return sessions.find_photo(photo_id, token)[1]
+    return find_photo(photo_id)
 
 @app.route('/photos/<photo_id>', methods=['GET'])
 def get_photo(photo_id):
-    global uploaded_photos
+    photo = find_photo(photo_id)
+    
+    if not photo:
+        return jsonify({'error': 'Photo not found'}), 404
+    
+    return jsonify(photo_dict(g.workspace, photo))
+
+@app.route('/photos/by-hash/<content_hash>', methods=['GET'])
+def get_photo_by_hash(content_hash):
+    """The photo already holding these bytes (SHA-256 hex), so a client can skip uploading it again"""
+    photos = session_photos()
+    photo = photos.get_by_content_hash(content_hash.lower()) if photos is not None else None
+    
+    if not photo:
+        return jsonify({'error': 'Photo not found'}), 404
     
-    photo = next((p for p in uploaded_photos if p['id'] == photo_id), None)
+    return jsonify(photo_dict(g.workspace, photo))
+
+@app.route('/photos/<photo_id>/similar', methods=['GET'])
+def get_similar_photos(photo_id):
+    """The k photos of the session that look most like this one, by cosine similarity of their stored features"""
+    photos = session_photos()
+    photo = photos.get(photo_id) if photos is not None else None
     
     if not photo:
         return jsonify({'error': 'Photo not found'}), 404
     
+    try:
+        k = min(max(int(request.args.get('k', SIMILAR_DEFAULT_K)), 1), SIMILAR_MAX_K)
+    except ValueError:
+        return jsonify({'error': 'k must be an integer'}), 400
+    
+    # Copies are never embedded; search from the photo they copy, which then leads the results
+    original = photo
+    while original.duplicate_of is not None and photos.get(original.duplicate_of) is not None:
+        original = photos.get(original.duplicate_of)
+    # The store holds every session's photos (and some from before a restart); search this session's distinct ones
+    candidates = [record.id for record in photos if record.duplicate_of is None]
+    matches = [] if original is photo else [(original.id, 1.0)]
+    try:
+        # Looked up and read in one hold of the store's lock, so a concurrent delete can't slip in between
+        matches += get_classifier().similar_photos(original.id, k - len(matches), candidates=candidates)
+    except KeyError:
+        # Not embedded yet. Running ResNet50 here would hold the models up for every job, so ingest does it
+        if original.id in unembeddable:
+            return jsonify({'error': 'Could not extract features from this photo'}), 422
+        if ingest_queue.embed is None:
+            return jsonify({'error': 'Photo has no features yet; process the session first'}), 409
+        if not ingest_queue.queued(original.id):
+            ingest_queue.submit(original, g.workspace.duplicates)
+        response = jsonify({'status': 'pending', 'message': 'Extracting features; try again shortly'})
+        response.headers['Retry-After'] = str(SIMILAR_RETRY_AFTER)
+        return response, 202
     return jsonify({
-        'id': photo['id'],
-        'filename': photo['filename'],
-        'url': photo['url']
+        'photo': photo_dict(g.workspace, photo),
+        'similar': [{**photo_dict(g.workspace, photos.get(match_id)), 'similarity': round(similarity, 4)}
+                    for match_id, similarity in matches if photos.get(match_id) is not None],
     })
 
-@app.route('/photos/<photo_id>', methods=['DELETE'])
-def delete_photo(photo_id):
-    global uploaded_photos
+@app.route('/photos/<photo_id>/file', methods=['GET'])
+def get_photo_file(photo_id):
+    """Serve the uploaded file itself, streamed from disk with conditional GET support"""
+    photo = media_photo(photo_id)
     
-    photo = next((p for p in uploaded_photos if p['id'] == photo_id), None)
+    if not photo or not os.path.exists(photo.filepath):
+        return jsonify({'error': 'Photo not found'}), 404
     
-    if not photo:
+    response = send_file(photo.filepath, download_name=photo.filename, conditional=True, max_age=3600)
+    # Only the session's own browser may cache it, never a shared proxy
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@app.route('/photos/<photo_id>/renditions/<name>', methods=['GET'])
+def get_photo_rendition(photo_id, name):
+    """Serve a small, medium or full rendition with long-lived caching and ETag revalidation"""
+    if name not in RENDITION_SIZES:
+        return jsonify({'error': f'Unknown rendition: {name}'}), 404
+    
+    photo = media_photo(photo_id)
+    
+    if not photo or not os.path.exists(photo.filepath):
         return jsonify({'error': 'Photo not found'}), 404
     
     try:
-        # Remove file from disk
-        if os.path.exists(photo['filepath']):
-            os.remove(photo['filepath'])
-        
-        # Remove from uploaded_photos list
-        uploaded_photos = [p for p in uploaded_photos if p['id'] != photo_id]
+        path = renditions.get(photo, name)
+    except Exception as e:
+        return jsonify({'error': f'Failed to create rendition: {str(e)}'}), 500
+    
+    response = send_file(path, conditional=True, etag=True, max_age=RENDITION_MAX_AGE)
+    response.cache_control.immutable = True
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@app.route('/photos/<photo_id>', methods=['DELETE'])
+def delete_photo(photo_id):
+    workspace = current_workspace(create=False)
+    if workspace is None or workspace.photos.get(photo_id) is None:
+        return jsonify({'error': 'Photo not found'}), 404
+    
+    try:
+        # Copies left behind stand in for the deleted photo; the file goes once no other upload shares it
+        photo = sessions.remove_photo(workspace, photo_id)
+        if not photo:
+            return jsonify({'error': 'Photo not found'}), 404
+        renditions.remove(photo.id)
+        unembeddable.discard(photo.id)
+        if classifier is not None and classifier.store is not None:
+            with classifier_lock:
+                classifier.store.delete([photo.id])
+                classifier.store.flush()
         
         return jsonify({'message': 'Photo deleted successfully'})
         
@@ -271,7 +700,46 @@ def delete_photo(photo_id):
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'healthy', 'photoCount': len(uploaded_photos)})
+    return jsonify({'status': 'healthy', 'photoCount': sessions.loaded_photos(), 'sessionCount': len(sessions)})
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def start_session_eviction():
+    """Drop sessions idle past PHOTORANK_SESSION_TTL in the background; the thread starts with the worker's first request"""
+    sessions.start_eviction()
+
+@app.after_request
+def remember_session(response):
+    """Hand the session id back as a cookie and a header so the client keeps using its workspace"""
+    workspace = g.get('workspace')
+    if workspace is not None:
+        response.headers[SESSION_HEADER] = workspace.id
+        secure = SECURE_COOKIES or request.is_secure
+        response.set_cookie(SESSION_COOKIE, workspace.id, max_age=sessions.ttl, httponly=True,
+                            secure=secure, samesite='None' if secure else 'Lax')
+    return response
+
+@app.teardown_request
+def discard_spooled_uploads(exc):
+    """Remove multipart parts the request streamed to disk but never moved into place"""
+    request.discard_spooled()
+
+@app.after_request
+def record_request_metrics(response):
+    """Count every request and time it by endpoint"""
+    if metrics.ENABLED and 'request_started' in g:
+        endpoint = request.endpoint or 'unmatched'
+        metrics.HTTP_REQUESTS.inc(1, endpoint, request.method, response.status_code)
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - g.request_started, endpoint)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint for this process"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
 @app.after_request
 def after_request(response):
@@ -285,22 +753,90 @@ def after_request(response):
     if origin in allowed_origins:
         response.headers.add('Access-Control-Allow-Origin', origin)
     
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,Upload-Offset,X-Photorank-Session')
+    response.headers.add('Access-Control-Expose-Headers', 'Location,Upload-Offset,Upload-Length,X-Photorank-Session')
+    response.headers.add('Access-Control-Allow-Methods', 'GET,HEAD,PUT,POST,PATCH,DELETE,OPTIONS')
     response.headers.add('Access-Control-Allow-Credentials', 'true')
     return response
 
+def session_job(job_id=None):
+    """
+    (job, state) of a job the requesting session submitted, its latest
+    without job_id: the Job when it runs in this worker, else the state
+    another worker saved to the session backend; (None, None) if unknown.
+    """
+    workspace = current_workspace(create=False)
+    if workspace is None:
+        return None, None
+    state = sessions.load_job(workspace.id, job_id)
+    if state is not None:
+        job_id = state['jobId']
+    elif job_id is None:
+        job = job_queue.latest(owner=workspace.id)
+        return (job, None) if job is not None else (None, None)
+    job = job_queue.get(job_id, owner=workspace.id)
+    return (job, None) if job is not None else (None, state)
+
 @app.route('/status', methods=['GET'])
 def get_processing_status():
-    global processing_status
-    return jsonify(processing_status)
+    """Status of the most recent processing job"""
+    job, state = session_job()
+    if job is None and state is None:
+        return jsonify({"status": "idle", "message": "Ready to process photos"})
+    return jsonify(job.to_dict() if job is not None else state)
+
+@app.route('/status/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    job, state = session_job(job_id)
+    if job is None and state is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict() if job is not None else state)
+
+@app.route('/status/<job_id>/stream', methods=['GET'])
+def stream_job_status(job_id):
+    """Push job progress as server-sent events until the job finishes"""
+    job, state = session_job(job_id)
+    if job is None and state is None:
+        return jsonify({'error': 'Job not found'}), 404
+    session_id = current_workspace(create=False).id
+
+    def poll():
+        # The job runs in another worker, which saves its state at most every PUBLISH_INTERVAL
+        current, version, quiet = state, None, 0
+        while current is not None:
+            if current['version'] != version:
+                version, quiet = current['version'], 0
+                yield sse_event(current)
+                if current['status'] in FINISHED_STATES:
+                    return
+            elif quiet >= SSE_KEEPALIVE_SECONDS:
+                quiet = 0
+                yield ": keep-alive\n\n"
+            time.sleep(SSE_POLL_SECONDS)
+            quiet += SSE_POLL_SECONDS
+            current = sessions.load_job(session_id, job_id)
+
+    def events():
+        version = None
+        while True:
+            current = job.wait_for_change(version, timeout=SSE_KEEPALIVE_SECONDS)
+            if current == version:
+                yield ": keep-alive\n\n"
+                continue
+            version = current
+            yield job.to_sse()
+            if job.finished_running:
+                return
+
+    return Response(stream_with_context(events() if job is not None else poll()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/test', methods=['GET'])
 def test_endpoint():
     """Simple test endpoint to verify backend is working"""
     return jsonify({
         'message': 'Backend is working',
-        'photoCount': len(uploaded_photos),
+        'photoCount': len(session_photos() or ()),
         'timestamp': str(datetime.now())
     })
 
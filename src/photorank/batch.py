@@ -0,0 +1,395 @@
+"""
+Batch clustering and ranking of whole photo libraries, without prompts.
+
+Walks directory trees for photos and hands them out in chunks to a pool
+of worker processes. Each worker loads its own copy of the models and
+runs with a pinned slice of the CPU threads. Per-photo quality scores
+stream to JSONL or Parquet as chunks finish, and a checkpoint manifest
+records every chunk written, so an interrupted run picks up where it
+stopped with --resume; photos that failed are tried again then. Once
+every photo is embedded, the features are clustered in one pass and the
+ranked clusters written to clusters.jsonl.
+
+Output directory layout:
+    manifest.jsonl          run settings, then one line per finished chunk
+    photos.jsonl            one record per scored photo (or photos/part-*.parquet)
+    failures.jsonl          photos that could not be decoded or embedded
+    features/chunk-*.npz    feature vectors, scores and paths per chunk
+    clusters.jsonl          one line per cluster, best photo first
+
+Usage:
+    photorank-batch /archive/2019 /archive/2020 --output runs/archive --workers 4
+    photorank-batch /archive --output runs/archive --resume --format parquet
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from .embed_score import rank_clusters_by_score
+from .inference import BACKENDS, EAGER
+from .neighbor_index import AUTO, INDEX_KINDS, dbscan_labels
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.heic')
+CLASSIFIERS = ('full', 'lite')
+JSONL = 'jsonl'
+PARQUET = 'parquet'
+OUTPUT_FORMATS = (JSONL, PARQUET)
+MANIFEST_VERSION = 2
+# Settings a resumed run must share with the run it continues
+RESUME_SETTINGS = ('classifier', 'backend', 'format', 'roots')
+# Chunks each worker may have queued or in progress at once
+CHUNKS_PER_WORKER = 2
+
+# Worker process state, set by _init_worker
+_classifier = None
+
+
+def walk_images(roots):
+    """Image paths under each root, recursively, in a stable sorted order"""
+    for root in roots:
+        if os.path.isfile(root):
+            yield os.path.abspath(root)
+            continue
+        for directory, subdirectories, filenames in os.walk(root):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.abspath(os.path.join(directory, filename))
+
+
+def chunked(paths, size):
+    chunk = []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def worker_cpus(worker, threads):
+    """The CPUs worker number `worker` is pinned to, or None where affinity is not supported"""
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    start = (worker * threads) % len(cpus)
+    # Wrap around, so the last workers are not left with fewer CPUs than threads
+    return {cpus[(start + n) % len(cpus)] for n in range(min(threads, len(cpus)))}
+
+
+def _init_worker(counter, threads, classifier_name, backend, batch_size):
+    """Pin this worker to its own CPUs and thread count, then load one copy of the models"""
+    global _classifier
+    import torch
+
+    with counter.get_lock():
+        worker = counter.value
+        counter.value += 1
+    cpus = worker_cpus(worker, threads)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    if classifier_name == 'lite':
+        from .photo_classifier_lite import PhotoClassifierLite
+        _classifier = PhotoClassifierLite(batch_size=batch_size, prefetch_workers=0, backend=backend)
+    else:
+        from .photo_classifier import PhotoClassifier
+        _classifier = PhotoClassifier(batch_size=batch_size, prefetch_workers=0, backend=backend)
+    _classifier.warm_up()
+
+
+def _process_chunk(chunk_id, paths):
+    """Embed and score one chunk in a worker; returns its records and the paths that failed"""
+    result = _classifier.embed_and_score(paths)
+    kept = set(result.kept)
+    records = []
+    for pos, idx in enumerate(result.kept):
+        records.append({
+            'path': paths[idx],
+            'confidence': float(result.confidence[pos]),
+            'sharpness': float(result.sharpness[pos]),
+            'score': float(result.scores[pos]),
+        })
+    failed = [path for idx, path in enumerate(paths) if idx not in kept]
+    return chunk_id, records, failed, result.features.astype(np.float32, copy=False)
+
+
+class RecordWriter:
+    """
+    Appends per-photo records: to photos.jsonl, whose length after each
+    chunk goes in the manifest so a resumed run can cut off a torn tail,
+    or as one Parquet part file per chunk (needs pyarrow).
+    """
+    def __init__(self, output_dir, fmt):
+        self.format = fmt
+        if fmt == PARQUET:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow)")
+            self._pa, self._pq = pyarrow, pyarrow.parquet
+            self.directory = os.path.join(output_dir, 'photos')
+            os.makedirs(self.directory, exist_ok=True)
+        else:
+            self.path = os.path.join(output_dir, 'photos.jsonl')
+            self._file = open(self.path, 'ab')
+
+    def truncate(self, offset):
+        """Drop JSONL records written after the last checkpoint"""
+        if self.format == JSONL:
+            self._file.truncate(offset)
+            self._file.seek(offset)
+
+    def write(self, chunk_id, records):
+        """Write and flush a chunk's records; returns the JSONL offset after them, or None"""
+        if self.format == PARQUET:
+            if not records:
+                return None
+            columns = {key: [record.get(key) for record in records]
+                       for key in ('path', 'confidence', 'sharpness', 'score')}
+            table = self._pa.table(columns)
+            path = os.path.join(self.directory, f"part-{chunk_id:06d}.parquet")
+            self._pq.write_table(table, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            return None
+        self._file.write(b''.join(json.dumps(record).encode() + b'\n' for record in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        if self.format == JSONL:
+            self._file.close()
+
+
+class Manifest:
+    """
+    Checkpoint log: the run's settings on the first line, then one line
+    per finished chunk with the paths it scored and the paths that
+    failed. A chunk counts as done only once its line is written, after
+    its records and features are on disk; its failed paths never do.
+    """
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, 'manifest.jsonl')
+        self.settings = None
+        self.chunks = []
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break  # A line torn by the interruption; its chunk is redone
+        self.settings, self.chunks = entries[0], entries[1:]
+        if len(entries) < len(lines):
+            # Drop the torn tail so new entries are not appended after it
+            with open(self.path, 'w') as f:
+                f.writelines(json.dumps(entry) + '\n' for entry in entries)
+
+    def mismatches(self, settings):
+        """Names of the settings in which a resumed run differs from the recorded one"""
+        if self.settings.get('version') != MANIFEST_VERSION:
+            return ['version']
+        return [key for key in RESUME_SETTINGS if self.settings.get(key) != settings[key]]
+
+    def start(self, settings):
+        self.settings = dict(settings, version=MANIFEST_VERSION)
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(self.settings) + '\n')
+
+    def record(self, entry):
+        self.chunks.append(entry)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def discard_unrecorded(self, output_dir):
+        """Remove feature and Parquet files of chunks that finished after the last checkpoint"""
+        recorded = {f"{chunk['chunk']:06d}" for chunk in self.chunks}
+        for directory, prefix in (('features', 'chunk-'), ('photos', 'part-')):
+            directory = os.path.join(output_dir, directory)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.startswith(prefix) and name[len(prefix):len(prefix) + 6] not in recorded:
+                    os.remove(os.path.join(directory, name))
+
+    def done_paths(self):
+        return {path for chunk in self.chunks for path in chunk['paths']}
+
+    def failed_paths(self):
+        """Paths that failed in their latest attempt, in the order they failed"""
+        failed = {}
+        for chunk in self.chunks:
+            for path in chunk['paths']:
+                failed.pop(path, None)
+            failed.update(dict.fromkeys(chunk.get('failed', ())))
+        return list(failed)
+
+    def last_offset(self):
+        offsets = [chunk['offset'] for chunk in self.chunks if chunk.get('offset') is not None]
+        return offsets[-1] if offsets else 0
+
+
+def cluster_features(output_dir, manifest, eps, min_samples, neighbor_index):
+    """DBSCAN over every checkpointed chunk's features; writes clusters.jsonl and returns the cluster count"""
+    features, paths, scores = [], [], []
+    for chunk in manifest.chunks:
+        with np.load(os.path.join(output_dir, chunk['features'])) as data:
+            if len(data['paths']):
+                features.append(data['features'])
+                paths.extend(data['paths'].tolist())
+                scores.extend(data['scores'].tolist())
+    if not features:
+        return 0
+    labels = dbscan_labels(np.concatenate(features), eps, min_samples, kind=neighbor_index)
+    ranked_clusters = rank_clusters_by_score(labels, paths, scores)
+    with open(os.path.join(output_dir, 'clusters.jsonl'), 'w') as f:
+        for cluster_id, ranked in sorted(ranked_clusters.items()):
+            f.write(json.dumps({
+                'cluster': cluster_id,
+                'photos': [{'path': path, 'score': score} for path, score in ranked],
+                'recommended': ranked[0][0] if cluster_id != -1 else None,
+            }) + '\n')
+    return len([label for label in ranked_clusters if label != -1])
+
+
+def write_failures(output_dir, manifest):
+    """Rewrite failures.jsonl from the manifest; returns how many photos are in it"""
+    failed = manifest.failed_paths()
+    path = os.path.join(output_dir, 'failures.jsonl')
+    with open(path + '.tmp', 'w') as f:
+        f.writelines(json.dumps({'path': photo, 'error': 'Could not be decoded or embedded'}) + '\n'
+                     for photo in failed)
+    os.replace(path + '.tmp', path)
+    return len(failed)
+
+
+def run(args):
+    os.makedirs(os.path.join(args.output, 'features'), exist_ok=True)
+    settings = {
+        'classifier': args.classifier,
+        'backend': args.backend,
+        'format': args.format,
+        'roots': [os.path.abspath(root) for root in args.roots],
+    }
+    manifest = Manifest(args.output)
+    if manifest.exists():
+        if not args.resume:
+            raise SystemExit(f"{manifest.path} exists; pass --resume to continue that run")
+        manifest.load()
+        mismatches = manifest.mismatches(settings)
+        if mismatches:
+            raise SystemExit(f"The run in {args.output} differs in {', '.join(mismatches)}; "
+                             "resume it with the same roots and options, or pick a new --output")
+        manifest.discard_unrecorded(args.output)
+    else:
+        manifest.start(settings)
+
+    writer = RecordWriter(args.output, args.format)
+    writer.truncate(manifest.last_offset())
+    done = manifest.done_paths()
+    next_chunk = max((chunk['chunk'] for chunk in manifest.chunks), default=-1) + 1
+    pending_paths = (path for path in walk_images(args.roots) if path not in done)
+    chunks = ((next_chunk + n, chunk) for n, chunk in enumerate(chunked(pending_paths, args.chunk_size)))
+    retried = len(manifest.failed_paths())
+    print(f"Resuming after {len(done)} photos, retrying {retried} that failed" if manifest.chunks
+          else "Starting a new run", file=sys.stderr)
+
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    counter = context.Value('i', 0)
+    started = time.perf_counter()
+    photos = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(counter, args.threads, args.classifier, args.backend,
+                                           args.batch_size)) as executor:
+            in_flight = set()
+            exhausted = False
+            while in_flight or not exhausted:
+                # Keep a bounded number of chunks queued so the walk stays lazy
+                while not exhausted and len(in_flight) < args.workers * CHUNKS_PER_WORKER:
+                    try:
+                        chunk_id, paths = next(chunks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    in_flight.add(executor.submit(_process_chunk, chunk_id, paths))
+                if not in_flight:
+                    break
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    chunk_id, records, failed, features = future.result()
+                    features_path = os.path.join('features', f"chunk-{chunk_id:06d}.npz")
+                    np.savez(os.path.join(args.output, features_path), features=features,
+                             paths=np.array([r['path'] for r in records], dtype=str),
+                             scores=np.array([r['score'] for r in records]))
+                    offset = writer.write(chunk_id, records)
+                    manifest.record({'chunk': chunk_id, 'paths': [r['path'] for r in records],
+                                     'failed': failed, 'features': features_path, 'offset': offset})
+                    photos += len(records) + len(failed)
+                    elapsed = time.perf_counter() - started
+                    print(f"chunk {chunk_id}: {photos} photos, {photos / elapsed:.1f}/s", file=sys.stderr)
+    finally:
+        writer.close()
+        failures = write_failures(args.output, manifest)
+    if failures:
+        print(f"{failures} photos failed; see failures.jsonl, --resume tries them again", file=sys.stderr)
+
+    if not args.no_cluster:
+        clusters = cluster_features(args.output, manifest, args.eps, args.min_samples, args.neighbor_index)
+        print(f"{clusters} clusters written to {os.path.join(args.output, 'clusters.jsonl')}", file=sys.stderr)
+
+
+def default_workers():
+    return max(1, (os.cpu_count() or 1) // 2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='photorank-batch', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('roots', nargs='+', help='directories (searched recursively) or image files')
+    parser.add_argument('--output', required=True, help='directory for results and the checkpoint manifest')
+    parser.add_argument('--resume', action='store_true', help='continue the run checkpointed in --output')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default=JSONL, help='per-photo record format')
+    parser.add_argument('--workers', type=int, default=default_workers(), help='worker processes')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads per worker (default: CPUs divided among the workers)')
+    parser.add_argument('--classifier', choices=CLASSIFIERS, default='full')
+    parser.add_argument('--backend', choices=BACKENDS, default=EAGER)
+    parser.add_argument('--chunk-size', type=int, default=64, help='photos per task handed to a worker')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--eps', type=float, default=0.3)
+    parser.add_argument('--min-samples', type=int, default=2)
+    parser.add_argument('--neighbor-index', choices=INDEX_KINDS, default=AUTO)
+    parser.add_argument('--no-cluster', action='store_true', help='only embed and score, skip clustering')
+    args = parser.parse_args(argv)
+    missing = [root for root in args.roots if not os.path.exists(root)]
+    if missing:
+        parser.error(f"No such file or directory: {', '.join(missing)}")
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+    try:
+        run(args)
+    except RuntimeError as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
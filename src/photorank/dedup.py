@@ -0,0 +1,192 @@
+"""
+Duplicate detection at ingest, before any model sees a photo.
+
+Exact duplicates are found by the SHA-256 of the file's bytes, computed
+while the upload streams to disk; identical content is stored once and
+reference counted. Near duplicates (re-encoded, resized or lightly edited
+copies) are found by a 64-bit difference hash compared by Hamming
+distance, and flagged so only distinct photos are embedded for
+clustering; near duplicates still get their own quality score, so burst
+frames and edits are ranked against each other.
+"""
+import hashlib
+import os
+import threading
+
+from .image_io import load_reduced
+from .perceptual import HASH_DECODE_SIDE, HammingIndex, dhash_batch, thumbnails
+
+# Largest Hamming distance between difference hashes that counts as a near duplicate
+DEFAULT_NEAR_DUPLICATE_DISTANCE = 3
+
+
+def default_near_duplicate_distance():
+    return int(os.environ.get('PHOTORANK_NEAR_DUPLICATE_DISTANCE', DEFAULT_NEAR_DUPLICATE_DISTANCE))
+
+
+class HashingFile:
+    """Writable file wrapper that feeds every byte written through SHA-256"""
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def perceptual_hash(path):
+    """Difference hash of an image file, decoded at a small fraction of its resolution"""
+    small, _ = thumbnails(load_reduced(path, HASH_DECODE_SIDE))
+    return int(dhash_batch(small[None])[0])
+
+
+class DuplicateIndex:
+    """
+    Content hashes of stored files with their reference counts, and the
+    perceptual hashes of distinct photos. Exact duplicates share the first
+    copy's file and point at the first photo; near duplicates point at the
+    distinct photo they resemble. Both are left out of feature extraction;
+    exact duplicates share their original's quality score too.
+    """
+    def __init__(self, max_distance=None):
+        self.max_distance = default_near_duplicate_distance() if max_distance is None else max_distance
+        self._files = {}  # content hash -> [filepath, references, photo id of the first copy]
+        self._distinct = HammingIndex()  # photo id -> perceptual hash
+        self._copies = {}  # photo id -> {id: None} of the photos flagged as its copies
+        self._lock = threading.Lock()
+
+    def store(self, record):
+        """
+        Register an upload's content. If the same bytes are already stored,
+        the new copy is removed, the record is pointed at the stored file
+        and flagged as a duplicate of the first photo.
+        """
+        with self._lock:
+            entry = self._files.get(record.content_hash)
+            if entry is None:
+                self._files[record.content_hash] = [record.filepath, 1, record.id]
+                return record
+            entry[1] += 1
+            self._copies.setdefault(entry[2], {})[record.id] = None
+        if record.filepath != entry[0]:
+            os.remove(record.filepath)
+        record.filepath = entry[0]
+        record.duplicate_of = entry[2]
+        return record
+
+    def holds(self, content_hash):
+        """Whether these bytes are already stored, so another copy would take no space"""
+        with self._lock:
+            return content_hash in self._files
+
+    def restore(self, record):
+        """
+        Re-register a photo that was stored and flagged earlier, e.g. one
+        loaded back from a session backend. Records must come in upload
+        order so each content hash's first copy comes first.
+        """
+        with self._lock:
+            entry = self._files.get(record.content_hash)
+            if entry is None:
+                self._files[record.content_hash] = [record.filepath, 1, record.id]
+            else:
+                entry[1] += 1
+            if record.duplicate_of is not None:
+                self._copies.setdefault(record.duplicate_of, {})[record.id] = None
+            elif record.perceptual_hash is not None:
+                self._distinct.add(record.id, record.perceptual_hash)
+
+    def release(self, record):
+        """Drop a photo; return True when it held the last reference to its file"""
+        with self._lock:
+            self._distinct.remove(record.id)
+            self._copies.get(record.duplicate_of, {}).pop(record.id, None)
+            entry = self._files.get(record.content_hash)
+            if entry is None:
+                return True
+            entry[1] -= 1
+            if entry[1] > 0:
+                return False
+            del self._files[record.content_hash]
+            return True
+
+    def flag(self, record):
+        """
+        Give a photo its perceptual hash and flag it if it nearly matches a
+        distinct photo; otherwise it becomes one. Returns the record's
+        duplicate_of.
+        """
+        if record.duplicate_of is not None:
+            return record.duplicate_of  # Exact copies were flagged when stored
+        if record.perceptual_hash is None:
+            record.perceptual_hash = perceptual_hash(record.filepath)
+        with self._lock:
+            match = self._distinct.nearest(record.perceptual_hash, self.max_distance, exclude=record.id)
+            if match is not None:
+                record.duplicate_of = match
+                self._copies.setdefault(match, {})[record.id] = None
+                return match
+            self._distinct.add(record.id, record.perceptual_hash)
+        return None
+
+    def reassign(self, removed, lookup):
+        """
+        After `removed` is deleted, promote the earliest of its copies to
+        stand in for it and point the others at that one. `lookup` finds a
+        registered record by id. Exact copies were never hashed, so a
+        promoted one gets its perceptual hash here and is matched against
+        from then on.
+        """
+        with self._lock:
+            copies = [lookup(photo_id) for photo_id in self._copies.pop(removed.id, {})]
+            copies = [record for record in copies if record is not None]
+            if not copies:
+                return None
+            successor = copies[0]
+            successor.duplicate_of = None
+            for entry in self._files.values():
+                if entry[2] == removed.id:
+                    entry[2] = successor.id
+            for record in copies[1:]:
+                record.duplicate_of = successor.id
+            if len(copies) > 1:
+                self._copies.setdefault(successor.id, {}).update(dict.fromkeys(r.id for r in copies[1:]))
+        if successor.perceptual_hash is None:
+            if successor.content_hash == removed.content_hash and removed.perceptual_hash is not None:
+                successor.perceptual_hash = removed.perceptual_hash
+            else:
+                try:
+                    successor.perceptual_hash = perceptual_hash(successor.filepath)
+                except OSError:
+                    return successor  # Unreadable; it simply isn't matched against
+        with self._lock:
+            self._distinct.add(successor.id, successor.perceptual_hash)
+        return successor
+
+    def partition(self, records):
+        """
+        Split photos into the distinct ones to run through the models and a
+        mapping of distinct photo id -> its duplicates in `records`. A
+        duplicate whose original is not among `records` counts as distinct.
+        """
+        by_id = {record.id: record for record in records}
+        distinct, duplicates = [], {}
+        for record in records:
+            original = record
+            seen = {record.id}
+            # An exact copy of a near duplicate belongs to the photo that one resembles
+            while original.duplicate_of in by_id and original.duplicate_of not in seen:
+                original = by_id[original.duplicate_of]
+                seen.add(original.id)
+            if original is record:
+                distinct.append(record)
+            else:
+                duplicates.setdefault(original.id, []).append(record)
+        return distinct, duplicates
@@ -0,0 +1,269 @@
+import logging
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from .image_io import load_model_input
+from .metrics import CACHE_LOOKUPS, increment, log_event, timed
+from .prefetch import PROCESS, PrefetchPool
+from .sharpness import GLOBAL, MIDPOINTS, grayscale_proxy
+
+# One backbone produces both the pooled features and the logits
+SHARED_BACKBONE = 'shared_backbone'
+# Separate feature and quality models fed from the same preprocessed tensor
+SHARED_INPUT = 'shared_input'
+ENGINE_MODES = (SHARED_BACKBONE, SHARED_INPUT)
+# Bump when decoding, preprocessing or scoring changes so cached embeddings and scores are recomputed
+PREPROCESS_VERSION = 5
+
+
+def combine_quality_score(confidence, sharpness, midpoint=MIDPOINTS[GLOBAL]):
+    """
+    Combine a 0-1 model confidence with raw proxy Laplacian sharpness into
+    a 0-10 score; `midpoint` is the scorer's (SharpnessScorer.midpoint).
+    """
+    # Sharper always scores higher: the normalized value approaches 1 but never reaches it
+    normalized_sharpness = sharpness / (sharpness + midpoint)
+    # 70% neural network confidence, 30% sharpness
+    return (0.7 * confidence + 0.3 * normalized_sharpness) * 10
+
+
+def rank_clusters_by_score(labels, keys, scores):
+    """Group keys by cluster label and sort each cluster by descending score"""
+    ranked_clusters = {}
+    for label, key, score in zip(labels, keys, scores):
+        ranked_clusters.setdefault(int(label), []).append((key, float(score)))
+    for ranked_images in ranked_clusters.values():
+        ranked_images.sort(key=lambda x: x[1], reverse=True)
+    return ranked_clusters
+
+
+class EmbedScoreResult:
+    """Per-image outputs of one EmbedScoreEngine run, aligned with `kept`"""
+    __slots__ = ('features', 'confidence', 'sharpness', 'scores', 'kept')
+
+    def __init__(self, features, confidence, sharpness, scores, kept):
+        self.features = features
+        self.confidence = confidence
+        self.sharpness = sharpness
+        self.scores = scores
+        self.kept = kept
+
+
+class ImagePreparer:
+    """
+    Decode one (index, image) item into its model tensor and, when
+    proxy_size is set, the grayscale proxy sharpness is scored from.
+
+    Runs on prefetch workers, so it returns (index, tensor, proxy, error)
+    instead of raising. Picklable as long as the transform is, which lets
+    it run in worker processes too.
+    """
+    def __init__(self, transform, proxy_size=None):
+        self.transform = transform
+        self.proxy_size = proxy_size
+
+    def __call__(self, item):
+        idx, source = item
+        try:
+            with timed('decode'):
+                img = load_model_input(source)
+            with timed('preprocess'):
+                tensor = self.transform(img)
+                proxy = grayscale_proxy(img, self.proxy_size) if self.proxy_size else None
+            return idx, tensor, proxy, None
+        except Exception as e:
+            return idx, None, None, str(e)
+
+
+def known_length(items):
+    """len(items) for sequences, None for iterators whose length is only known once consumed"""
+    return len(items) if hasattr(items, '__len__') else None
+
+
+def _portable_source(source):
+    """Send a process worker the path of an image opened from disk rather than its pickled pixels"""
+    return getattr(source, 'filename', None) or source
+
+
+class EmbedScoreEngine:
+    """
+    Preprocesses every image once and derives the clustering feature vector
+    and the quality score from the same tensor.
+
+    `forward(batch)` runs the model(s) on a (B, 3, 224, 224) tensor and
+    returns a (B, D) feature tensor plus a (B,) 0-1 confidence tensor, or
+    None for the confidence when only features are wanted.
+
+    Decoding and preprocessing run on a PrefetchPool, overlapping with
+    the forward passes; without a pool they run inline. `sharpness` is a
+    SharpnessScorer that scores each batch's grayscale proxies together.
+    """
+    def __init__(self, transform, forward, sharpness, device, batch_size=32, pool=None):
+        self.transform = transform
+        self.forward = forward
+        self.sharpness = sharpness
+        self.device = device
+        self.batch_size = batch_size
+        self.pool = pool or PrefetchPool(workers=0)
+
+    def _run_forward(self, tensors):
+        batch = torch.stack(tensors).to(self.device)
+        with torch.no_grad(), timed('inference', len(tensors)):
+            features, confidence = self.forward(batch)
+        features = features.reshape(features.size(0), -1).cpu().numpy()
+        if confidence is not None:
+            confidence = confidence.cpu().numpy()
+        return features, confidence
+
+    def _forward_batch(self, indices, tensors, batch_sharpness):
+        """Forward one batch, returning (indices, features, confidence, sharpness) groups that succeeded"""
+        try:
+            batch_features, batch_confidence = self._run_forward(tensors)
+            return [(indices, batch_features, batch_confidence, batch_sharpness)]
+        except Exception as e:
+            # Fall back to one image at a time so a single bad input
+            # only costs its own slot
+            log_event('batch_forward_failed', logging.WARNING, images=len(indices), error=str(e))
+        results = []
+        for pos, idx in enumerate(indices):
+            try:
+                single_features, single_confidence = self._run_forward([tensors[pos]])
+            except Exception as single_error:
+                log_event('forward_failed', logging.WARNING, image=idx, error=str(single_error))
+                continue
+            results.append(([idx], single_features, single_confidence, batch_sharpness[pos:pos + 1]))
+        return results
+
+    def process(self, images, score=True, progress=None):
+        """Run PIL images or image paths, from a list or any iterable, through the engine
+
+        Images are pulled from `images` only as the prefetch pool has room
+        for them, so an iterator of lazily loaded images keeps no more than
+        a few batches decoded at once. Images that fail to decode or
+        preprocess are dropped; the returned arrays only cover the input
+        indices listed in `kept`. `progress`, if given, is called as
+        progress(images_done, images_total) after every batch; the total is
+        None for an iterator until it runs out.
+        """
+        features = []
+        confidence = []
+        sharpness = []
+        kept = []
+
+        total = known_length(images)
+        preparer = ImagePreparer(self.transform, self.sharpness.size if score else None)
+        items = enumerate(images)
+        if self.pool.kind == PROCESS and self.pool.workers:
+            items = ((idx, _portable_source(img)) for idx, img in items)
+
+        def flush(indices, tensors, proxies, done):
+            batch_sharpness = []
+            if score:
+                with timed('sharpness', len(proxies)):
+                    batch_sharpness = self.sharpness.score(proxies)
+            for result_indices, result_features, result_confidence, result_sharpness in \
+                    self._forward_batch(indices, tensors, batch_sharpness):
+                features.append(result_features)
+                kept.extend(result_indices)
+                if score:
+                    confidence.append(result_confidence)
+                    sharpness.extend(result_sharpness)
+            if progress is not None:
+                progress(done, total)
+
+        tensors = []
+        indices = []
+        proxies = []
+        done = 0
+        with tqdm(total=total, desc="Extracting features") as bar:
+            for idx, tensor, proxy, error in self.pool.map(preparer, items):
+                done += 1
+                bar.update(1)
+                if error is not None:
+                    log_event('preprocess_failed', logging.WARNING, image=idx, error=error)
+                else:
+                    tensors.append(tensor)
+                    indices.append(idx)
+                    proxies.append(proxy)
+                if len(tensors) == self.batch_size:
+                    flush(indices, tensors, proxies, done)
+                    tensors, indices, proxies = [], [], []
+            total = done
+            if tensors:
+                flush(indices, tensors, proxies, done)
+            elif progress is not None and done:
+                progress(done, total)
+
+        if not features:
+            empty = np.empty(0, dtype=np.float32)
+            return EmbedScoreResult(np.empty((0, 0), dtype=np.float32), empty, empty, empty, [])
+
+        features = np.concatenate(features)
+        if not score:
+            return EmbedScoreResult(features, None, None, None, kept)
+
+        confidence = np.concatenate(confidence).astype(np.float64)
+        sharpness = np.asarray(sharpness, dtype=np.float64)
+        scores = np.array([combine_quality_score(c, s, self.sharpness.midpoint) for c, s in zip(confidence, sharpness)])
+        return EmbedScoreResult(features, confidence, sharpness, scores, kept)
+
+    def process_cached(self, images, cache, progress=None):
+        """Like process(), but only runs the models on images missing from an EmbeddingCache
+
+        Cache lookups happen as images stream past, so `images` may be any
+        iterable; only the cached rows and the indices of the misses are kept.
+        """
+        total = known_length(images)
+        keys = []
+        hits = {}
+        missing = []
+
+        def misses():
+            for idx, img in enumerate(images):
+                key = cache.key_for(img)
+                keys.append(key)
+                entry = cache.get(key) if key is not None else None
+                if entry is not None:
+                    hits[idx] = entry
+                else:
+                    missing.append(idx)
+                    yield img
+
+        # Cache hits count as already done
+        fresh_progress = None
+        if progress is not None:
+            def fresh_progress(done, fresh_total):
+                # An iterator's total is known once the engine has drained it
+                progress(len(hits) + done, total if total is not None or fresh_total is None else len(keys))
+        fresh = self.process(misses(), progress=fresh_progress)
+        if progress is not None and not missing:
+            progress(len(hits), total if total is not None else len(hits))
+        increment(CACHE_LOOKUPS, len(hits), 'hit')
+        increment(CACHE_LOOKUPS, len(missing), 'miss')
+        log_event('embedding_cache', hits=len(hits), missing=len(missing))
+
+        rows = hits
+        for pos, fresh_idx in enumerate(fresh.kept):
+            idx = missing[fresh_idx]
+            entry = (fresh.features[pos], fresh.confidence[pos], fresh.sharpness[pos], fresh.scores[pos])
+            rows[idx] = entry
+            if keys[idx] is not None:
+                cache.put(keys[idx], *entry)
+        cache.flush()
+
+        kept = sorted(rows)
+        if not kept:
+            return self.process([])
+        if cache.dim:
+            features = np.stack([rows[idx][0] for idx in kept])
+        else:
+            # Score-only caches hold no feature vectors
+            features = np.empty((len(kept), 0), dtype=np.float32)
+        return EmbedScoreResult(
+            features,
+            np.array([rows[idx][1] for idx in kept], dtype=np.float64),
+            np.array([rows[idx][2] for idx in kept], dtype=np.float64),
+            np.array([rows[idx][3] for idx in kept], dtype=np.float64),
+            kept,
+        )
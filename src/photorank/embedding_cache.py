@@ -0,0 +1,205 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no file locks, and no forking servers sharing a cache either
+    fcntl = None
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # Feature slab budget per model namespace
+SCORE_ONLY_MAX_ENTRIES = 200_000  # Entry limit for caches without feature vectors
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def default_cache_dir():
+    """Cache location on the persistent disk: PHOTORANK_CACHE_DIR, else under TORCH_HOME"""
+    cache_dir = os.environ.get('PHOTORANK_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    torch_home = os.environ.get('TORCH_HOME', os.path.join(os.path.expanduser('~'), '.cache', 'torch'))
+    return os.path.join(torch_home, 'photorank-cache')
+
+
+def claim_directory(root, namespace):
+    """
+    (directory, lock file) for this process under <root>/<namespace>:
+    the first worker-N directory whose lock no other process holds.
+    Gunicorn workers sharing a cache root each write their own files
+    instead of overwriting each other's slots and index, and a restarted
+    worker takes over the files its predecessor left. The claim lasts
+    until the lock file is closed; a process forked after claiming
+    shares it, so claim in the process that writes.
+    """
+    base = os.path.join(root, namespace)
+    if fcntl is None:
+        os.makedirs(base, exist_ok=True)
+        return base, None
+    for slot in itertools.count():
+        directory = os.path.join(base, f"worker-{slot}")
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, '.lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        return directory, lock
+
+
+def file_content_hash(path):
+    """SHA-256 of a file's bytes, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of feature vectors, sharpness and quality scores.
+
+    Entries live under <root>/<namespace>, where the namespace encodes the
+    model identity, so switching models never serves stale vectors, in a
+    directory this process claims (see claim_directory). Feature
+    rows are stored in one preallocated .npy slab that is memory-mapped on
+    load; the index of content hash -> slot and scalar scores is a JSON file
+    kept in least-recently-used order. When the slab is full the least
+    recently used entry gives up its slot. A dim of 0 caches scores only.
+    """
+    def __init__(self, root, namespace, dim, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory, self._claim = claim_directory(root, namespace)
+        self.dim = dim
+        if dim:
+            self.capacity = max(1, max_bytes // (dim * np.dtype(np.float32).itemsize))
+        else:
+            self.capacity = SCORE_ONLY_MAX_ENTRIES
+        self.entries = OrderedDict()  # content hash -> {'slot', 'confidence', 'sharpness', 'score'}
+        self.features = None
+        self._free_slots = []  # Released slots below _next_slot
+        self._next_slot = 0  # Slots from here up have never been used
+        self._hashes = {}  # (path, size, mtime) -> content hash
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._load()
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    @property
+    def _features_path(self):
+        return os.path.join(self.directory, 'features.npy')
+
+    def _load(self):
+        """Open the slab and index left by a previous process, discarding them if they don't match"""
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+            if index.get('dim') != self.dim:
+                raise ValueError("feature dimension changed")
+            if self.dim:
+                self.features = np.load(self._features_path, mmap_mode='r+')
+                if self.features.shape[1] != self.dim:
+                    raise ValueError("feature slab shape mismatch")
+            for key, entry in index['entries']:
+                self.entries[key] = entry
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Discarding embedding cache in {self.directory}: {str(e)}")
+            self.entries.clear()
+            self.features = None
+
+        if self.dim and self.features is None:
+            self.features = np.lib.format.open_memmap(
+                self._features_path, mode='w+', dtype=np.float32, shape=(self.capacity, self.dim))
+        if self.dim:
+            # An existing slab keeps the size it was created with
+            self.capacity = self.features.shape[0]
+
+        # Drop entries that no longer fit if the budget shrank
+        for key in [key for key, entry in self.entries.items() if entry['slot'] >= self.capacity]:
+            del self.entries[key]
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        used = {entry['slot'] for entry in self.entries.values()}
+        self._next_slot = max(used) + 1 if used else 0
+        self._free_slots = [slot for slot in range(self._next_slot - 1, -1, -1) if slot not in used]
+
+    def key_for(self, img):
+        """Content hash for an image path or a PIL image opened from disk, or None if it has no backing file"""
+        path = img if isinstance(img, (str, os.PathLike)) else getattr(img, 'filename', None)
+        if not path:
+            return None
+        try:
+            stat = os.stat(path)
+            stat_key = (path, stat.st_size, stat.st_mtime_ns)
+            if stat_key not in self._hashes:
+                self._hashes[stat_key] = file_content_hash(path)
+            return self._hashes[stat_key]
+        except OSError:
+            return None
+
+    def get(self, key):
+        """Return (features, confidence, sharpness, score) for a cached key, or None"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self._dirty = True
+            features = np.array(self.features[entry['slot']]) if self.dim else None
+            return features, entry['confidence'], entry['sharpness'], entry['score']
+
+    def put(self, key, features, confidence, sharpness, score):
+        """Store one entry, evicting the least recently used one if the cache is full"""
+        with self._lock:
+            if key in self.entries:
+                slot = self.entries.pop(key)['slot']
+            elif self._free_slots:
+                slot = self._free_slots.pop()
+            elif self._next_slot < self.capacity:
+                slot = self._next_slot
+                self._next_slot += 1
+            else:
+                _, evicted = self.entries.popitem(last=False)
+                slot = evicted['slot']
+            if self.dim:
+                self.features[slot] = features
+            self.entries[key] = {
+                'slot': slot,
+                'confidence': float(confidence),
+                'sharpness': float(sharpness),
+                'score': float(score),
+            }
+            self._dirty = True
+
+    def flush(self):
+        """Persist the slab and the index (including LRU order) to disk"""
+        with self._lock:
+            if not self._dirty:
+                return
+            if self.dim:
+                self.features.flush()
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'dim': self.dim, 'entries': list(self.entries.items())}, f)
+            os.replace(tmp_path, self._index_path)
+            self._dirty = False
+
+    def close(self):
+        """Flush and release the directory claim, so another instance can take these files over"""
+        self.flush()
+        if self._claim is not None:
+            self._claim.close()
+            self._claim = None
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,364 @@
+"""
+Persistent store of photo embeddings, one L2-normalized row per photo id.
+
+Rows live in a single contiguous .npy matrix that is memory-mapped, so
+similarity search reads them in place instead of stacking a fresh array
+every run. Rows are stored as float32, float16 (half the disk and page
+cache per photo) or int8 with a per-row scale (a quarter); get() decodes
+those two into float32 copies. New and replaced photos are appended;
+deleted ones leave a tombstone that is compacted away once tombstones
+outnumber live rows.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+import torch
+
+from .embedding_cache import claim_directory
+from .neighbor_index import normalize_rows
+
+FLOAT32 = 'float32'
+FLOAT16 = 'float16'
+# Symmetric per-row quantization: row = codes * scale
+INT8 = 'int8'
+STORE_DTYPES = (FLOAT32, FLOAT16, INT8)
+INITIAL_CAPACITY = 1024
+# Tombstones are compacted away once there are this many and they outnumber live rows
+COMPACT_MIN_TOMBSTONES = 256
+# Candidates per wanted neighbour re-scored exactly after the fast pass
+SHORTLIST_FACTOR = 4
+# int8 rows widened to float32 at a time by similarity search; small enough to stay in cache
+DECODE_BLOCK_ROWS = 128
+
+
+def default_store_dtype():
+    return os.environ.get('PHOTORANK_EMBEDDING_DTYPE', FLOAT32)
+
+
+def _encode(vectors, dtype):
+    """(stored rows, per-row scales or None) for L2-normalized float32 vectors"""
+    if dtype == INT8:
+        steps = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        codes = np.rint(vectors / steps[:, None]).astype(np.int8)
+        # Scaling to unit length rather than by the step undoes rounding's change of norm too
+        scales = 1.0 / np.maximum(np.linalg.norm(codes.astype(np.float32), axis=1), 1e-12)
+        return codes, scales.astype(np.float32)
+    return vectors.astype(dtype, copy=False), None
+
+
+class EmbeddingStore:
+    """
+    Embeddings keyed by photo id under <root>/<namespace>, where the
+    namespace names the model, in a directory this process claims, as for
+    EmbeddingCache.
+
+    vectors.npy holds `capacity` rows, of which the first `count` are
+    used; index.json maps each used row to its photo id (None for a
+    tombstone). Deletes since index.json was written are appended to
+    deleted.jsonl instead of rewriting it, and replayed on load. int8
+    stores keep their row scales in scales.npy. Call flush() to persist
+    appends and deletes.
+    """
+    def __init__(self, root, namespace, dim, dtype=None, capacity=INITIAL_CAPACITY):
+        dtype = dtype or default_store_dtype()
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"Unknown embedding dtype: {dtype}")
+        self.directory, self._claim = claim_directory(root, namespace)
+        self.dim = dim
+        self.dtype = dtype
+        self.vectors = None
+        self.scales = None
+        self.count = 0
+        self._row_ids = []  # row -> photo id, None for tombstones
+        self._rows = {}  # photo id -> row
+        self._live = np.zeros(0, dtype=bool)  # row -> not a tombstone, for vectorized scans
+        self._lock = threading.Lock()
+        self._dirty = False  # index.json is out of date beyond deletes
+        self._deleted = []  # Ids deleted since the last flush
+        self._logged = 0  # Ids in deleted.jsonl
+        self._generation = 0  # Of index.json; log entries of other generations are stale
+        self._load(capacity)
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    @property
+    def _log_path(self):
+        return os.path.join(self.directory, 'deleted.jsonl')
+
+    def _matrix_path(self, name):
+        return os.path.join(self.directory, f"{name}.npy")
+
+    def _load(self, capacity):
+        """Map the matrix and index a previous process left, discarding them if they don't match"""
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+            if (index.get('dim'), index.get('dtype')) != (self.dim, self.dtype):
+                raise ValueError("dimension or dtype changed")
+            self.vectors = np.load(self._matrix_path('vectors'), mmap_mode='r+')
+            if self.dtype == INT8:
+                self.scales = np.load(self._matrix_path('scales'), mmap_mode='r+')
+            self._row_ids = index['ids']
+            self.count = len(self._row_ids)
+            if self.count > len(self.vectors):
+                raise ValueError("index outgrew the matrix")
+            self._rows = {photo_id: row for row, photo_id in enumerate(self._row_ids) if photo_id is not None}
+            self._live = np.zeros(len(self.vectors), dtype=bool)
+            self._live[list(self._rows.values())] = True
+            self._generation = index.get('generation', 0)
+            self._replay_deletes()
+        except FileNotFoundError:
+            self.vectors = None
+        except Exception as e:
+            print(f"Discarding embedding store in {self.directory}: {str(e)}")
+            self.vectors = None
+        if self.vectors is None:
+            self._row_ids, self._rows, self.count = [], {}, 0
+            self._deleted, self._logged = [], 0
+            self.scales, self._live = None, np.zeros(0, dtype=bool)
+            self._allocate(capacity)
+
+    def _replay_deletes(self):
+        """Tombstone the ids deleted.jsonl logged against the loaded index"""
+        try:
+            with open(self._log_path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                generation, photo_id = json.loads(line)
+            except ValueError:
+                continue  # Torn last line of a crashed write
+            if generation == self._generation:
+                self._logged += 1
+                self._tombstone(photo_id)
+        self._deleted = []
+
+    def _allocate(self, capacity, keep=None):
+        """
+        Map fresh files of `capacity` rows holding the given rows of the
+        current matrix (every used row by default). Arrays handed out
+        earlier stay valid: they keep the replaced file mapped.
+        """
+        keep = np.arange(self.count) if keep is None else keep
+        matrices = [('vectors', self.vectors, (capacity, self.dim), self.dtype)]
+        if self.dtype == INT8:
+            matrices.append(('scales', self.scales, (capacity,), np.float32))
+        for name, old, shape, dtype in matrices:
+            path = self._matrix_path(name)
+            new = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=shape)
+            if old is not None and len(keep):
+                new[:len(keep)] = old[keep]
+            new.flush()
+            os.replace(path + '.tmp', path)
+            setattr(self, name, new)
+        live = np.zeros(capacity, dtype=bool)
+        live[:len(keep)] = self._live[keep] if len(self._live) else False
+        self._live = live
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, photo_id):
+        return photo_id in self._rows
+
+    def ids(self):
+        """Live photo ids in row order"""
+        with self._lock:
+            return [photo_id for photo_id in self._row_ids if photo_id is not None]
+
+    @property
+    def bytes_per_vector(self):
+        return self.dim * np.dtype(self.dtype).itemsize + (4 if self.dtype == INT8 else 0)
+
+    def _encode(self, ids, vectors):
+        vectors = normalize_rows(vectors)
+        if len(ids) != len(vectors) or vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {len(ids)} vectors of dimension {self.dim}")
+        return _encode(vectors, self.dtype)
+
+    def put(self, ids, vectors):
+        """Normalize and append vectors under photo ids; a stored id's old row becomes a tombstone"""
+        codes, scales = self._encode(ids, vectors)
+        with self._lock:
+            self._append(ids, codes, scales)
+
+    def update(self, ids, vectors):
+        """
+        Like put(), but only for the ids that are not stored yet or whose
+        stored rows differ from these vectors', so storing an unchanged
+        batch again appends nothing. Returns how many ids were written.
+        """
+        codes, scales = self._encode(ids, vectors)
+        with self._lock:
+            rows = np.fromiter((self._rows.get(photo_id, -1) for photo_id in ids), dtype=np.int64, count=len(ids))
+            changed = rows < 0
+            stored = np.flatnonzero(~changed)
+            if len(stored):
+                differs = np.any(self.vectors[rows[stored]] != codes[stored], axis=1)
+                if scales is not None:
+                    differs |= self.scales[rows[stored]] != scales[stored]
+                changed[stored] = differs
+            changed = np.flatnonzero(changed)
+            if len(changed):
+                self._append([ids[idx] for idx in changed.tolist()], codes[changed],
+                             None if scales is None else scales[changed])
+        return len(changed)
+
+    def _append(self, ids, codes, scales):
+        for photo_id in ids:
+            self._tombstone(photo_id)
+        start, end = self.count, self.count + len(ids)
+        if end > len(self.vectors):
+            self._allocate(max(end, 2 * len(self.vectors)))
+        self.vectors[start:end] = codes
+        if scales is not None:
+            self.scales[start:end] = scales
+        for row, photo_id in enumerate(ids, start):
+            self._rows[photo_id] = row
+        self._live[start:end] = True
+        self._row_ids.extend(ids)
+        self.count = end
+        self._dirty = True
+
+    def _tombstone(self, photo_id):
+        row = self._rows.pop(photo_id, None)
+        if row is not None:
+            self._row_ids[row] = None
+            self._live[row] = False
+            self._deleted.append(photo_id)
+
+    def delete(self, ids):
+        """Drop photo ids, ignoring ones that are not stored"""
+        with self._lock:
+            for photo_id in ids:
+                self._tombstone(photo_id)
+
+    def _decode(self, rows):
+        """float32 unit rows for stored rows, an array of indices or a slice"""
+        if self.dtype == FLOAT32:
+            return self.vectors[rows]
+        decoded = self.vectors[rows].astype(np.float32)
+        if self.dtype == INT8:
+            decoded *= self.scales[rows][:, None]
+        return decoded
+
+    def _similarities(self, query, count):
+        """Cosine similarity of a unit query to each of the first `count` rows, without decoding them all"""
+        if self.dtype == FLOAT32:
+            return self.vectors[:count] @ query
+        if self.dtype == FLOAT16:
+            # NumPy widens float16 one element at a time; torch's half kernels are vectorized
+            rows = torch.from_numpy(np.asarray(self.vectors[:count]))
+            return (rows @ torch.from_numpy(query).half()).float().numpy()
+        similarity = np.empty(count, dtype=np.float32)
+        widened = np.empty((DECODE_BLOCK_ROWS, self.dim), dtype=np.float32)
+        for start in range(0, count, DECODE_BLOCK_ROWS):
+            block = self.vectors[start:min(start + DECODE_BLOCK_ROWS, count)]
+            np.copyto(widened[:len(block)], block, casting='unsafe')
+            similarity[start:start + len(block)] = widened[:len(block)] @ query
+        return similarity * self.scales[:count]
+
+    def get(self, ids):
+        """
+        (len(ids), dim) float32 unit vectors. For a float32 store whose ids
+        sit in consecutive rows, as a batch just put does, this is a view of
+        the mapped matrix rather than a copy. KeyError for unknown ids.
+        """
+        with self._lock:
+            rows = np.fromiter((self._rows[photo_id] for photo_id in ids), dtype=np.int64, count=len(ids))
+            if len(rows) and np.all(np.diff(rows) == 1):
+                return self._decode(slice(int(rows[0]), int(rows[-1]) + 1))
+            return self._decode(rows)
+
+    def nearest(self, vector, k, exclude=(), candidates=None):
+        """
+        The k stored ids most cosine-similar to `vector`, best first, as
+        (photo id, similarity) pairs, chosen from `candidates` when given.
+        One matrix-vector product over the mapped rows, no index to build;
+        the best SHORTLIST_FACTOR * k are then re-scored in float32, since
+        float16 products only keep three significant digits.
+        """
+        if k < 1:
+            return []
+        query = normalize_rows(vector)[0]
+        with self._lock:
+            count = self.count
+            if candidates is None:
+                searchable = self._live[:count].copy()
+            else:
+                searchable = np.zeros(count, dtype=bool)
+                searchable[[self._rows[photo_id] for photo_id in candidates if photo_id in self._rows]] = True
+            searchable[[self._rows[photo_id] for photo_id in exclude if photo_id in self._rows]] = False
+            rows = np.flatnonzero(searchable)
+            if not len(rows):
+                return []
+            similarity = self._similarities(query, count)[rows]
+            shortlist = SHORTLIST_FACTOR * k
+            if len(rows) > shortlist:
+                rows = rows[np.argpartition(-similarity, shortlist - 1)[:shortlist]]
+            similarity = self._decode(rows) @ query
+            if len(rows) > k:
+                top = np.argpartition(-similarity, k - 1)[:k]
+                rows, similarity = rows[top], similarity[top]
+            order = np.argsort(-similarity, kind='stable')
+            return [(self._row_ids[row], float(score))
+                    for row, score in zip(rows[order].tolist(), similarity[order].tolist())]
+
+    def compact(self):
+        """Rewrite the live rows contiguously, dropping tombstones"""
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        live = np.array([row for row, photo_id in enumerate(self._row_ids) if photo_id is not None], dtype=np.int64)
+        self._allocate(max(INITIAL_CAPACITY, 2 * len(live)), keep=live)
+        self._row_ids = [self._row_ids[row] for row in live.tolist()]
+        self._rows = {photo_id: row for row, photo_id in enumerate(self._row_ids)}
+        self.count = len(live)
+        self._dirty = True
+
+    def flush(self):
+        """
+        Persist the matrix and the id index, compacting first when
+        tombstones dominate. Deletes alone are appended to deleted.jsonl;
+        the index is rewritten once the log holds as many ids as it has rows.
+        """
+        with self._lock:
+            if not self._dirty and not self._deleted:
+                return
+            tombstones = self.count - len(self._rows)
+            if tombstones >= COMPACT_MIN_TOMBSTONES and tombstones > len(self._rows):
+                self._compact()
+            if not self._dirty and self._logged + len(self._deleted) <= self.count:
+                with open(self._log_path, 'a') as f:
+                    f.writelines(json.dumps([self._generation, photo_id]) + '\n' for photo_id in self._deleted)
+                self._logged += len(self._deleted)
+                self._deleted = []
+                return
+            self.vectors.flush()
+            if self.scales is not None:
+                self.scales.flush()
+            # A new generation, so a log left behind by a crash before it is emptied is ignored
+            self._generation += 1
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'dim': self.dim, 'dtype': self.dtype, 'generation': self._generation,
+                           'ids': self._row_ids}, f)
+            os.replace(tmp_path, self._index_path)
+            open(self._log_path, 'w').close()
+            self._dirty = False
+            self._deleted = []
+            self._logged = 0
+
+    def close(self):
+        """Flush and release the directory claim, so another instance can take these files over"""
+        self.flush()
+        if self._claim is not None:
+            self._claim.close()
+            self._claim = None
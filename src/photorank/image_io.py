@@ -0,0 +1,96 @@
+import math
+import os
+
+from PIL import Image, ImageOps
+from pillow_heif import register_heif_opener
+
+# Paths handed to the loaders may be HEICs straight from a phone
+register_heif_opener()
+
+# Long side decoded for model input: twice the 224 px network input, so the
+# final resize still averages real detail and sharpness is measured at one
+# consistent scale whatever the camera resolution
+MODEL_DECODE_SIDE = 448
+
+
+def reduce_to_fit(img, max_side):
+    """
+    Shrink an image so its longer side is at most max_side. Integer-factor
+    Image.reduce does the bulk of the work cheaply, leaving only a small
+    final resample.
+    """
+    if max(img.size) <= max_side:
+        return img
+    factor = max(img.size) // (2 * max_side)
+    if factor > 1:
+        img = img.reduce(factor)
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    return img
+
+
+def _draft(img, max_side):
+    """
+    Ask the decoder for the smallest version of the image whose longer side
+    is still at least max_side. JPEGs decode at a reduced DCT scale; HEICs
+    use an embedded thumbnail when pillow-heif finds one big enough. Other
+    formats ignore the request.
+    """
+    scale = max_side / max(img.size)
+    if scale < 1:
+        img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+
+
+def load_reduced(path, max_side=None):
+    """
+    Decode an image file as upright RGB, no larger than max_side, with the
+    decode cost following the output size rather than the sensor resolution.
+    """
+    with Image.open(path) as img:
+        if max_side:
+            _draft(img, max_side)
+        img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if max_side:
+        img = reduce_to_fit(img, max_side)
+    return img
+
+
+class LazyImage:
+    """
+    Handle to an image file that holds nothing but its path. It is path-like,
+    so every loader here opens, decodes and closes the file only when it is
+    used, and it pickles as the path alone for worker processes.
+    """
+    __slots__ = ('path',)
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return f"LazyImage({self.path!r})"
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def load(self, max_side=None):
+        """Decode the image now, as upright RGB no larger than max_side"""
+        return load_reduced(self.path, max_side)
+
+
+def load_model_input(source, max_side=MODEL_DECODE_SIDE):
+    """
+    Upright RGB image ready for the model transforms, from a file path or a
+    PIL image. Paths take the reduced-resolution decode; images that are
+    already open are only rotated and reduced, leaving the caller's copy as is.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return load_reduced(source, max_side)
+    img = ImageOps.exif_transpose(source)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return reduce_to_fit(img, max_side)
@@ -0,0 +1,211 @@
+import os
+
+import numpy as np
+from .neighbor_index import ExactIndex, normalize_rows
+
+NOISE = -1
+
+
+class IncrementalDBSCAN:
+    """
+    DBSCAN over cosine distance that keeps its state between calls.
+
+    Points are identified by caller-supplied keys and stored in a neighbour
+    index (see neighbor_index.py). Inserting or removing points only
+    re-expands the clusters around the changed points: those of points
+    whose neighbourhood changed, and of every neighbour of a point that
+    gained or lost core status. Recomputed clusters keep the label of the
+    old cluster they overlap most, so labels stay stable across calls.
+    Noise, core points and cluster membership match sklearn's DBSCAN with
+    metric='cosine'; border points reachable from two clusters may be
+    assigned to either, as in DBSCAN itself.
+    """
+    def __init__(self, eps=0.3, min_samples=2, index=None):
+        self.eps = eps
+        self.min_samples = min_samples
+        # Answers the eps-neighbourhood queries; ExactIndex unless an ANN index is supplied
+        self.index = index if index is not None else ExactIndex()
+        self.labels = {}  # key -> cluster label
+        self.neighbors = {}  # key -> set of keys within eps, excluding itself
+        self._next_label = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def _is_core(self, key):
+        # sklearn counts the point itself towards min_samples
+        return len(self.neighbors[key]) + 1 >= self.min_samples
+
+    def _insert(self, keys, vectors, was_core):
+        """
+        Add points and return the set of keys whose neighbourhood changed,
+        recording in `was_core` whether each was a core point beforehand
+        """
+        self.index.add(keys, vectors)
+        for key in keys:
+            self.neighbors[key] = set()
+            self.labels[key] = NOISE
+            was_core.setdefault(key, False)
+
+        dirty = set(keys)
+        for key, found in zip(keys, self.index.radius_query(self.index.get(keys), self.eps)):
+            for neighbor in found:
+                if neighbor == key:
+                    continue
+                if neighbor not in was_core:
+                    was_core[neighbor] = self._is_core(neighbor)
+                self.neighbors[key].add(neighbor)
+                self.neighbors[neighbor].add(key)
+                dirty.add(neighbor)
+        return dirty
+
+    def _remove(self, keys, was_core):
+        """
+        Drop points and return the remaining keys whose neighbourhood
+        changed plus the labels they held, recording core status as _insert does
+        """
+        dirty = set()
+        removed_labels = set()
+        keys = [key for key in keys if key in self.index]
+        for key in keys:
+            removed_labels.add(self.labels.pop(key))
+            for neighbor in self.neighbors.pop(key):
+                if neighbor not in was_core:
+                    was_core[neighbor] = self._is_core(neighbor)
+                self.neighbors[neighbor].discard(key)
+                dirty.add(neighbor)
+        self.index.remove(keys)
+        return {key for key in dirty if key in self.index}, removed_labels
+
+    def insert(self, keys, vectors):
+        """Add points and update the clusters around them"""
+        was_core = {}
+        self._recluster(self._insert(keys, vectors, was_core), set(), was_core)
+
+    def remove(self, keys):
+        """Remove points and update the clusters they belonged to"""
+        was_core = {}
+        dirty, removed_labels = self._remove(keys, was_core)
+        self._recluster(dirty, removed_labels, was_core)
+
+    def _recluster(self, dirty, removed_labels, was_core):
+        """Re-expand every cluster touching a dirty key and relabel it stably"""
+        region = set(dirty)
+        # A point that became core can pull in neighbours that were noise; one that stopped
+        # being core can leave its border points stranded. Either way its neighbours are revisited
+        for key in dirty:
+            if self._is_core(key) != was_core.get(key, False):
+                region.update(self.neighbors[key])
+        affected_labels = {self.labels[key] for key in region} | removed_labels
+        affected_labels.discard(NOISE)
+        if affected_labels:
+            region.update(key for key, label in self.labels.items() if label in affected_labels)
+
+        old_labels = {key: self.labels[key] for key in region}
+        components = []
+        assigned = set()
+        for seed in region:
+            if seed in assigned or not self._is_core(seed):
+                continue
+            component = {seed}
+            assigned.add(seed)
+            stack = [seed]
+            while stack:
+                key = stack.pop()
+                for neighbor in self.neighbors[key]:
+                    if neighbor in assigned or not self._is_core(neighbor):
+                        continue
+                    assigned.add(neighbor)
+                    component.add(neighbor)
+                    stack.append(neighbor)
+            components.append(component)
+
+        # Each recomputed component inherits the old label it overlaps most
+        used_labels = set()
+        for component in sorted(components, key=len, reverse=True):
+            overlap = {}
+            for key in component:
+                label = old_labels.get(key, self.labels[key])
+                if label != NOISE and label not in used_labels:
+                    overlap[label] = overlap.get(label, 0) + 1
+            if overlap:
+                label = max(overlap, key=lambda l: (overlap[l], -l))
+            else:
+                label = self._next_label
+                self._next_label += 1
+            used_labels.add(label)
+            for key in component:
+                self.labels[key] = label
+
+        # Non-core points join the cluster of a neighbouring core point, if any
+        for key in region - assigned:
+            core_labels = sorted(self.labels[n] for n in self.neighbors[key] if self._is_core(n))
+            if not core_labels:
+                self.labels[key] = NOISE
+            elif old_labels.get(key) in core_labels:
+                self.labels[key] = old_labels[key]
+            else:
+                self.labels[key] = core_labels[0]
+
+    def sync(self, keys, vectors):
+        """Make the clustered set equal to keys/vectors and return their labels in order
+
+        Keys that are already present with the same vector are left alone,
+        so the cost of a call scales with what changed since the last one.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        wanted = dict(zip(keys, range(len(keys))))
+        stale = [key for key in self.index.keys() if key not in wanted]
+        fresh = [key for key in wanted if key not in self.index]
+
+        # Keys whose vector changed (e.g. a file replaced in place) are re-inserted
+        known = [key for key in wanted if key in self.index]
+        if known:
+            current = normalize_rows(vectors[[wanted[key] for key in known]])
+            changed = np.abs(self.index.get(known) - current).max(axis=1) > 1e-6
+            for key in np.array(known, dtype=object)[changed]:
+                stale.append(key)
+                fresh.append(key)
+
+        was_core = {}
+        dirty, removed_labels = self._remove(stale, was_core)
+        if fresh:
+            dirty |= self._insert(fresh, vectors[[wanted[key] for key in fresh]], was_core)
+        if dirty or removed_labels:
+            self._recluster(dirty, removed_labels, was_core)
+        return np.array([self.labels[key] for key in keys], dtype=int)
+
+
+def point_key(name, img):
+    """Stable key for a (name, image or path) pair: the image's file path when it has one"""
+    if isinstance(img, (str, os.PathLike)):
+        return os.fspath(img)
+    return getattr(img, 'filename', None) or name
+
+
+def point_keys(images, kept):
+    """Stable keys for the kept (name, image or path) pairs"""
+    keys = []
+    seen = set()
+    for idx in kept:
+        key = point_key(*images[idx])
+        # Two in-memory images with the same name still need distinct points
+        if key in seen:
+            key = f"{key}#{idx}"
+        seen.add(key)
+        keys.append(key)
+    return keys
+
+
+def stream_images(images, names):
+    """
+    Yield the image of each (name, image or path) pair from any iterable,
+    appending (name, point key) to `names` as it passes, so only those two
+    strings outlive the image once it has been processed.
+    """
+    for name, img in images:
+        names.append((name, point_key(name, img)))
+        yield img
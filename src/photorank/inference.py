@@ -0,0 +1,157 @@
+import copy
+import importlib.util
+import os
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+EAGER = 'eager'
+# Traced, frozen and optimized for inference
+TORCHSCRIPT = 'torchscript'
+# int8 weights and activations throughout, calibrated on sample batches
+STATIC_INT8 = 'static_int8'
+# Exported to ONNX and run by ONNX Runtime (needs the onnx and onnxruntime packages)
+ONNX = 'onnx'
+BACKENDS = (EAGER, TORCHSCRIPT, STATIC_INT8, ONNX)
+INPUT_SHAPE = (3, 224, 224)
+
+
+def default_backend():
+    return os.environ.get('PHOTORANK_BACKEND', EAGER)
+
+
+def synthetic_calibration(batches=4, batch_size=8, seed=0):
+    """
+    Normalized smooth-noise batches for static quantization when no real
+    photos are available. Calibrating on photos gives better int8 ranges.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    for _ in range(batches):
+        coarse = torch.rand(batch_size, 3, 14, 14, generator=generator)
+        images = nn.functional.interpolate(coarse, size=INPUT_SHAPE[1:], mode='bilinear', align_corners=False)
+        mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+        yield (images - mean) / std
+
+
+def calibration_batches(images, to_tensor, batch_size=8):
+    """Input batches for STATIC_INT8 calibration from image paths or PIL images"""
+    images = list(images)
+    for start in range(0, len(images), batch_size):
+        yield torch.stack([to_tensor(img) for img in images[start:start + batch_size]])
+
+
+class OnnxModule:
+    """Runs an exported model in an ONNX Runtime CPU session, taking and returning torch tensors"""
+    def __init__(self, path, threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        output = self.session.run(None, {self.input_name: batch.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+
+def _export_onnx(module, name, export_dir):
+    path = os.path.join(export_dir or tempfile.gettempdir(), f"photorank-{name}.onnx")
+    if not os.path.exists(path):
+        tmp_path = path + '.tmp'
+        torch.onnx.export(module, (torch.zeros(1, *INPUT_SHAPE),), tmp_path, dynamo=False,
+                          input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}})
+        os.replace(tmp_path, path)
+    return path
+
+
+def compile_module(module, backend=EAGER, name='model', calibration=None, export_dir=None):
+    """
+    Return a callable that maps a (B, 3, 224, 224) batch to the same output
+    as the eval-mode `module`, run on the chosen backend. Every backend
+    except EAGER works on its own copy, so shared registry weights are
+    never modified. `calibration` is an iterable of input batches for
+    STATIC_INT8; `name` and `export_dir` place the exported ONNX file.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    module = module.eval()
+    if backend == EAGER:
+        return module
+
+    example = torch.zeros(2, *INPUT_SHAPE)
+    with torch.no_grad():
+        if backend == TORCHSCRIPT:
+            traced = torch.jit.trace(module, example)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        if backend == STATIC_INT8:
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+            qconfig = get_default_qconfig_mapping(torch.backends.quantized.engine)
+            prepared = prepare_fx(copy.deepcopy(module), qconfig, (example,))
+            for batch in calibration if calibration is not None else synthetic_calibration():
+                prepared(batch)
+            return convert_fx(prepared)
+    missing = [package for package in ('onnx', 'onnxruntime') if importlib.util.find_spec(package) is None]
+    if missing:
+        raise RuntimeError(f"The onnx backend needs {' and '.join(missing)} installed")
+    return OnnxModule(_export_onnx(module, name, export_dir))
+
+
+def _normalized(features):
+    features = np.asarray(features, dtype=np.float64).reshape(len(features), -1)
+    return features / np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-12)
+
+
+def parity_report(baseline, candidate, groups=None):
+    """
+    Compare a backend's EmbedScoreResult against the fp32 baseline over the
+    same images. Reports the cosine drift (1 - cosine similarity) of each
+    embedding, the score differences, and ranking changes: pairs of images
+    whose order flips overall and, for each group of baseline indices
+    (e.g. a cluster), whether the order or the recommended photo changes.
+    """
+    shared = sorted(set(baseline.kept) & set(candidate.kept))
+    base_pos = {idx: pos for pos, idx in enumerate(baseline.kept)}
+    cand_pos = {idx: pos for pos, idx in enumerate(candidate.kept)}
+    base_rows = [base_pos[idx] for idx in shared]
+    cand_rows = [cand_pos[idx] for idx in shared]
+
+    drift = 1.0 - np.sum(_normalized(baseline.features[base_rows]) * _normalized(candidate.features[cand_rows]), axis=1)
+    report = {
+        'images': len(shared),
+        'dropped': sorted(set(baseline.kept) - set(candidate.kept)),
+        'cosine_drift_mean': float(drift.mean()) if len(drift) else 0.0,
+        'cosine_drift_max': float(drift.max()) if len(drift) else 0.0,
+    }
+    if baseline.scores is None or candidate.scores is None:
+        return report
+
+    base_scores = dict(zip(baseline.kept, baseline.scores.tolist()))
+    cand_scores = dict(zip(candidate.kept, candidate.scores.tolist()))
+    score_diff = np.abs(np.array([cand_scores[idx] - base_scores[idx] for idx in shared]))
+    report['score_diff_mean'] = float(score_diff.mean()) if len(score_diff) else 0.0
+    report['score_diff_max'] = float(score_diff.max()) if len(score_diff) else 0.0
+
+    base = np.array([base_scores[idx] for idx in shared])
+    cand = np.array([cand_scores[idx] for idx in shared])
+    flipped = np.sign(base[:, None] - base[None, :]) * np.sign(cand[:, None] - cand[None, :]) < 0
+    report['swapped_pairs'] = int(np.triu(flipped, 1).sum())
+
+    changed = []
+    for label, members in (groups or {}).items():
+        members = [idx for idx in members if idx in cand_scores]
+        base_order = sorted(members, key=lambda idx: -base_scores[idx])
+        cand_order = sorted(members, key=lambda idx: -cand_scores[idx])
+        if base_order != cand_order:
+            changed.append({
+                'group': label,
+                'baseline_order': base_order,
+                'backend_order': cand_order,
+                'recommended_changed': base_order[:1] != cand_order[:1],
+            })
+    report['groups_reordered'] = changed
+    return report
@@ -0,0 +1,173 @@
+import json
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = 'queued'
+PROCESSING = 'processing'
+COMPLETED = 'completed'
+ERROR = 'error'
+FINISHED_STATES = (COMPLETED, ERROR)
+# Progress is passed to on_change at most this often; status changes always are
+PUBLISH_INTERVAL = 1.0
+
+
+def sse_event(state):
+    """A job's to_dict() state as a server-sent event"""
+    return f"data: {json.dumps(state)}\n\n"
+
+
+class Job:
+    """
+    A unit of background work with per-stage progress that request threads
+    can poll or wait on. `on_change(job)` is called after changes, outside
+    the job's lock, e.g. to share its state with other workers.
+    """
+    def __init__(self, job_id, description, owner=None, on_change=None):
+        self.id = job_id
+        self.description = description
+        self.owner = owner  # Session the job belongs to
+        self.status = QUEUED
+        self.message = 'Waiting for a worker'
+        self.stage = None
+        self.stages = OrderedDict()  # stage -> {'done', 'total', 'started', 'updated'}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.version = 0  # Bumped on every change so waiters know something happened
+        self.on_change = on_change
+        self._published = 0.0
+        self._changed = threading.Condition()
+
+    def _touch(self):
+        self.version += 1
+        self._changed.notify_all()
+
+    def publish(self, force=False):
+        """Pass the job to on_change, unless it was passed less than PUBLISH_INTERVAL ago"""
+        if self.on_change is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._published < PUBLISH_INTERVAL:
+            return
+        self._published = now
+        self.on_change(self)
+
+    def update(self, status=None, message=None):
+        with self._changed:
+            if status is not None:
+                self.status = status
+                if status in FINISHED_STATES:
+                    self.finished = time.time()
+            if message is not None:
+                self.message = message
+            self._touch()
+        self.publish(force=status is not None)
+
+    def progress(self, stage, done, total):
+        """Record that `done` of `total` items of a stage are finished"""
+        with self._changed:
+            now = time.time()
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {'done': 0, 'total': total, 'started': now, 'updated': now}
+            entry['done'] = done
+            entry['total'] = total
+            entry['updated'] = now
+            self.stage = stage
+            self._touch()
+        self.publish()
+
+    def wait_for_change(self, seen_version, timeout):
+        """Block until the job changes past seen_version or the timeout passes; return the current version"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != seen_version, timeout=timeout)
+            return self.version
+
+    @property
+    def finished_running(self):
+        return self.status in FINISHED_STATES
+
+    def to_dict(self):
+        with self._changed:
+            stages = {}
+            for name, entry in self.stages.items():
+                elapsed = entry['updated'] - entry['started']
+                stages[name] = {
+                    'done': entry['done'],
+                    'total': entry['total'],
+                    'seconds': round(elapsed, 3),
+                    'throughput': round(entry['done'] / elapsed, 2) if elapsed > 0 else None,
+                }
+            return {
+                'jobId': self.id,
+                'status': self.status,
+                'message': self.message,
+                'stage': self.stage,
+                'stages': stages,
+                'error': self.error,
+                'version': self.version,
+            }
+
+    def to_sse(self):
+        """Current state as a server-sent event"""
+        return sse_event(self.to_dict())
+
+
+class JobQueue:
+    """
+    Runs jobs on a pool of background threads so long clustering runs never
+    hold a request worker. Only the most recent `history` jobs are kept.
+    `on_change` is handed to every job (see Job).
+    """
+    def __init__(self, workers=1, history=50, on_change=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photorank-job')
+        self.history = history
+        self.on_change = on_change
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, description='', owner=None, **kwargs):
+        """Queue fn(job, *args, **kwargs); its return value becomes job.result"""
+        job = Job(str(uuid.uuid4()), description, owner, self.on_change)
+        with self._lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                oldest_id, oldest = next(iter(self.jobs.items()))
+                if not oldest.finished_running:
+                    break
+                del self.jobs[oldest_id]
+        job.publish(force=True)
+        self.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.update(status=PROCESSING, message='Processing started')
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.update(status=COMPLETED, message='Processing completed successfully')
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.update(status=ERROR, message=f"Processing failed: {str(e)}")
+
+    def get(self, job_id, owner=None):
+        """The job, or None if it is unknown or belongs to another owner than the one given"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is not None and owner is not None and job.owner != owner:
+            return None
+        return job
+
+    def latest(self, owner=None):
+        with self._lock:
+            return next((job for job in reversed(self.jobs.values()) if owner is None or job.owner == owner), None)
+
+    def active(self):
+        """Number of jobs queued or running"""
+        with self._lock:
+            return sum(1 for job in self.jobs.values() if not job.finished_running)
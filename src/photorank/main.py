@@ -1,5 +1,7 @@
 from photorank.photo_classifier import PhotoClassifier
 from photorank.utils import load_images, display_clusters
+from photorank.embedding_cache import default_cache_dir
+import itertools
 import os
 import torch
 
@@ -16,21 +18,24 @@ def main():
         print(f"Directory {directory} does not exist!")
         return
     
-    # Load all images
-    print("\nLoading images...")
+    # Lazy handles: each image is opened and decoded only when the classifier reaches it
     images = load_images(directory)
+    first = next(images, None)
     
-    if not images:
+    if first is None:
         print("No images found in the directory!")
         return
+    images = itertools.chain([first], images)
     
-    print(f"\nSuccessfully loaded {len(images)} images!")
-    
-    # Initialize the photo classifier
-    classifier = PhotoClassifier()
+    # Initialize the photo classifier; PHOTORANK_PREFETCH_WORKERS sets how many
+    # images are decoded in parallel while the models run
+    classifier = PhotoClassifier(cache_dir=default_cache_dir())
     
     # Cluster the images
-    cluster_groups = classifier.cluster_images(images)
+    try:
+        cluster_groups = classifier.cluster_images(images)
+    finally:
+        classifier.prefetch.close()
     
     # Display results
     display_clusters(cluster_groups)
@@ -0,0 +1,253 @@
+"""
+Lightweight instrumentation: counters, histograms and gauges rendered in
+the Prometheus text format, plus sampled structured (JSON) logs.
+
+Metrics live in the process that records them. Under gunicorn each
+worker exposes its own, and decode timings from PROCESS prefetch workers
+are not collected. With PHOTORANK_METRICS=0 every timer and counter is a
+no-op.
+"""
+import json
+import logging
+import math
+import os
+import random
+import resource
+import threading
+import time
+
+ENABLED = os.environ.get('PHOTORANK_METRICS', '1') == '1'
+# Fraction of routine (below WARNING) log events that are written
+LOG_SAMPLE_RATE = float(os.environ.get('PHOTORANK_LOG_SAMPLE', '1'))
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, math.inf)
+
+logger = logging.getLogger('photorank')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return '+Inf' if value == math.inf else repr(float(value))
+
+
+class Counter:
+    """Monotonic count per label combination"""
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _label_text(self.labelnames, labels), value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label combination"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(entry) for labels, entry in self._values.items()}
+        for labels, entry in sorted(values.items()):
+            for bound, count in zip(self.buckets, entry):
+                yield (f"{self.name}_bucket",
+                       _label_text(self.labelnames, labels, [('le', _format_value(bound))]), count)
+            yield f"{self.name}_sum", _label_text(self.labelnames, labels), entry[-2]
+            yield f"{self.name}_count", _label_text(self.labelnames, labels), entry[-1]
+
+
+class Gauge:
+    """A value read from a callback each time metrics are rendered"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        try:
+            value = self.read()
+        except Exception:
+            return
+        if value is not None:
+            yield self.name, '', value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=STAGE_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, read):
+        """Register a gauge, replacing any earlier callback of the same name"""
+        with self._lock:
+            self._metrics[name] = Gauge(name, help, read)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+STAGE_SECONDS = registry.histogram('photorank_stage_seconds', 'Time spent in each pipeline stage', ('stage',))
+STAGE_ITEMS = registry.counter('photorank_stage_items_total', 'Items processed by each pipeline stage', ('stage',))
+STAGE_ERRORS = registry.counter('photorank_stage_errors_total', 'Failures in each pipeline stage', ('stage',))
+HTTP_REQUESTS = registry.counter('photorank_http_requests_total', 'HTTP requests served',
+                                 ('endpoint', 'method', 'status'))
+HTTP_SECONDS = registry.histogram('photorank_http_request_seconds', 'HTTP request latency', ('endpoint',))
+CACHE_LOOKUPS = registry.counter('photorank_embedding_cache_lookups_total', 'Embedding cache lookups', ('result',))
+
+
+def resident_memory_bytes():
+    """Current RSS from /proc, or None where it is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_resident_memory_bytes():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+registry.gauge('process_resident_memory_bytes', 'Resident memory size in bytes', resident_memory_bytes)
+registry.gauge('process_peak_resident_memory_bytes', 'Peak resident memory size in bytes',
+               peak_resident_memory_bytes)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    __slots__ = ('stage', 'items', 'started')
+
+    def __init__(self, stage, items):
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self.started, self.stage)
+        if exc_type is None:
+            STAGE_ITEMS.inc(self.items, self.stage)
+        else:
+            STAGE_ERRORS.inc(1, self.stage)
+        return False
+
+
+def timed(stage, items=1):
+    """Context manager recording a stage's duration, its items, and a failure if it raises"""
+    if not ENABLED:
+        return _NULL_TIMER
+    return _StageTimer(stage, items)
+
+
+def increment(counter, value=1, *labels):
+    if ENABLED:
+        counter.inc(value, *labels)
+
+
+def count_error(stage):
+    increment(STAGE_ERRORS, 1, stage)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, event and its fields"""
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'event': getattr(record, 'event', None) or record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=None):
+    """Send photorank logs to stderr as JSON lines, unless a handler is already attached"""
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level or os.environ.get('PHOTORANK_LOG_LEVEL', 'INFO').upper())
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """
+    Structured log of an event and its fields. Events below WARNING are
+    kept with probability LOG_SAMPLE_RATE; the check comes before any
+    formatting, so dropped events cost almost nothing.
+    """
+    if level < logging.WARNING and LOG_SAMPLE_RATE < 1 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'event': event, 'fields': fields})
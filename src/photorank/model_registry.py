@@ -0,0 +1,51 @@
+import threading
+
+from torchvision import models
+
+from .metrics import timed
+
+RESNET50 = 'resnet50'
+MOBILENET_V2 = 'mobilenet_v2'
+
+BUILDERS = {
+    RESNET50: lambda: models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1),
+    MOBILENET_V2: lambda: models.mobilenet_v2(weights=models.MobileNet_V2_Weights.IMAGENET1K_V1),
+}
+
+_models = {}
+_lock = threading.Lock()
+
+
+def get_model(name):
+    """
+    The process-wide eval-mode instance of a pretrained model, loaded on
+    first use. Callers share it, so they must not modify its weights.
+    """
+    with _lock:
+        model = _models.get(name)
+        if model is None:
+            if name not in BUILDERS:
+                raise ValueError(f"Unknown model: {name}")
+            print(f"Loading {name} weights...")
+            with timed('model_load'):
+                model = BUILDERS[name]()
+                model.eval()
+            _models[name] = model
+        return model
+
+
+def loaded_models():
+    return list(_models)
+
+
+def preload(names=None, share_memory=True):
+    """
+    Load models up front. Run in the gunicorn master before it forks, the
+    weights are then shared by every worker; share_memory moves them into
+    shared memory so no worker ever ends up with a private copy.
+    """
+    for name in names or BUILDERS:
+        model = get_model(name)
+        if share_memory:
+            model.share_memory()
+
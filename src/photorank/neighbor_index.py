@@ -0,0 +1,311 @@
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import DBSCAN
+
+EXACT = 'exact'
+IVF = 'ivf'
+AUTO = 'auto'
+INDEX_KINDS = (EXACT, IVF, AUTO)
+# Below this many photos brute force is both exact and fast enough
+AUTO_EXACT_LIMIT = 5000
+
+
+def normalize_rows(vectors):
+    """L2-normalize each row so dot products are cosine similarities"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[np.newaxis, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class ExactIndex:
+    """
+    Brute-force cosine index over L2-normalized vectors.
+
+    Vectors live in one growable float32 matrix; removed rows are zeroed
+    and recycled. Radius queries are blocked matrix products against every
+    live row.
+    """
+    def __init__(self):
+        self._rows = {}  # key -> row in _matrix
+        self._row_keys = []  # row -> key, None for free rows
+        self._free_rows = []
+        self._matrix = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def keys(self):
+        return self._rows.keys()
+
+    def _allocate_rows(self, count, dim):
+        if self._matrix is None:
+            self._matrix = np.zeros((max(count, 16), dim), dtype=np.float32)
+        rows = []
+        while self._free_rows and len(rows) < count:
+            rows.append(self._free_rows.pop())
+        needed = count - len(rows)
+        if needed:
+            start = len(self._row_keys)
+            if start + needed > self._matrix.shape[0]:
+                capacity = max(start + needed, 2 * self._matrix.shape[0])
+                grown = np.zeros((capacity, dim), dtype=np.float32)
+                grown[:start] = self._matrix[:start]
+                self._matrix = grown
+            self._row_keys.extend([None] * needed)
+            rows.extend(range(start, start + needed))
+        return rows
+
+    def _live_rows(self):
+        return np.fromiter(self._rows.values(), dtype=np.int64, count=len(self._rows))
+
+    def add(self, keys, vectors):
+        """Insert vectors under the given keys and return the rows they were stored in"""
+        vectors = normalize_rows(vectors)
+        rows = self._allocate_rows(len(keys), vectors.shape[1])
+        for key, row, vector in zip(keys, rows, vectors):
+            self._matrix[row] = vector
+            self._rows[key] = row
+            self._row_keys[row] = key
+        return rows
+
+    def remove(self, keys):
+        """Drop keys from the index, ignoring ones that are not present"""
+        removed = []
+        for key in keys:
+            row = self._rows.pop(key, None)
+            if row is None:
+                continue
+            self._row_keys[row] = None
+            self._free_rows.append(row)
+            self._matrix[row] = 0.0
+            removed.append(row)
+        return removed
+
+    def get(self, keys):
+        """Stored (normalized) vectors for the given keys"""
+        return self._matrix[[self._rows[key] for key in keys]]
+
+    def _radius_pairs(self, vectors, eps, block_size=1024):
+        """(query index, row, similarity) arrays for every stored row within eps of a query"""
+        min_similarity = 1.0 - eps
+        live = self._live_rows()
+        stored = self._matrix[live]
+        queries, rows, similarities = [], [], []
+        for start in range(0, len(vectors), block_size):
+            similarity = vectors[start:start + block_size] @ stored.T
+            query_pos, live_pos = np.nonzero(similarity >= min_similarity)
+            queries.append(query_pos + start)
+            rows.append(live[live_pos])
+            similarities.append(similarity[query_pos, live_pos])
+        return _concatenate_pairs(queries, rows, similarities)
+
+    def radius_query(self, vectors, eps, block_size=1024):
+        """Keys within cosine distance eps of each query vector, including an identical stored key"""
+        vectors = normalize_rows(vectors)
+        if not self._rows:
+            return [[] for _ in range(len(vectors))]
+        queries, rows, _ = self._radius_pairs(vectors, eps, block_size=block_size)
+        order = np.argsort(queries, kind='stable')
+        bounds = np.searchsorted(queries[order], np.arange(len(vectors) + 1))
+        row_keys = self._row_keys
+        return [[row_keys[row] for row in rows[order[bounds[q]:bounds[q + 1]]].tolist()]
+                for q in range(len(vectors))]
+
+
+def _concatenate_pairs(queries, rows, similarities):
+    if not queries:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    return np.concatenate(queries), np.concatenate(rows), np.concatenate(similarities)
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted-file approximate cosine index in pure NumPy.
+
+    A spherical k-means quantizer splits the vectors into nlist cells; a
+    query only compares against the vectors in its nprobe most similar
+    cells. Until min_train vectors have been added it answers exactly, and
+    it retrains whenever the collection has grown retrain_factor times
+    since the last training.
+    """
+    def __init__(self, nlist=None, nprobe=8, min_train=1024, retrain_factor=4, kmeans_iterations=8, seed=0):
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.retrain_factor = retrain_factor
+        self.kmeans_iterations = kmeans_iterations
+        self.rng = np.random.default_rng(seed)
+        self.centroids = None
+        self.center = None  # Mean vector removed before quantization
+        self._trained_size = 0
+        self._lists = []  # cell -> set of rows
+        self._row_cell = {}  # row -> cell
+        self._cell_arrays = None
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def _quantizer_space(self, vectors):
+        # Post-ReLU features share a strong mean direction; without centering
+        # most vectors would land in a handful of giant cells
+        return normalize_rows(vectors - self.center)
+
+    def _nearest_cells(self, vectors, count):
+        similarity = self._quantizer_space(vectors) @ self.centroids.T
+        if count >= similarity.shape[1]:
+            return np.argsort(-similarity, axis=1)
+        cells = np.argpartition(-similarity, count - 1, axis=1)[:, :count]
+        return cells
+
+    def train(self):
+        """Fit the coarse quantizer on the current vectors and rebuild the inverted lists"""
+        live = self._live_rows()
+        self.center = self._matrix[live].mean(axis=0)
+        nlist = self.nlist or max(1, int(2 * np.sqrt(len(live))))
+        nlist = min(nlist, len(live))
+        # A few dozen samples per cell is enough for a coarse quantizer
+        sample_size = min(len(live), nlist * 32)
+        sample = self._quantizer_space(self._matrix[self.rng.choice(live, sample_size, replace=False)])
+        centroids = sample[self.rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(self.kmeans_iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            membership = sparse.csr_matrix(
+                (np.ones(sample_size, dtype=np.float32), (assignment, np.arange(sample_size))),
+                shape=(nlist, sample_size))
+            sums = np.asarray(membership @ sample)
+            counts = np.bincount(assignment, minlength=nlist)
+            empty = counts == 0
+            # Re-seed empty cells from random samples
+            sums[empty] = sample[self.rng.choice(sample_size, int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        self.centroids = centroids
+        self._trained_size = len(live)
+        self._lists = [set() for _ in range(nlist)]
+        self._row_cell = {}
+        self._assign(live)
+
+    def _assign(self, rows, block_size=4096):
+        self._cell_arrays = None
+        for start in range(0, len(rows), block_size):
+            block = np.asarray(rows[start:start + block_size])
+            cells = np.argmax(self._quantizer_space(self._matrix[block]) @ self.centroids.T, axis=1)
+            for row, cell in zip(block.tolist(), cells.tolist()):
+                self._lists[cell].add(row)
+                self._row_cell[row] = cell
+
+    def add(self, keys, vectors):
+        rows = super().add(keys, vectors)
+        if not self.trained:
+            if len(self) >= self.min_train:
+                self.train()
+        elif len(self) >= self.retrain_factor * self._trained_size:
+            self.train()
+        else:
+            self._assign(rows)
+        return rows
+
+    def remove(self, keys):
+        removed = super().remove(keys)
+        if self.trained:
+            self._cell_arrays = None
+            for row in removed:
+                cell = self._row_cell.pop(row, None)
+                if cell is not None:
+                    self._lists[cell].discard(row)
+        return removed
+
+    def _cell_rows(self):
+        """Inverted lists as arrays, rebuilt only after adds or removes"""
+        if self._cell_arrays is None:
+            self._cell_arrays = [np.fromiter(rows, dtype=np.int64, count=len(rows)) for rows in self._lists]
+        return self._cell_arrays
+
+    def _radius_pairs(self, vectors, eps, block_size=1024):
+        if not self.trained:
+            return super()._radius_pairs(vectors, eps, block_size=block_size)
+        min_similarity = 1.0 - eps
+        cell_rows = self._cell_rows()
+        probe = np.concatenate([self._nearest_cells(vectors[start:start + block_size], self.nprobe)
+                                for start in range(0, len(vectors), block_size)])
+
+        # Visit each probed cell once, comparing its members against every query that probes it
+        probe_queries = np.repeat(np.arange(len(vectors)), probe.shape[1])
+        probe_cells = probe.ravel()
+        order = np.argsort(probe_cells, kind='stable')
+        probe_queries, probe_cells = probe_queries[order], probe_cells[order]
+        cells, bounds = np.unique(probe_cells, return_index=True)
+        bounds = np.append(bounds, len(probe_cells))
+
+        queries, rows, similarities = [], [], []
+        for cell, lo, hi in zip(cells.tolist(), bounds[:-1].tolist(), bounds[1:].tolist()):
+            members = cell_rows[cell]
+            if not len(members):
+                continue
+            member_vectors = self._matrix[members]
+            for chunk_lo in range(lo, hi, block_size):
+                query_idx = probe_queries[chunk_lo:min(chunk_lo + block_size, hi)]
+                similarity = vectors[query_idx] @ member_vectors.T
+                query_pos, member_pos = np.nonzero(similarity >= min_similarity)
+                queries.append(query_idx[query_pos])
+                rows.append(members[member_pos])
+                similarities.append(similarity[query_pos, member_pos])
+        return _concatenate_pairs(queries, rows, similarities)
+
+
+def build_index(kind=EXACT, **kwargs):
+    """Create a neighbour index; AUTO answers exactly until the collection outgrows AUTO_EXACT_LIMIT"""
+    if kind not in INDEX_KINDS:
+        raise ValueError(f"Unknown neighbour index: {kind}")
+    if kind == AUTO:
+        kwargs.setdefault('min_train', AUTO_EXACT_LIMIT)
+        return IVFIndex(**kwargs)
+    if kind == IVF:
+        return IVFIndex(**kwargs)
+    return ExactIndex()
+
+
+def radius_graph(features, eps, kind=IVF, **kwargs):
+    """
+    Sparse cosine-distance graph holding every pair within eps, built from a
+    neighbour index. Feed it to DBSCAN(metric='precomputed') in place of the
+    dense O(n^2) distance computation.
+    """
+    if not len(features):
+        return sparse.csr_matrix((0, 0), dtype=np.float64)
+    index = build_index(kind, **kwargs)
+    keys = list(range(len(features)))
+    rows = index.add(keys, features)
+    stored = index.get(keys)
+    queries, found_rows, similarity = index._radius_pairs(stored, eps)
+    # Map storage rows back to feature indices
+    row_to_key = np.empty(max(rows) + 1, dtype=np.int64)
+    row_to_key[rows] = keys
+    # Explicit zeros would be dropped as non-neighbours, so clamp duplicates to a tiny distance
+    distance = np.clip(1.0 - similarity.astype(np.float64), 1e-9, None)
+    return sparse.csr_matrix((distance, (queries, row_to_key[found_rows])),
+                             shape=(len(features), len(features)))
+
+
+def dbscan_labels(features, eps, min_samples, kind=EXACT, sample_weight=None):
+    """
+    DBSCAN labels over cosine distance, brute force or via an approximate
+    radius graph. A point with sample_weight w counts as w points towards
+    min_samples, e.g. one photo standing in for a group.
+    """
+    if kind == AUTO:
+        kind = EXACT if len(features) < AUTO_EXACT_LIMIT else IVF
+    if kind == EXACT:
+        return DBSCAN(eps=eps, min_samples=min_samples, metric='cosine').fit_predict(
+            features, sample_weight=sample_weight)
+    graph = radius_graph(features, eps, kind=kind)
+    return DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed').fit_predict(
+        graph, sample_weight=sample_weight)
@@ -0,0 +1,238 @@
+"""
+Perceptual hashes and a Hamming-distance index over them.
+
+Hashes are computed for a whole batch at once from small grayscale
+thumbnails: a 64-bit difference hash (dHash: is each pixel brighter than
+its right-hand neighbour) and a 64-bit DCT hash (pHash: is each
+low-frequency coefficient above the median). Both survive re-encoding and
+resizing; pHash also shrugs off exposure changes that flip dHash bits.
+
+The clustering prefilter (TWO_TIER) groups photos whose hashes are close
+before any model runs, so only one photo per group needs deep features.
+"""
+import os
+
+import numpy as np
+from PIL import Image
+
+from .image_io import load_reduced
+
+# Every photo goes through the feature model before DBSCAN
+DEEP = 'deep'
+# Perceptual-hash groups first, deep features only for group representatives and ambiguous photos
+TWO_TIER = 'two_tier'
+CLUSTER_STRATEGIES = (DEEP, TWO_TIER)
+
+HASH_BITS = 64
+# dHash compares neighbouring pixels of a (DHASH_SIDE + 1) x DHASH_SIDE thumbnail
+DHASH_SIDE = 8
+# pHash keeps the top-left PHASH_SIDE x PHASH_SIDE DCT coefficients of a PHASH_INPUT thumbnail
+PHASH_SIDE = 8
+PHASH_INPUT = 32
+# Long side decoded for hashing; JPEGs and HEICs decode a reduced version this small
+HASH_DECODE_SIDE = 64
+# Photos within both distances are grouped without deep features
+DEFAULT_SURE_DISTANCE = 8
+# Photos within either distance of another, but not sure, get deep features of their own
+DEFAULT_AMBIGUOUS_DISTANCE = 16
+
+
+def default_cluster_strategy():
+    return os.environ.get('PHOTORANK_CLUSTER_STRATEGY', DEEP)
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis as an (n, n) matrix"""
+    k = np.arange(n)[:, None]
+    basis = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    basis[0] /= np.sqrt(2)
+    return basis
+
+
+_DCT = _dct_matrix(PHASH_INPUT)
+
+
+def _pack(bits):
+    """(N, 64) booleans -> (N,) uint64 hashes, first bit most significant"""
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def dhash_batch(thumbnails):
+    """Difference hashes for an (N, DHASH_SIDE, DHASH_SIDE + 1) stack of grayscale thumbnails"""
+    thumbnails = np.asarray(thumbnails, dtype=np.int16)
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    return _pack(bits.reshape(len(thumbnails), -1))
+
+
+def phash_batch(thumbnails):
+    """DCT hashes for an (N, PHASH_INPUT, PHASH_INPUT) stack of grayscale thumbnails"""
+    thumbnails = np.asarray(thumbnails, dtype=np.float32)
+    coefficients = _DCT @ thumbnails @ _DCT.T
+    low = coefficients[:, :PHASH_SIDE, :PHASH_SIDE].reshape(len(thumbnails), -1)
+    # The DC term only says how bright the photo is
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    return _pack(low > median)
+
+
+def thumbnails(img):
+    """The two grayscale thumbnails the hashes are computed from"""
+    gray = img.convert('L')
+    small = np.asarray(gray.resize((DHASH_SIDE + 1, DHASH_SIDE), Image.BILINEAR))
+    square = np.asarray(gray.resize((PHASH_INPUT, PHASH_INPUT), Image.BILINEAR))
+    return small, square
+
+
+def hash_images(images):
+    """
+    dHash and pHash arrays for image paths or PIL images, plus the indices
+    of the inputs that could be decoded. Paths are decoded at a small
+    fraction of their resolution.
+    """
+    small, square, kept = [], [], []
+    for idx, img in enumerate(images):
+        try:
+            if isinstance(img, (str, os.PathLike)):
+                img = load_reduced(img, HASH_DECODE_SIDE)
+            d, p = thumbnails(img)
+        except Exception:
+            continue
+        small.append(d)
+        square.append(p)
+        kept.append(idx)
+    if not kept:
+        empty = np.empty(0, dtype=np.uint64)
+        return empty, empty, kept
+    return dhash_batch(np.stack(small)), phash_batch(np.stack(square)), kept
+
+
+# Set bits in each byte value, for NumPy before 2.0
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def _popcount_bytes(values):
+    """Set bits in each element of a uint64 array, a byte at a time through a lookup table"""
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return _BYTE_BITS[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+# np.bitwise_count is a single vectorized instruction per element where the CPU has one
+popcount = getattr(np, 'bitwise_count', _popcount_bytes)
+
+
+class HammingIndex:
+    """
+    Hashes in a flat uint64 array, searched by XOR and popcount in
+    vectorized blocks. Removal leaves a tombstone that the next add reuses.
+    """
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.keys = []
+        self._live = np.empty(0, dtype=bool)
+        self._rows = {}  # key -> row
+        self._free = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def add(self, key, value):
+        if key in self._rows:
+            self.remove(key)
+        if self._free:
+            row = self._free.pop()
+            self.keys[row] = key
+        else:
+            row = len(self.keys)
+            self.keys.append(key)
+            if row == len(self.hashes):
+                capacity = max(64, 2 * len(self.hashes))
+                self.hashes = np.resize(self.hashes, capacity)
+                self._live = np.concatenate([self._live, np.zeros(capacity - len(self._live), dtype=bool)])
+        self.hashes[row] = value
+        self._live[row] = True
+        self._rows[key] = row
+
+    def remove(self, key):
+        row = self._rows.pop(key, None)
+        if row is not None:
+            self._live[row] = False
+            self._free.append(row)
+
+    def nearest(self, value, max_distance, exclude=None):
+        """Key of the closest hash within max_distance, or None"""
+        count = len(self.keys)
+        if not count:
+            return None
+        distances = popcount(self.hashes[:count] ^ np.uint64(value)).astype(np.int16)
+        distances[~self._live[:count]] = HASH_BITS + 1
+        if exclude is not None and exclude in self._rows:
+            distances[self._rows[exclude]] = HASH_BITS + 1
+        row = int(np.argmin(distances))
+        return self.keys[row] if distances[row] <= max_distance else None
+
+
+def hamming_pairs(hashes, max_distance, block_size=512):
+    """
+    Every pair (i, j), i < j, of an (N,) uint64 array within max_distance,
+    as index arrays plus their distances. Memory stays at block_size x N.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    firsts, seconds, distances = [], [], []
+    for start in range(0, len(hashes), block_size):
+        block = hashes[start:start + block_size]
+        distance = popcount(block[:, None] ^ hashes[None, start:])
+        rows, cols = np.nonzero(distance <= max_distance)
+        keep = cols > rows  # Upper triangle; the block starts at column `start`
+        rows, cols = rows[keep], cols[keep]
+        firsts.append(rows + start)
+        seconds.append(cols + start)
+        distances.append(distance[rows, cols])
+    if not firsts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    return np.concatenate(firsts), np.concatenate(seconds), np.concatenate(distances)
+
+
+def _union_find_labels(count, firsts, seconds):
+    parent = np.arange(count)
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in zip(firsts.tolist(), seconds.tolist()):
+        ra, rb = root(a), root(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    return np.array([root(i) for i in range(count)])
+
+
+def hash_groups(dhashes, phashes, sure=DEFAULT_SURE_DISTANCE, ambiguous=DEFAULT_AMBIGUOUS_DISTANCE):
+    """
+    Candidate groups from two hashes of the same photos. Photos within
+    `sure` bits on both hashes are joined (transitively); photos within
+    `ambiguous` bits on either hash of a photo that ended up in another
+    group are marked ambiguous.
+
+    Returns (groups, ambiguous): a group label per photo (the lowest index
+    in its group) and a boolean mask.
+    """
+    count = len(dhashes)
+    d_first, d_second, d_distance = hamming_pairs(dhashes, ambiguous)
+    p_first, p_second, p_distance = hamming_pairs(phashes, ambiguous)
+    d_pairs = {(a, b): dist for a, b, dist in zip(d_first.tolist(), d_second.tolist(), d_distance.tolist())}
+    p_pairs = {(a, b): dist for a, b, dist in zip(p_first.tolist(), p_second.tolist(), p_distance.tolist())}
+
+    sure_pairs = [pair for pair, dist in d_pairs.items() if dist <= sure and p_pairs.get(pair, HASH_BITS) <= sure]
+    pairs = np.array(sure_pairs, dtype=np.int64).reshape(-1, 2)
+    groups = _union_find_labels(count, pairs[:, 0], pairs[:, 1])
+    # Close calls inside one group are settled by the group; only those across groups need the model
+    uncertain = np.zeros(count, dtype=bool)
+    for a, b in set(d_pairs) | set(p_pairs):
+        if groups[a] != groups[b]:
+            uncertain[a] = uncertain[b] = True
+    return groups, uncertain
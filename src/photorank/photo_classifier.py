@@ -1,17 +1,98 @@
 import numpy as np
 import torch
 import torch.nn as nn
-from torchvision import models, transforms
-from sklearn.cluster import DBSCAN
+import torch.nn.functional as F
+from torchvision import transforms
 from tqdm import tqdm
 from .photo_ranker import PhotoRanker
+from .embed_score import EmbedScoreEngine, known_length, ENGINE_MODES, PREPROCESS_VERSION, SHARED_BACKBONE, SHARED_INPUT, rank_clusters_by_score
+from .embedding_cache import EmbeddingCache
+from .embedding_store import FLOAT32, EmbeddingStore
+from .image_io import load_model_input
+from .inference import BACKENDS, EAGER, calibration_batches, compile_module
+from .incremental_cluster import IncrementalDBSCAN, point_keys, stream_images
+from .metrics import log_event, timed
+from .model_registry import RESNET50, get_model
+from .neighbor_index import EXACT, INDEX_KINDS, build_index, dbscan_labels
+from .perceptual import CLUSTER_STRATEGIES, DEEP, TWO_TIER, hash_groups, hash_images
+from .prefetch import PrefetchPool
+from .sharpness import GLOBAL, SharpnessScorer
 from PIL import Image
 
 class PhotoClassifier:
-    def __init__(self):
+    def __init__(self, batch_size=32, mode=SHARED_INPUT, cache_dir=None, incremental=False,
+                 neighbor_index=EXACT, prefetch_workers=None, prefetch=None, sharpness_mode=GLOBAL,
+                 backend=EAGER, calibration_images=None, cluster_strategy=DEEP, store_dir=None,
+                 store_dtype=None):
+        """
+        mode selects how clustering features and quality scores share work:
+        SHARED_INPUT keeps ResNet50 features and MobileNetV2 quality but
+        preprocesses each image once; SHARED_BACKBONE scores quality from the
+        ResNet50 logits so every image needs a single forward pass.
+
+        cache_dir enables the persistent EmbeddingCache so images seen in an
+        earlier run are not pushed through the models again.
+
+        incremental keeps an IncrementalDBSCAN between cluster_images calls,
+        so re-clustering after adding or removing a few photos only touches
+        the clusters around them; callers clustering several photo sets
+        pass each set's owner so every set keeps its own.
+
+        neighbor_index picks how eps-neighbourhoods are found: EXACT brute
+        force, IVF approximate search for large libraries, or AUTO to switch
+        to IVF once the library is big enough.
+
+        prefetch_workers and prefetch size the PrefetchPool that decodes and
+        preprocesses upcoming images while the models run (THREAD or
+        PROCESS workers; 0 workers decodes inline). Defaults come from
+        PHOTORANK_PREFETCH_WORKERS and PHOTORANK_PREFETCH.
+
+        sharpness_mode picks the SharpnessScorer variant: GLOBAL, MULTISCALE
+        or TILED.
+
+        backend picks how the models run (see inference.BACKENDS): EAGER
+        PyTorch, TORCHSCRIPT, STATIC_INT8 or ONNX. Static quantization
+        calibrates on calibration_images, a few representative photos, or
+        on synthetic input without them. Every backend but EAGER keeps a
+        private compiled copy of the weights.
+
+        cluster_strategy is the default for cluster_images: DEEP runs every
+        photo through ResNet50; TWO_TIER groups photos by perceptual hash
+        first and only embeds one photo per group plus the ambiguous ones.
+
+        store_dir enables the EmbeddingStore: each DEEP run's features are
+        kept there under the names passed to cluster_images (which must
+        then be unique, e.g. photo ids), stored as store_dtype (FLOAT32,
+        FLOAT16 or INT8; PHOTORANK_EMBEDDING_DTYPE by default). Quantized
+        rows shrink the store, not clustering: DBSCAN reads float32 stores
+        back from the mapped matrix and clusters the batch otherwise.
+        """
+        if mode not in ENGINE_MODES:
+            raise ValueError(f"Unknown engine mode: {mode}")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend}")
+        if neighbor_index not in INDEX_KINDS:
+            raise ValueError(f"Unknown neighbour index: {neighbor_index}")
+        if cluster_strategy not in CLUSTER_STRATEGIES:
+            raise ValueError(f"Unknown cluster strategy: {cluster_strategy}")
         self.model = None
+        self.classifier_head = None  # ResNet50 fc layer, kept for SHARED_BACKBONE
         self.ranker = None
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # Number of images stacked into a single forward pass
+        self.batch_size = batch_size
+        self.mode = mode
+        self.sharpness = SharpnessScorer(mode=sharpness_mode)
+        self.backend = backend
+        self.calibration_images = calibration_images
+        self.cache_dir = cache_dir
+        self.cache = EmbeddingCache(cache_dir, self.model_identity(), dim=2048) if cache_dir else None
+        self.store = EmbeddingStore(store_dir, self.model_identity(), dim=2048, dtype=store_dtype) if store_dir else None
+        self.incremental = incremental
+        self.clusterer = None
+        self.neighbor_index = neighbor_index
+        self.cluster_strategy = cluster_strategy
+        self.prefetch = PrefetchPool(workers=prefetch_workers, kind=prefetch)
         
         # Define image preprocessing transforms
         self.transform = transforms.Compose([
@@ -27,12 +108,19 @@ class PhotoClassifier:
         """Lazy load the ResNet50 model only when needed"""
         if self.model is None:
             print("Loading ResNet50 model...")
-            # Load pre-trained ResNet50 model
-            self.model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
+            # Pre-trained ResNet50, shared with every other user in this process
+            resnet = get_model(RESNET50)
             # Remove the final classification layer to get features
-            self.model = nn.Sequential(*list(self.model.children())[:-1])
-            self.model.eval()  # Set to evaluation mode
-            self.model.to(self.device)
+            backbone = nn.Sequential(*list(resnet.children())[:-1])
+            backbone.eval()  # Set to evaluation mode
+            backbone.to(self.device)
+            calibration = None
+            if self.calibration_images:
+                calibration = calibration_batches(self.calibration_images, self._to_tensor)
+            self.model = compile_module(backbone, self.backend, name=f"resnet50-backbone-{self.backend}",
+                                        calibration=calibration, export_dir=self.cache_dir)
+            # Keep the classification layer so logits can double as a quality signal
+            self.classifier_head = resnet.fc.eval().to(self.device)
             print("ResNet50 model loaded successfully!")
     
     def _load_ranker(self):
@@ -40,17 +128,17 @@ class PhotoClassifier:
         if self.ranker is None:
             print("Loading PhotoRanker...")
             from .photo_ranker import PhotoRanker
-            self.ranker = PhotoRanker()
+            self.ranker = PhotoRanker(cache_dir=self.cache_dir, sharpness=self.sharpness, backend=self.backend,
+                                      calibration_images=self.calibration_images)
             print("PhotoRanker loaded successfully!")
 
+    def _to_tensor(self, img):
+        """Convert a PIL image or image path to a normalized (3, 224, 224) tensor"""
+        return self.transform(load_model_input(img))
+
     def preprocess_image(self, img):
         """Preprocess image for ResNet"""
-        # Ensure image is in RGB format
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Apply transforms
-        img_tensor = self.transform(img)
+        img_tensor = self._to_tensor(img)
         # Add batch dimension
         img_tensor = img_tensor.unsqueeze(0)
         return img_tensor.to(self.device)
@@ -66,7 +154,7 @@ class PhotoClassifier:
             with torch.no_grad():
                 features = self.model(img_tensor)
                 # Flatten the features
-                features = features.view(features.size(0), -1)
+                features = features.reshape(features.size(0), -1)
                 # Convert to numpy array
                 features = features.cpu().numpy().flatten()
             
@@ -75,42 +163,242 @@ class PhotoClassifier:
             print(f"\nError extracting features: {str(e)}")
             return None
 
-    def cluster_images(self, images, eps=0.3, min_samples=2):
-        """Cluster similar images using DBSCAN"""
-        print("\nExtracting features from images...")
-        features = []
-        filenames = []
-        image_dict = {}  # Store images for later ranking
-        
-        # Create progress bar for feature extraction
-        for filename, img in tqdm(images, desc="Extracting features"):
-            try:
-                feature = self.extract_features(img)
-                if feature is not None:
-                    features.append(feature)
-                    filenames.append(filename)
-                    image_dict[filename] = img
-            except Exception as e:
-                print(f"\nError processing {filename}: {str(e)}")
+    def model_identity(self):
+        """Name of the models and preprocessing behind the features and scores"""
+        if self.mode == SHARED_BACKBONE:
+            return f"resnet50-imagenet1k_v1-backbone-p{PREPROCESS_VERSION}-{self.sharpness.mode}-{self.backend}"
+        return (f"resnet50-imagenet1k_v1+mobilenet_v2-imagenet1k_v1-p{PREPROCESS_VERSION}"
+                f"-{self.sharpness.mode}-{self.backend}")
+
+    def _forward(self, batch, score=True):
+        """Run a preprocessed batch, returning pooled features and 0-1 confidence"""
+        features = self.model(batch).flatten(1)
+        if not score:
+            return features, None
+        return features, self.confidence_batch(batch, features)
+
+    def confidence_batch(self, batch, features):
+        """0-1 confidence for a preprocessed batch and its pooled features"""
+        if self.mode == SHARED_BACKBONE:
+            probabilities = F.softmax(self.classifier_head(features), dim=1)
+            return probabilities.max(dim=1).values
+        return self.ranker.confidence_batch(batch)
+
+    def warm_up(self, batch_size=1):
+        """Load the models and run a dummy batch so the first real request skips lazy setup"""
+        self._load_model()
+        if self.mode == SHARED_INPUT:
+            self._load_ranker()
+        with torch.no_grad():
+            self._forward(torch.zeros(batch_size, 3, 224, 224, device=self.device))
+
+    def _engine(self, score=True, batch_size=None):
+        """Build an EmbedScoreEngine around the loaded models"""
+        self._load_model()
+        self._load_ranker()
+        return EmbedScoreEngine(
+            self.transform,
+            lambda batch: self._forward(batch, score=score),
+            self.sharpness,
+            self.device,
+            batch_size=batch_size or self.batch_size,
+            pool=self.prefetch,
+        )
+
+    def extract_features_batch(self, images, batch_size=None):
+        """Extract ResNet features for a list of images in batches
+
+        Returns the (n, 2048) feature matrix and the indices of the input
+        images it covers. Images that fail to preprocess are dropped from
+        their batch instead of failing the whole batch.
+        """
+        result = self._engine(score=False, batch_size=batch_size).process(images, score=False)
+        return result.features, result.kept
+
+    def embed_and_score(self, images, progress=None):
+        """Extract clustering features and quality scores in a single pass
+
+        Returns an EmbedScoreResult whose arrays are aligned with its
+        `kept` list of input indices. With a cache, only images whose
+        content hash is not cached yet are run through the models.
+        """
+        if self.cache is not None:
+            return self._engine().process_cached(images, self.cache, progress=progress)
+        return self._engine().process(images, progress=progress)
+
+    def score_images(self, images):
+        """
+        Quality scores for (name, image) pairs that need no clustering
+        features, e.g. near-duplicate copies, as a {name: score} dict. Only
+        the quality model runs, except in shared_backbone mode, where the
+        scores come from the ResNet50 logits.
+        """
+        images = list(images)
+        if not images:
+            return {}
+        sources = [img for _, img in images]
+        if self.mode == SHARED_BACKBONE:
+            result = self.embed_and_score(sources)
+        else:
+            self._load_ranker()
+            result = self.ranker.score_images(sources)
+        return {images[idx][0]: float(score) for idx, score in zip(result.kept, result.scores.tolist())}
+
+    def store_features(self, images):
+        """Embed the (name, image) pairs missing from the EmbeddingStore and store them; return how many were missing"""
+        missing = [(name, img) for name, img in images if name not in self.store]
+        if missing:
+            result = self.embed_and_score([img for _, img in missing])
+            if result.kept:
+                self.store.put([missing[idx][0] for idx in result.kept], result.features)
+                self.store.flush()
+        return len(missing)
+
+    def similar_photos(self, name, k=10, candidates=None):
+        """
+        The k stored photos whose features are most cosine-similar to
+        `name`'s, best first, as (name, similarity) pairs, optionally only
+        among `candidates`. A search over the EmbeddingStore: no model runs
+        and no DBSCAN. KeyError if `name` has no stored features.
+        """
+        if self.store is None:
+            raise RuntimeError("Similarity search needs an embedding store; pass store_dir")
+        vector = self.store.get([name])[0]
+        with timed('similarity_search', len(self.store)):
+            return self.store.nearest(vector, k, exclude=[name], candidates=candidates)
+
+    def _cluster_incremental(self, keys, features, eps, min_samples, owner=None):
+        """Update the persistent clusterer held by `owner` (the classifier by default) to this image set and return its labels"""
+        owner = self if owner is None else owner
+        clusterer = owner.clusterer
+        if clusterer is None or (clusterer.eps, clusterer.min_samples) != (eps, min_samples):
+            clusterer = owner.clusterer = IncrementalDBSCAN(eps=eps, min_samples=min_samples,
+                                                            index=build_index(self.neighbor_index))
+        return clusterer.sync(keys, features)
+
+    def cluster_images(self, images, eps=0.3, min_samples=2, progress=None, strategy=None, owner=None):
+        """Cluster similar images using DBSCAN
+
+        `images` is a list or any iterable of (name, image) pairs, where an
+        image is a PIL image, a path or a LazyImage; an iterator of lazy
+        handles (utils.load_images) is consumed as the models go, so decoded
+        pixels stay bounded by the batch size rather than the library size.
+        `progress`, if given, is called as progress(stage, done, total) for
+        the 'features', 'clustering' and 'ranking' stages. `strategy`
+        overrides the classifier's cluster_strategy for this call. With
+        incremental clustering, `owner` is any object with a `clusterer`
+        attribute (e.g. a session's Workspace) that keeps the clusterer for
+        its own photos instead of the classifier.
+        """
+        strategy = strategy or self.cluster_strategy
+        if strategy not in CLUSTER_STRATEGIES:
+            raise ValueError(f"Unknown cluster strategy: {strategy}")
+        report = progress or (lambda stage, done, total: None)
+        if strategy == TWO_TIER:
+            return self._cluster_two_tier(images, eps, min_samples, report)
+        print("\nExtracting features and quality scores from images...")
+        total = known_length(images)
+        report('features', 0, total)
+        # Streamed: only names and point keys are kept for images already processed
+        names = []
+        result = self.embed_and_score(stream_images(images, names),
+                                      progress=lambda done, total: report('features', done, total))
         
-        if not features:
+        if not result.kept:
             print("No features extracted from images!")
             return {}
         
-        features = np.array(features)
+        features = result.features
+        filenames = [names[idx][0] for idx in result.kept]
+        if self.store is not None:
+            # Only photos that are new or whose features changed are written again
+            self.store.update(filenames, features)
+            self.store.flush()
+            if self.store.dtype == FLOAT32:
+                # DBSCAN reads the mapped rows, so let the batch copy go. Quantized rows would only be
+                # decoded into another float32 copy; the incremental index keeps its own either way
+                result.features = None
+                features = self.store.get(filenames)
         print(f"\nExtracted features from {len(features)} images")
         print("\nClustering images...")
-        clustering = DBSCAN(eps=eps, min_samples=min_samples, metric='cosine')
-        clusters = clustering.fit_predict(features)
-        
-        # Group images by cluster
-        cluster_groups = {}
-        for idx, cluster_id in enumerate(clusters):
-            if cluster_id not in cluster_groups:
-                cluster_groups[cluster_id] = []
-            cluster_groups[cluster_id].append((filenames[idx], image_dict[filenames[idx]]))
+        report('clustering', 0, len(features))
+        with timed('clustering', len(features)):
+            if self.incremental:
+                clusters = self._cluster_incremental(point_keys(names, result.kept), features, eps, min_samples,
+                                                     owner)
+            else:
+                clusters = dbscan_labels(features, eps, min_samples, kind=self.neighbor_index)
         
-        print(f"Found {len(cluster_groups)} clusters")
-        # Load ranker and rank images within each cluster
+        report('clustering', len(features), len(features))
+        # Group images by cluster and rank them with the scores computed alongside the features
+        with timed('ranking', len(features)):
+            ranked_clusters = rank_clusters_by_score(clusters, filenames, result.scores)
+        report('ranking', len(features), len(features))
+        print(f"Found {len(ranked_clusters)} clusters")
+        return ranked_clusters 
+
+    def _cluster_two_tier(self, images, eps, min_samples, report):
+        """
+        Perceptual-hash groups first, then DBSCAN over deep features of one
+        photo per group and of every ambiguous photo, each weighted by the
+        photos it stands for. Hash-only members take their representative's
+        label and are scored by the quality model alone, so ResNet50 never
+        sees them. Runs DBSCAN afresh rather than through the incremental
+        clusterer.
+        """
+        if self.mode == SHARED_BACKBONE:
+            # Scores there come from the ResNet50 logits, which hash-only photos never get
+            raise ValueError("The two-tier strategy needs the shared_input engine mode")
+        # Hashing and embedding each take their own pass, so the handles are listed once
+        images = list(images)
+        sources = [img for _, img in images]
+        with timed('perceptual_hash', len(images)):
+            dhashes, phashes, hashed = hash_images(sources)
+            hash_labels, hash_ambiguous = hash_groups(dhashes, phashes)
+        # Photos that could not be hashed stand alone and go to the model like ambiguous ones
+        group = np.arange(len(images))
+        needs_deep = np.ones(len(images), dtype=bool)
+        for pos, idx in enumerate(hashed):
+            group[idx] = hashed[hash_labels[pos]]
+            needs_deep[idx] = hash_ambiguous[pos] or hash_labels[pos] == pos
+        deep = np.flatnonzero(needs_deep).tolist()
+        members = np.flatnonzero(~needs_deep).tolist()
+        print(f"\nPerceptual hashes grouped {len(images)} images; {len(deep)} need deep features")
+
+        report('features', 0, len(images))
+        result = self.embed_and_score([sources[idx] for idx in deep],
+                                      progress=lambda done, total: report('features', done, len(images)))
+        deep_kept = [deep[pos] for pos in result.kept]
+        row_of = {idx: row for row, idx in enumerate(deep_kept)}
+        # Members whose representative failed to embed have no cluster to join
+        members = [idx for idx in members if group[idx] in row_of]
         self._load_ranker()
-        return self.ranker.rank_clusters(cluster_groups) 
\ No newline at end of file
+        member_scores = self.ranker.score_images([sources[idx] for idx in members])
+        report('features', len(images), len(images))
+        if not deep_kept:
+            print("No features extracted from images!")
+            return {}
+
+        weights = np.ones(len(deep_kept))
+        for idx in members:
+            weights[row_of[group[idx]]] += 1
+        report('clustering', 0, len(deep_kept))
+        with timed('clustering', len(deep_kept)):
+            deep_labels = dbscan_labels(result.features, eps, min_samples, kind=self.neighbor_index,
+                                        sample_weight=weights)
+        report('clustering', len(deep_kept), len(deep_kept))
+
+        labels = list(deep_labels)
+        filenames = [images[idx][0] for idx in deep_kept]
+        scores = list(result.scores)
+        for pos, score in zip(member_scores.kept, member_scores.scores):
+            idx = members[pos]
+            labels.append(deep_labels[row_of[group[idx]]])
+            filenames.append(images[idx][0])
+            scores.append(score)
+        with timed('ranking', len(labels)):
+            ranked_clusters = rank_clusters_by_score(labels, filenames, scores)
+        report('ranking', len(labels), len(labels))
+        log_event('two_tier_clustering', images=len(images), deep=len(deep), hash_only=len(members))
+        print(f"Found {len(ranked_clusters)} clusters")
+        return ranked_clusters
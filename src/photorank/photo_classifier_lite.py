@@ -1,20 +1,53 @@
 import numpy as np
 import torch
 import torch.nn as nn
-from torchvision import models, transforms
-from sklearn.cluster import DBSCAN
+from torchvision import transforms
 from tqdm import tqdm
 from PIL import Image
-import cv2
+from .embed_score import EmbedScoreEngine, known_length, PREPROCESS_VERSION, combine_quality_score, rank_clusters_by_score
+from .embedding_cache import EmbeddingCache
+from .embedding_store import FLOAT32, EmbeddingStore
+from .image_io import load_model_input
+from .inference import BACKENDS, EAGER, calibration_batches, compile_module
+from .incremental_cluster import IncrementalDBSCAN, point_keys, stream_images
+from .metrics import timed
+from .model_registry import MOBILENET_V2, get_model
+from .neighbor_index import EXACT, INDEX_KINDS, build_index, dbscan_labels
+from .prefetch import PrefetchPool
+from .sharpness import GLOBAL, SharpnessScorer
 
 class PhotoClassifierLite:
     """
     Memory-optimized version for Hobby plan (512MB limit)
     Uses MobileNetV2 for both feature extraction and quality assessment
     """
-    def __init__(self):
+    def __init__(self, batch_size=16, cache_dir=None, incremental=False,
+                 neighbor_index=EXACT, prefetch_workers=None, prefetch=None, sharpness_mode=GLOBAL,
+                 backend=EAGER, calibration_images=None, store_dir=None, store_dtype=None):
+        if neighbor_index not in INDEX_KINDS:
+            raise ValueError(f"Unknown neighbour index: {neighbor_index}")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend}")
         self.model = None
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # Smaller default batch than PhotoClassifier to stay inside the memory budget
+        self.batch_size = batch_size
+        self.sharpness = SharpnessScorer(mode=sharpness_mode)
+        # How the model runs, see inference.BACKENDS
+        self.backend = backend
+        self.calibration_images = calibration_images
+        self.cache_dir = cache_dir
+        # MobileNetV2 feature maps are 1280 x 7 x 7
+        self.cache = EmbeddingCache(cache_dir, self.model_identity(), dim=1280 * 7 * 7) if cache_dir else None
+        # Features of clustered photos by name; FLOAT16 or INT8 rows cut their 245 KB each on disk to a half or a quarter
+        self.store = (EmbeddingStore(store_dir, self.model_identity(), dim=1280 * 7 * 7, dtype=store_dtype)
+                      if store_dir else None)
+        # Keep clustering state between cluster_images calls
+        self.incremental = incremental
+        self.clusterer = None
+        self.neighbor_index = neighbor_index
+        # Decodes upcoming images while the model runs
+        self.prefetch = PrefetchPool(workers=prefetch_workers, kind=prefetch)
         
         # Define image preprocessing transforms
         self.transform = transforms.Compose([
@@ -30,22 +63,27 @@ class PhotoClassifierLite:
         """Lazy load the MobileNetV2 model only when needed"""
         if self.model is None:
             print("Loading MobileNetV2 model (lite version)...")
-            # Use MobileNetV2 for both feature extraction and quality assessment
-            self.model = models.mobilenet_v2(weights=models.MobileNet_V2_Weights.IMAGENET1K_V1)
+            # Use MobileNetV2 for both feature extraction and quality assessment;
+            # the weights are the registry's shared copy
+            mobilenet = get_model(MOBILENET_V2)
             # Remove the final classification layer to get features
-            self.model = nn.Sequential(*list(self.model.children())[:-1])
-            self.model.eval()
-            self.model.to(self.device)
+            features = nn.Sequential(*list(mobilenet.children())[:-1])
+            features.eval()
+            features.to(self.device)
+            calibration = None
+            if self.calibration_images:
+                calibration = calibration_batches(self.calibration_images, self._to_tensor)
+            self.model = compile_module(features, self.backend, name=f"mobilenet_v2-features-{self.backend}",
+                                        calibration=calibration, export_dir=self.cache_dir)
             print("MobileNetV2 model loaded successfully!")
     
+    def _to_tensor(self, img):
+        """Convert a PIL image or image path to a normalized (3, 224, 224) tensor"""
+        return self.transform(load_model_input(img))
+
     def preprocess_image(self, img):
         """Preprocess image for MobileNetV2"""
-        # Ensure image is in RGB format
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Apply transforms
-        img_tensor = self.transform(img)
+        img_tensor = self._to_tensor(img)
         # Add batch dimension
         img_tensor = img_tensor.unsqueeze(0)
         return img_tensor.to(self.device)
@@ -61,7 +99,7 @@ class PhotoClassifierLite:
             with torch.no_grad():
                 features = self.model(img_tensor)
                 # Flatten the features
-                features = features.view(features.size(0), -1)
+                features = features.reshape(features.size(0), -1)
                 # Convert to numpy array
                 features = features.cpu().numpy().flatten()
             
@@ -70,16 +108,60 @@ class PhotoClassifierLite:
             print(f"\nError extracting features: {str(e)}")
             return None
 
+    def model_identity(self):
+        """Name of the model and preprocessing behind the features and scores"""
+        return f"mobilenet_v2-imagenet1k_v1-lite-p{PREPROCESS_VERSION}-{self.sharpness.mode}-{self.backend}"
+
+    def _forward(self, batch, score=True):
+        """Run a preprocessed batch, returning features and feature-magnitude confidence"""
+        features = self.model(batch)
+        if not score:
+            return features, None
+        return features, self.confidence_batch(batch, features)
+
+    def confidence_batch(self, batch, features):
+        """0-1 confidence for a batch, read off the magnitude of its features"""
+        # Higher magnitude = more confident/clear features (typical range 0-50, normalize to 0-1)
+        feature_magnitude = torch.linalg.vector_norm(features.flatten(1), dim=1)
+        return torch.clamp(feature_magnitude / 25.0, max=1.0)
+
+    def warm_up(self, batch_size=1):
+        """Load the model and run a dummy batch so the first real request skips lazy setup"""
+        self._load_model()
+        with torch.no_grad():
+            self._forward(torch.zeros(batch_size, 3, 224, 224, device=self.device))
+
+    def _engine(self, score=True, batch_size=None):
+        """Build an EmbedScoreEngine around the single MobileNetV2 backbone"""
+        self._load_model()
+        return EmbedScoreEngine(
+            self.transform,
+            lambda batch: self._forward(batch, score=score),
+            self.sharpness,
+            self.device,
+            batch_size=batch_size or self.batch_size,
+            pool=self.prefetch,
+        )
+
+    def extract_features_batch(self, images, batch_size=None):
+        """Extract MobileNetV2 features for a list of images in batches
+
+        Returns the feature matrix and the indices of the input images it
+        covers. Images that fail to preprocess are dropped from their batch.
+        """
+        result = self._engine(score=False, batch_size=batch_size).process(images, score=False)
+        return result.features, result.kept
+
+    def embed_and_score(self, images, progress=None):
+        """Extract clustering features and quality scores from one forward pass per image"""
+        if self.cache is not None:
+            return self._engine().process_cached(images, self.cache, progress=progress)
+        return self._engine().process(images, progress=progress)
+
     def calculate_image_sharpness(self, img):
-        """Calculate image sharpness using Laplacian variance"""
+        """Calculate image sharpness using Laplacian variance of its grayscale proxy"""
         try:
-            # Convert PIL image to OpenCV format
-            img_cv = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-            # Convert to grayscale
-            gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-            # Calculate Laplacian variance (measure of sharpness)
-            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
-            return laplacian_var
+            return self.sharpness.score_image(img)
         except Exception as e:
             print(f"Error calculating sharpness: {str(e)}")
             return 0.0
@@ -90,6 +172,9 @@ class PhotoClassifierLite:
             # Load model if not already loaded
             self._load_model()
             
+            # Decode once at reduced resolution for both the network and sharpness
+            img = load_model_input(img)
+            
             # Get neural network confidence score
             img_tensor = self.preprocess_image(img)
             
@@ -105,66 +190,84 @@ class PhotoClassifierLite:
             
             # Get sharpness score
             sharpness = self.calculate_image_sharpness(img)
-            # Normalize sharpness score (typical range 0-2000, normalize to 0-1)
-            normalized_sharpness = min(sharpness / 1000.0, 1.0)
             
             # Combine metrics (weighted average)
-            # 70% neural network confidence, 30% sharpness
-            quality_score = (0.7 * normalized_confidence + 0.3 * normalized_sharpness) * 10
-            
-            return quality_score
+            return combine_quality_score(normalized_confidence, sharpness, self.sharpness.midpoint)
         except Exception as e:
             print(f"\nError processing image: {str(e)}")
             return 0.0
 
-    def cluster_images(self, images, eps=0.3, min_samples=2):
-        """Cluster similar images using DBSCAN"""
-        print("\nExtracting features from images...")
-        features = []
-        filenames = []
-        image_dict = {}  # Store images for later ranking
-        
-        # Create progress bar for feature extraction
-        for filename, img in tqdm(images, desc="Extracting features"):
-            try:
-                feature = self.extract_features(img)
-                if feature is not None:
-                    features.append(feature)
-                    filenames.append(filename)
-                    image_dict[filename] = img
-            except Exception as e:
-                print(f"\nError processing {filename}: {str(e)}")
+    def _cluster_incremental(self, keys, features, eps, min_samples, owner=None):
+        """Update the persistent clusterer held by `owner` (the classifier by default) to this image set and return its labels"""
+        owner = self if owner is None else owner
+        clusterer = owner.clusterer
+        if clusterer is None or (clusterer.eps, clusterer.min_samples) != (eps, min_samples):
+            clusterer = owner.clusterer = IncrementalDBSCAN(eps=eps, min_samples=min_samples,
+                                                            index=build_index(self.neighbor_index))
+        return clusterer.sync(keys, features)
+
+    def cluster_images(self, images, eps=0.3, min_samples=2, progress=None, owner=None):
+        """Cluster similar images using DBSCAN
+
+        `images` is a list or any iterable of (name, image) pairs, where an
+        image is a PIL image, a path or a LazyImage; an iterator of lazy
+        handles (utils.load_images) is consumed as the models go, so decoded
+        pixels stay bounded by the batch size rather than the library size.
+        `progress`, if given, is called as progress(stage, done, total) for
+        the 'features', 'clustering' and 'ranking' stages. With incremental
+        clustering, `owner` is any object with a `clusterer` attribute (e.g.
+        a session's Workspace) that keeps the clusterer for its own photos
+        instead of the classifier.
+        """
+        report = progress or (lambda stage, done, total: None)
+        print("\nExtracting features and quality scores from images...")
+        total = known_length(images)
+        report('features', 0, total)
+        # Streamed: only names and point keys are kept for images already processed
+        names = []
+        result = self.embed_and_score(stream_images(images, names),
+                                      progress=lambda done, total: report('features', done, total))
         
-        if not features:
+        if not result.kept:
             print("No features extracted from images!")
             return {}
         
-        features = np.array(features)
+        features = result.features
+        filenames = [names[idx][0] for idx in result.kept]
+        if self.store is not None:
+            # Only photos that are new or whose features changed are written again
+            self.store.update(filenames, features)
+            self.store.flush()
+            if self.store.dtype == FLOAT32:
+                # DBSCAN reads the mapped rows, so let the batch copy go. Quantized rows would only be
+                # decoded into another float32 copy; the incremental index keeps its own either way
+                result.features = None
+                features = self.store.get(filenames)
         print(f"\nExtracted features from {len(features)} images")
         print("\nClustering images...")
-        clustering = DBSCAN(eps=eps, min_samples=min_samples, metric='cosine')
-        clusters = clustering.fit_predict(features)
-        
-        # Group images by cluster
-        cluster_groups = {}
-        for idx, cluster_id in enumerate(clusters):
-            if cluster_id not in cluster_groups:
-                cluster_groups[cluster_id] = []
-            cluster_groups[cluster_id].append((filenames[idx], image_dict[filenames[idx]]))
+        report('clustering', 0, len(features))
+        with timed('clustering', len(features)):
+            if self.incremental:
+                clusters = self._cluster_incremental(point_keys(names, result.kept), features, eps, min_samples,
+                                                     owner)
+            else:
+                clusters = dbscan_labels(features, eps, min_samples, kind=self.neighbor_index)
         
-        print(f"Found {len(cluster_groups)} clusters")
-        # Rank images within each cluster
-        return self.rank_clusters(cluster_groups)
+        report('clustering', len(features), len(features))
+        # Group images by cluster and rank them with the scores from the same forward pass
+        with timed('ranking', len(features)):
+            ranked_clusters = rank_clusters_by_score(clusters, filenames, result.scores)
+        report('ranking', len(features), len(features))
+        print(f"Found {len(ranked_clusters)} clusters")
+        return ranked_clusters
 
     def rank_images_in_cluster(self, images):
         """Rank images in a cluster based on quality scores"""
-        ranked_images = []
-        for filename, img in images:
-            try:
-                score = self.get_quality_score(img)
-                ranked_images.append((filename, score))
-            except Exception as e:
-                print(f"\nError scoring {filename}: {str(e)}")
+        result = self.embed_and_score([img for _, img in images])
+        
+        # Images that could not be scored rank last with a score of 0
+        scores = dict(zip(result.kept, result.scores.tolist()))
+        ranked_images = [(filename, scores.get(idx, 0.0)) for idx, (filename, _) in enumerate(images)]
         
         # Sort by score in descending order
         ranked_images.sort(key=lambda x: x[1], reverse=True)
@@ -2,13 +2,33 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchvision import models, transforms
+from torchvision import transforms
 from tqdm import tqdm
-import cv2
+from .embed_score import EmbedScoreEngine, combine_quality_score, PREPROCESS_VERSION
+from .embedding_cache import EmbeddingCache
+from .image_io import load_model_input
+from .inference import BACKENDS, EAGER, calibration_batches, compile_module
+from .model_registry import MOBILENET_V2, get_model
+from .sharpness import SharpnessScorer
 
 class PhotoRanker:
-    def __init__(self):
+    def __init__(self, cache_dir=None, sharpness=None, batch_size=32, backend=EAGER, calibration_images=None):
+        """
+        sharpness is the SharpnessScorer to use; PhotoClassifier passes its own so both agree.
+        backend is one of inference.BACKENDS; calibration_images are sample photos for STATIC_INT8.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend}")
         self.model = None
+        self.sharpness = sharpness or SharpnessScorer()
+        self.batch_size = batch_size
+        self.backend = backend
+        self.calibration_images = calibration_images
+        self.cache_dir = cache_dir
+        # Scores only, so the cache holds no feature vectors
+        self.cache = EmbeddingCache(
+            cache_dir, f"mobilenet_v2-quality-p{PREPROCESS_VERSION}-{self.sharpness.mode}-{backend}",
+            dim=0) if cache_dir else None
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         
         # Define image preprocessing transforms
@@ -26,16 +46,20 @@ class PhotoRanker:
         if self.model is None:
             print("Loading image quality model...")
             # Use MobileNetV2 from torchvision for image quality assessment
-            self.model = models.mobilenet_v2(weights=models.MobileNet_V2_Weights.IMAGENET1K_V1)
-            self.model.eval()
-            self.model.to(self.device)
+            model = get_model(MOBILENET_V2)
+            model.to(self.device)
+            calibration = None
+            if self.calibration_images:
+                calibration = calibration_batches(
+                    self.calibration_images, lambda img: self.transform(load_model_input(img)))
+            self.model = compile_module(model, self.backend, name=f"mobilenet_v2-{self.backend}",
+                                        calibration=calibration, export_dir=self.cache_dir)
             print("Image quality model loaded successfully!")
 
     def preprocess_image(self, img):
-        """Preprocess image for the model"""
-        # Ensure image is in RGB format
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
+        """Preprocess a PIL image or image path for the model"""
+        # Reduced-resolution, upright RGB decode
+        img = load_model_input(img)
         
         # Apply transforms
         img_tensor = self.transform(img)
@@ -43,59 +67,74 @@ class PhotoRanker:
         img_tensor = img_tensor.unsqueeze(0)
         return img_tensor.to(self.device)
 
+    def confidence_batch(self, img_tensor):
+        """Max softmax confidence for each image in a preprocessed batch"""
+        self._load_model()
+        with torch.no_grad():
+            predictions = self.model(img_tensor)
+            probabilities = F.softmax(predictions, dim=1)
+            return probabilities.max(dim=1).values
+
     def calculate_image_sharpness(self, img):
-        """Calculate image sharpness using Laplacian variance"""
+        """Calculate image sharpness using Laplacian variance of its grayscale proxy"""
         try:
-            # Convert PIL image to OpenCV format
-            img_cv = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-            # Convert to grayscale
-            gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-            # Calculate Laplacian variance (measure of sharpness)
-            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
-            return laplacian_var
+            return self.sharpness.score_image(img)
         except Exception as e:
             print(f"Error calculating sharpness: {str(e)}")
             return 0.0
 
+    def quality_components(self, img):
+        """Return the (confidence, sharpness) pair behind an image's quality score"""
+        # Load model if not already loaded
+        self._load_model()
+        
+        # Decode once at reduced resolution for both the network and sharpness
+        img = load_model_input(img)
+        
+        # Get neural network confidence score
+        img_tensor = self.preprocess_image(img)
+        # Use the highest confidence as one quality metric
+        max_confidence = self.confidence_batch(img_tensor).item()
+        
+        # Get sharpness score
+        sharpness = self.calculate_image_sharpness(img)
+        return max_confidence, sharpness
+
     def get_quality_score(self, img):
         """Get quality score for an image using multiple metrics"""
         try:
-            # Load model if not already loaded
-            self._load_model()
-            
-            # Get neural network confidence score
-            img_tensor = self.preprocess_image(img)
-            
-            with torch.no_grad():
-                predictions = self.model(img_tensor)
-                # Apply softmax to get probabilities
-                probabilities = F.softmax(predictions, dim=1)
-                # Use the highest confidence as one quality metric
-                max_confidence = torch.max(probabilities).item()
-            
-            # Get sharpness score
-            sharpness = self.calculate_image_sharpness(img)
-            # Normalize sharpness score (typical range 0-2000, normalize to 0-1)
-            normalized_sharpness = min(sharpness / 1000.0, 1.0)
-            
+            max_confidence, sharpness = self.quality_components(img)
             # Combine metrics (weighted average)
-            # 70% neural network confidence, 30% sharpness
-            quality_score = (0.7 * max_confidence + 0.3 * normalized_sharpness) * 10
-            
-            return quality_score
+            return combine_quality_score(max_confidence, sharpness, self.sharpness.midpoint)
         except Exception as e:
             print(f"\nError processing image: {str(e)}")
             return 0.0  # Return 0 score for failed images
 
+    def _engine(self):
+        """EmbedScoreEngine that produces confidence and sharpness, but no features"""
+        self._load_model()
+        return EmbedScoreEngine(
+            self.transform,
+            lambda batch: (batch.new_empty((len(batch), 0)), self.confidence_batch(batch)),
+            self.sharpness,
+            self.device,
+            batch_size=self.batch_size,
+        )
+
+    def score_images(self, images):
+        """Quality scores for PIL images or image paths, as an EmbedScoreResult without features"""
+        engine = self._engine()
+        if self.cache is not None:
+            return engine.process_cached(images, self.cache)
+        return engine.process(images)
+
     def rank_images_in_cluster(self, images):
         """Rank images in a cluster based on quality scores"""
-        ranked_images = []
-        for filename, img in images:
-            try:
-                score = self.get_quality_score(img)
-                ranked_images.append((filename, score))
-            except Exception as e:
-                print(f"\nError scoring {filename}: {str(e)}")
+        result = self.score_images([img for _, img in images])
+        
+        # Images that could not be scored rank last with a score of 0
+        scores = dict(zip(result.kept, result.scores.tolist()))
+        ranked_images = [(filename, scores.get(idx, 0.0)) for idx, (filename, _) in enumerate(images)]
         
         # Sort by score in descending order
         ranked_images.sort(key=lambda x: x[1], reverse=True)
@@ -109,4 +148,6 @@ class PhotoRanker:
             ranked_images = self.rank_images_in_cluster(cluster_images)
             ranked_clusters[cluster_id] = ranked_images
         
+        if self.cache is not None:
+            self.cache.flush()
         return ranked_clusters 
\ No newline at end of file
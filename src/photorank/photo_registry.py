@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+
+from PIL import Image
+
+ORIENTATION_TAG = 0x0112
+# Formats accepted as uploads, by the PIL opener that recognizes the file header
+# (the JPEG opener also covers MPO files from phone cameras)
+UPLOAD_FORMATS = ('JPEG', 'PNG', 'HEIF')
+
+
+class PhotoRecord:
+    """Metadata for one uploaded photo; pixels stay on disk until someone asks for them"""
+    __slots__ = ('id', 'filename', 'filepath', 'size', 'width', 'height', 'format', 'uploaded_at',
+                 'content_hash', 'perceptual_hash', 'duplicate_of')
+
+    def __init__(self, photo_id, filename, filepath, size=0, width=None, height=None, format=None):
+        self.id = photo_id
+        self.filename = filename
+        self.filepath = filepath
+        self.size = size
+        self.width = width
+        self.height = height
+        self.format = format
+        self.uploaded_at = time.time()
+        self.content_hash = None  # SHA-256 of the file's bytes
+        self.perceptual_hash = None  # 64-bit difference hash, set at ingest
+        self.duplicate_of = None  # Id of the photo this one is an exact or near copy of
+
+    @classmethod
+    def from_file(cls, photo_id, filename, filepath, formats=None):
+        """
+        Build a record from a saved upload, reading only the image header.
+        Files that are not one of `formats` (any PIL format by default)
+        raise PIL.UnidentifiedImageError.
+        """
+        with Image.open(filepath, formats=formats) as img:
+            width, height = img.size
+            image_format = img.format
+            # Report the upright size for photos stored rotated
+            if img.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8):
+                width, height = height, width
+        return cls(photo_id, filename, filepath, size=os.path.getsize(filepath),
+                   width=width, height=height, format=image_format)
+
+    @property
+    def url(self):
+        return f"/photos/{self.id}/file"
+
+    def rendition_url(self, name, token=None):
+        """URL of a rendition; `token` (see SessionManager.media_token) lets it load without the session"""
+        url = f"/photos/{self.id}/renditions/{name}"
+        return f"{url}?token={token}" if token else url
+
+    def to_state(self):
+        """Every field, JSON-serializable, for a session backend to persist"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_state(cls, state):
+        record = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(record, name, state.get(name))
+        return record
+
+    def open_image(self):
+        """Open the photo for decoding; use as a context manager so the file is closed afterwards"""
+        return Image.open(self.filepath)
+
+    def to_dict(self, token=None):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'url': self.rendition_url('full', token),
+            'previewUrl': self.rendition_url('medium', token),
+            'thumbnailUrl': self.rendition_url('small', token),
+            'width': self.width,
+            'height': self.height,
+            'duplicateOf': self.duplicate_of
+        }
+
+
+class PhotoRegistry:
+    """
+    Thread-safe collection of PhotoRecords in upload order, indexed by id
+    and by content hash so lookups and removals stay constant time
+    however many photos are held.
+    """
+    def __init__(self):
+        self._records = {}  # id -> record, in upload order
+        self._by_content = {}  # content hash -> {id: None} of the records holding it, in upload order
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self._records[record.id] = record
+            if record.content_hash is not None:
+                self._by_content.setdefault(record.content_hash, {})[record.id] = None
+        return record
+
+    def get(self, photo_id):
+        return self._records.get(photo_id)
+
+    def get_by_content_hash(self, content_hash):
+        """The earliest registered record with this content, or None"""
+        with self._lock:
+            ids = self._by_content.get(content_hash)
+            return self._records[next(iter(ids))] if ids else None
+
+    def remove(self, photo_id):
+        """Remove a record and return it, or None if it is not registered"""
+        with self._lock:
+            record = self._records.pop(photo_id, None)
+            if record is not None and record.content_hash is not None:
+                ids = self._by_content.get(record.content_hash, {})
+                ids.pop(photo_id, None)
+                if not ids:
+                    self._by_content.pop(record.content_hash, None)
+        return record
+
+    def snapshot(self):
+        """Current records as a list that later uploads or deletes won't modify"""
+        with self._lock:
+            return list(self._records.values())
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self.snapshot())
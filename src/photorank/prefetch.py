@@ -0,0 +1,88 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+THREAD = 'thread'
+PROCESS = 'process'
+PREFETCH_KINDS = (THREAD, PROCESS)
+# Items each worker may have finished or in progress ahead of the consumer
+DEPTH_PER_WORKER = 4
+
+
+def default_workers():
+    """PHOTORANK_PREFETCH_WORKERS, else one worker per spare core, at most 4"""
+    configured = os.environ.get('PHOTORANK_PREFETCH_WORKERS')
+    if configured is not None:
+        return int(configured)
+    return max(1, min(4, (os.cpu_count() or 1) - 1))
+
+
+def default_kind():
+    return os.environ.get('PHOTORANK_PREFETCH', THREAD)
+
+
+def _init_process_worker():
+    # Each worker is one of several; let the parent keep torch's thread pool
+    import torch
+    torch.set_num_threads(1)
+
+
+class PrefetchPool:
+    """
+    Worker pool that prepares items ahead of their consumer.
+
+    map() submits at most `depth` items at a time and yields results in
+    input order, so decode and preprocessing overlap with whatever the
+    consumer does between items (model inference) while memory stays
+    bounded by the depth. THREAD workers suit PIL and torchvision, which
+    release the GIL for most of their work; PROCESS workers sidestep the
+    GIL entirely but need picklable functions and items. With 0 workers
+    items are prepared inline.
+    """
+    def __init__(self, workers=None, depth=None, kind=None):
+        kind = kind or default_kind()
+        if kind not in PREFETCH_KINDS:
+            raise ValueError(f"Unknown prefetch kind: {kind}")
+        self.workers = default_workers() if workers is None else workers
+        self.depth = depth or max(1, self.workers) * DEPTH_PER_WORKER
+        self.kind = kind
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == PROCESS:
+                # Forking a process that already runs torch threads can deadlock
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_process_worker)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='photorank-prefetch')
+        return self._executor
+
+    def map(self, fn, items):
+        """Yield fn(item) for each item, in order, with up to `depth` items prepared ahead"""
+        if not self.workers:
+            for item in items:
+                yield fn(item)
+            return
+
+        executor = self._get_executor()
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= self.depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # The consumer stopped early; don't leave work queued behind it
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,74 @@
+import os
+import threading
+
+from .image_io import load_reduced, reduce_to_fit
+
+SMALL = 'small'
+MEDIUM = 'medium'
+FULL = 'full'
+# Longest side in pixels; None keeps the original resolution
+RENDITION_SIZES = {SMALL: 320, MEDIUM: 1280, FULL: None}
+# Formats browsers display natively, served as-is for the full rendition
+WEB_FORMATS = ('JPEG', 'PNG')
+
+
+class RenditionStore:
+    """
+    Downscaled JPEG renditions of uploaded photos, cached on disk under
+    <root>/<photo id>_<name>.jpg. The medium rendition is decoded from the
+    original at a reduced scale and the small one is derived from it, so each
+    upload is decoded once. The full rendition is the original file unless the
+    browser can't display its format (HEIC), in which case it is converted.
+    """
+    def __init__(self, root, quality=85):
+        self.root = root
+        self.quality = quality
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, photo_id, name):
+        return os.path.join(self.root, f"{photo_id}_{name}.jpg")
+
+    def _photo_lock(self, photo_id):
+        with self._lock:
+            return self._locks.setdefault(photo_id, threading.Lock())
+
+    def _save(self, img, path):
+        tmp_path = path + '.tmp'
+        img.save(tmp_path, format='JPEG', quality=self.quality, optimize=True, progressive=True)
+        os.replace(tmp_path, path)
+
+    def generate(self, record):
+        """Write every missing rendition for a PhotoRecord"""
+        with self._photo_lock(record.id):
+            small_path = self.path_for(record.id, SMALL)
+            medium_path = self.path_for(record.id, MEDIUM)
+            if not (os.path.exists(small_path) and os.path.exists(medium_path)):
+                img = load_reduced(record.filepath, RENDITION_SIZES[MEDIUM])
+                self._save(img, medium_path)
+                self._save(reduce_to_fit(img, RENDITION_SIZES[SMALL]), small_path)
+            if record.format not in WEB_FORMATS:
+                full_path = self.path_for(record.id, FULL)
+                if not os.path.exists(full_path):
+                    self._save(load_reduced(record.filepath), full_path)
+
+    def get(self, record, name):
+        """Path of a rendition, generating it first if needed; the original file for web-native full size"""
+        if name not in RENDITION_SIZES:
+            raise ValueError(f"Unknown rendition: {name}")
+        if name == FULL and record.format in WEB_FORMATS:
+            return record.filepath
+        path = self.path_for(record.id, name)
+        if not os.path.exists(path):
+            self.generate(record)
+        return path
+
+    def remove(self, photo_id):
+        """Delete the cached renditions of a photo"""
+        for name in RENDITION_SIZES:
+            path = self.path_for(photo_id, name)
+            if os.path.exists(path):
+                os.remove(path)
+        with self._lock:
+            self._locks.pop(photo_id, None)
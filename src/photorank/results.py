@@ -0,0 +1,197 @@
+"""
+Clustering results serialized once and served as bytes.
+
+Each cluster and each unclustered photo is encoded a single time, per
+format, when first asked for; a response body (the whole result or one
+page of it) is then just those bytes spliced into a container, so polls
+never walk or re-encode the result. Bodies are cached with their ETag and
+compressed variants.
+
+JSON is encoded with orjson when it is installed, msgpack is offered when
+msgpack is installed, and brotli joins gzip when brotli is installed.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CLUSTERS = 'clusters'
+UNCLUSTERED = 'unclustered'
+SECTIONS = (CLUSTERS, UNCLUSTERED)
+GZIP = 'gzip'
+BROTLI = 'br'
+# Smaller bodies are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Response bodies (pages, formats, encodings) kept per result
+BODY_CACHE_ENTRIES = 64
+
+
+def media_types():
+    """Formats this process can serve, preferred first"""
+    return (JSON, MSGPACK) if msgpack is not None else (JSON,)
+
+
+def content_encodings():
+    """Compressions this process can apply, preferred first"""
+    return (BROTLI, GZIP) if brotli is not None else (GZIP,)
+
+
+class _JsonCodec:
+    def encode(self, obj):
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+    def array(self, items):
+        return b'[' + b','.join(items) + b']'
+
+    def map(self, pairs):
+        """An object from (key, already encoded value) pairs"""
+        return b'{' + b','.join(self.encode(key) + b':' + value for key, value in pairs) + b'}'
+
+
+class _MsgpackCodec:
+    def encode(self, obj):
+        return msgpack.packb(obj)
+
+    def array(self, items):
+        return msgpack.Packer().pack_array_header(len(items)) + b''.join(items)
+
+    def map(self, pairs):
+        return msgpack.Packer().pack_map_header(len(pairs)) + b''.join(
+            self.encode(key) + value for key, value in pairs)
+
+
+_CODECS = {JSON: _JsonCodec(), MSGPACK: _MsgpackCodec()}
+
+
+def compress(body, encoding):
+    if encoding == BROTLI:
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+class StaleCursor(Exception):
+    """A page cursor from a result that has since been replaced"""
+
+
+class SerializedResults:
+    """
+    One clustering result ({'clusters': [...], 'unclustered': [...]}) and
+    its encoded forms. `version` identifies the result in cursors and
+    ETags, so a cursor from an older result is refused rather than
+    silently paging through a different one.
+    """
+    def __init__(self, result, version):
+        self.version = str(version)
+        self.sections = {section: result.get(section, []) for section in SECTIONS}
+        self._items = {}  # (media type, section) -> encoded items
+        self._bodies = OrderedDict()  # (media type, section, offset, limit, encoding) -> (body, etag, encoding)
+        self._lock = threading.Lock()
+
+    @property
+    def cluster_count(self):
+        return len(self.sections[CLUSTERS])
+
+    @property
+    def unclustered_count(self):
+        return len(self.sections[UNCLUSTERED])
+
+    def prepare(self, media_type=JSON):
+        """Encode every item up front, e.g. on the job thread, so the first request only splices"""
+        for section in SECTIONS:
+            self._encoded(media_type, section)
+
+    def _encoded(self, media_type, section):
+        key = (media_type, section)
+        items = self._items.get(key)
+        if items is None:
+            codec = _CODECS[media_type]
+            items = self._items[key] = [codec.encode(item) for item in self.sections[section]]
+        return items
+
+    def cursor(self, offset):
+        return base64.urlsafe_b64encode(f"{self.version}:{offset}".encode()).decode().rstrip('=')
+
+    def offset(self, cursor):
+        """Offset a cursor points at; ValueError when it is malformed, StaleCursor when it is outdated"""
+        if not cursor:
+            return 0
+        try:
+            version, offset = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().rsplit(':', 1)
+            offset = int(offset)
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Malformed cursor")
+        if version != self.version:
+            raise StaleCursor("Results changed since this cursor was issued")
+        return max(offset, 0)
+
+    def _page_body(self, media_type, section, offset, limit):
+        codec = _CODECS[media_type]
+        items = self._encoded(media_type, section)
+        if limit is None:
+            # The complete result, in the shape /cluster has always returned
+            return codec.map([(name, codec.array(self._encoded(media_type, name))) for name in SECTIONS])
+        end = min(offset + limit, len(items))
+        next_cursor = self.cursor(end) if end < len(items) else None
+        return codec.map([
+            (section, codec.array(items[offset:end])),
+            ('nextCursor', codec.encode(next_cursor)),
+            ('clusterCount', codec.encode(self.cluster_count)),
+            ('unclusteredCount', codec.encode(self.unclustered_count)),
+        ])
+
+    def body(self, media_type=JSON, section=CLUSTERS, cursor=None, limit=None, encoding=None):
+        """
+        (body, etag, applied encoding) for the whole result (limit None)
+        or one page of a section, in `media_type`, compressed with
+        `encoding` when the body is big enough for that to pay off.
+        """
+        if media_type not in media_types():
+            raise ValueError(f"Unsupported media type: {media_type}")
+        if section not in SECTIONS:
+            raise ValueError(f"Unknown section: {section}")
+        offset = self.offset(cursor)
+        if limit is None:
+            section, offset = CLUSTERS, 0  # One complete body, whatever was asked
+        else:
+            limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        key = (media_type, section, offset, limit, encoding)
+        with self._lock:
+            cached = self._bodies.get(key)
+            if cached is not None:
+                self._bodies.move_to_end(key)
+                return cached
+            plain = self._bodies.get(key[:-1] + (None,))
+        if plain is None:
+            body = self._page_body(media_type, section, offset, limit)
+            plain = (body, f"{self.version}-{hashlib.sha1(body).hexdigest()[:16]}", None)
+        result = plain
+        if encoding is not None and len(plain[0]) >= MIN_COMPRESS_BYTES:
+            # Each representation needs its own strong ETag
+            result = (compress(plain[0], encoding), f"{plain[1]}-{encoding}", encoding)
+        with self._lock:
+            self._bodies[key[:-1] + (None,)] = plain
+            self._bodies[key] = result
+            while len(self._bodies) > BODY_CACHE_ENTRIES:
+                self._bodies.popitem(last=False)
+        return result
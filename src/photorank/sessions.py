@@ -0,0 +1,805 @@
+"""
+Per-session workspaces, so users of one deployment never see or
+overwrite each other's photos and results.
+
+Each browser session gets a Workspace: its own photo registry, duplicate
+index, latest clustering results and upload directory. Workspaces are
+mirrored to a backend (in-process memory, SQLite or Redis) so any worker
+can serve any session; a worker keeps a bounded number of them loaded
+and reloads one when another worker has changed it. Sessions are held to
+a photo count and an upload size, and a session idle for longer than its
+TTL is dropped together with its files.
+
+Photo files and renditions are loaded by <img> tags, which can't send
+the session header, so their URLs carry a token signed for the photo and
+its session instead (SessionManager.media_token).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .dedup import DuplicateIndex
+from .embedding_cache import claim_directory
+from .metrics import log_event
+from .photo_registry import PhotoRecord, PhotoRegistry
+from .results import SerializedResults
+
+try:
+    import redis
+    from redis.exceptions import WatchError
+except ImportError:
+    redis = None
+    WatchError = ()  # Nothing to retry on without redis
+
+MEMORY = 'memory'
+SQLITE = 'sqlite'
+REDIS = 'redis'
+SESSION_BACKENDS = (MEMORY, SQLITE, REDIS)
+# Idle sessions and their uploads are dropped after this many seconds
+DEFAULT_SESSION_TTL = 6 * 60 * 60
+DEFAULT_SESSION_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_SESSION_MAX_PHOTOS = 5000
+# Workspaces a worker keeps in memory when the backend can reload the rest
+DEFAULT_LOADED_SESSIONS = 64
+# Seconds between sweeps for idle sessions
+EVICTION_INTERVAL = 60
+# A session's last-seen time is written at most this often
+TOUCH_INTERVAL = 30
+SESSION_ID_BYTES = 24
+# Jobs a shared backend keeps per session, newest first
+SESSION_JOB_HISTORY = 10
+# Bytes of HMAC-SHA256 kept in a media token
+MEDIA_TOKEN_BYTES = 16
+_SESSION_ID = re.compile(r'[A-Za-z0-9_-]{32}')
+
+
+def default_session_backend():
+    return os.environ.get('PHOTORANK_SESSION_BACKEND', MEMORY)
+
+
+def default_session_url():
+    """SQLite file or Redis URL for the session backend"""
+    return os.environ.get('PHOTORANK_SESSION_URL')
+
+
+def default_session_ttl():
+    return int(os.environ.get('PHOTORANK_SESSION_TTL', DEFAULT_SESSION_TTL))
+
+
+def default_session_max_bytes():
+    return int(os.environ.get('PHOTORANK_SESSION_MAX_BYTES', DEFAULT_SESSION_MAX_BYTES))
+
+
+def default_session_max_photos():
+    return int(os.environ.get('PHOTORANK_SESSION_MAX_PHOTOS', DEFAULT_SESSION_MAX_PHOTOS))
+
+
+def new_session_id():
+    return secrets.token_urlsafe(SESSION_ID_BYTES)
+
+
+def valid_session_id(session_id):
+    # Ids name upload directories; anything else could escape the root
+    return isinstance(session_id, str) and _SESSION_ID.fullmatch(session_id) is not None
+
+
+def load_secret(path):
+    """
+    The key media tokens are signed with: PHOTORANK_SECRET_KEY, else a
+    random key kept in `path` so every worker on the host signs alike
+    (workers on several hosts need the environment variable).
+    """
+    secret = os.environ.get('PHOTORANK_SECRET_KEY')
+    if secret:
+        return secret.encode()
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp_path, path)  # Fails if another worker got there first; then its key is used
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip().encode()
+
+
+class QuotaExceeded(Exception):
+    """An upload would take a session past its photo count or size limit"""
+
+
+class MemoryBackend:
+    """
+    Sessions known to this process only. The loaded workspaces are the
+    state, so this keeps just their versions and last-seen times; it suits
+    a single worker, and everything is gone after a restart.
+    """
+    persistent = False
+
+    def __init__(self):
+        self._sessions = {}  # session id -> [version, last seen, ids of its photos]
+        self._owners = {}  # photo id -> session id
+        self._lock = threading.Lock()
+
+    def create(self, session_id, now):
+        with self._lock:
+            self._sessions[session_id] = [0, now, set()]
+
+    def touch(self, session_id, now):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session[1] = now
+
+    def version(self, session_id):
+        session = self._sessions.get(session_id)
+        return session[0] if session is not None else None
+
+    def load(self, session_id):
+        version = self.version(session_id)
+        return None if version is None else (version, [], None)
+
+    def _bump(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session[0] += 1
+            return session[0]
+
+    def save_photos(self, session_id, states):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                for state in states:
+                    session[2].add(state['id'])
+                    self._owners[state['id']] = session_id
+        return self._bump(session_id)
+
+    def delete_photo(self, session_id, photo_id, updated=()):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session[2].discard(photo_id)
+                self._owners.pop(photo_id, None)
+        return self._bump(session_id)
+
+    def owner(self, photo_id):
+        """Id of the session holding a photo, or None"""
+        return self._owners.get(photo_id)
+
+    def save_result(self, session_id, tag, payload):
+        return self._bump(session_id)
+
+    def idle(self, before):
+        with self._lock:
+            return [session_id for session_id, (_, seen, _) in self._sessions.items() if seen < before]
+
+    def drop(self, session_id, before=None):
+        """Forget a session, unless it was seen at or after `before`; True when it was dropped"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or (before is not None and session[1] >= before):
+                return False
+            del self._sessions[session_id]
+            for photo_id in session[2]:
+                self._owners.pop(photo_id, None)
+            return True
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLiteBackend:
+    """
+    Sessions in a SQLite file that every worker on the host opens, in WAL
+    mode so readers never wait for a writer. Photo records and job states
+    are stored as JSON and results as their encoded /cluster body.
+    """
+    persistent = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+                       "last_seen REAL NOT NULL, result_tag TEXT, result BLOB)")
+            db.execute("CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)")
+            db.execute("CREATE TABLE IF NOT EXISTS photos (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                       "session_id TEXT NOT NULL, id TEXT NOT NULL, state TEXT NOT NULL, UNIQUE (session_id, id))")
+            db.execute("CREATE INDEX IF NOT EXISTS photos_id ON photos (id)")
+            db.execute("CREATE TABLE IF NOT EXISTS jobs (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                       "session_id TEXT NOT NULL, id TEXT NOT NULL UNIQUE, state TEXT NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, seq)")
+
+    @property
+    def _db(self):
+        # Connections can't be shared between threads, so each thread opens its own
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _transaction(self, write=True):
+        return _Transaction(self._db, write)
+
+    def create(self, session_id, now):
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO sessions (id, version, last_seen) VALUES (?, 0, ?)", (session_id, now))
+
+    def touch(self, session_id, now):
+        self._db.execute("UPDATE sessions SET last_seen = ? WHERE id = ?", (now, session_id))
+
+    def version(self, session_id):
+        row = self._db.execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, session_id):
+        """(version, photo states in upload order, (result tag, payload) or None), or None"""
+        with self._transaction(write=False) as db:
+            row = db.execute("SELECT version, result_tag, result FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            states = [json.loads(state) for state, in db.execute(
+                "SELECT state FROM photos WHERE session_id = ? ORDER BY seq", (session_id,))]
+        version, tag, payload = row
+        return version, states, (tag, bytes(payload)) if tag is not None else None
+
+    def _bump(self, db, session_id):
+        row = db.execute("UPDATE sessions SET version = version + 1 WHERE id = ? RETURNING version",
+                         (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_photos(self, session_id, states):
+        with self._transaction() as db:
+            version = self._bump(db, session_id)
+            if version is not None:
+                db.executemany("INSERT INTO photos (session_id, id, state) VALUES (?, ?, ?) "
+                               "ON CONFLICT (session_id, id) DO UPDATE SET state = excluded.state",
+                               [(session_id, state['id'], json.dumps(state)) for state in states])
+        return version
+
+    def delete_photo(self, session_id, photo_id, updated=()):
+        with self._transaction() as db:
+            version = self._bump(db, session_id)
+            if version is not None:
+                db.execute("DELETE FROM photos WHERE session_id = ? AND id = ?", (session_id, photo_id))
+                db.executemany("UPDATE photos SET state = ? WHERE session_id = ? AND id = ?",
+                               [(json.dumps(state), session_id, state['id']) for state in updated])
+        return version
+
+    def save_result(self, session_id, tag, payload):
+        with self._transaction() as db:
+            version = self._bump(db, session_id)
+            if version is not None:
+                db.execute("UPDATE sessions SET result_tag = ?, result = ? WHERE id = ?",
+                           (tag, sqlite3.Binary(payload), session_id))
+        return version
+
+    def save_job(self, session_id, job_id, state):
+        """Store a job's latest state, keeping the session's SESSION_JOB_HISTORY newest jobs"""
+        with self._transaction() as db:
+            cursor = db.execute("INSERT INTO jobs (session_id, id, state) SELECT ?, ?, ? "
+                                "WHERE EXISTS (SELECT 1 FROM sessions WHERE id = ?) "
+                                "ON CONFLICT (id) DO UPDATE SET state = excluded.state",
+                                (session_id, job_id, json.dumps(state), session_id))
+            if cursor.rowcount:
+                db.execute("DELETE FROM jobs WHERE session_id = ? AND seq <= (SELECT seq FROM jobs "
+                           "WHERE session_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                           (session_id, session_id, SESSION_JOB_HISTORY))
+
+    def load_job(self, session_id, job_id=None):
+        """State of one of the session's jobs, or of its latest when job_id is None; None if unknown"""
+        if job_id is None:
+            row = self._db.execute("SELECT state FROM jobs WHERE session_id = ? ORDER BY seq DESC LIMIT 1",
+                                   (session_id,)).fetchone()
+        else:
+            row = self._db.execute("SELECT state FROM jobs WHERE session_id = ? AND id = ?",
+                                   (session_id, job_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def owner(self, photo_id):
+        row = self._db.execute("SELECT session_id FROM photos WHERE id = ? LIMIT 1", (photo_id,)).fetchone()
+        return row[0] if row else None
+
+    def idle(self, before):
+        return [row[0] for row in self._db.execute("SELECT id FROM sessions WHERE last_seen < ?", (before,))]
+
+    def drop(self, session_id, before=None):
+        with self._transaction() as db:
+            cursor = db.execute("DELETE FROM sessions WHERE id = ? AND last_seen < ?",
+                                (session_id, float('inf') if before is None else before))
+            if cursor.rowcount:
+                db.execute("DELETE FROM photos WHERE session_id = ?", (session_id,))
+                db.execute("DELETE FROM jobs WHERE session_id = ?", (session_id,))
+        return cursor.rowcount > 0
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class _Transaction:
+    """
+    BEGIN ... COMMIT on a connection in autocommit mode, rolled back on
+    error. Writers take the lock up front (IMMEDIATE) so two of them never
+    deadlock upgrading a read lock.
+    """
+    def __init__(self, db, write=True):
+        self.db = db
+        self.write = write
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE" if self.write else "BEGIN")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class RedisBackend:
+    """
+    Sessions in Redis, shared by workers on any number of hosts. Each
+    session is a hash (version, last seen, result) next to a hash of its
+    photo records and one of its job states (with a sorted set ordering
+    the jobs), a sorted set orders sessions by last-seen time, and one
+    more hash maps photo ids to their session.
+    `client` may be any redis-py compatible client, e.g. fakeredis for a
+    local stand-in.
+    """
+    persistent = True
+
+    def __init__(self, url=None, client=None, prefix='photorank:'):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis session backend needs redis: pip install redis")
+            client = redis.Redis.from_url(url or 'redis://localhost:6379/0')
+        self.client = client
+        self.prefix = prefix
+        self._seen_key = prefix + 'last_seen'
+        self._owners_key = prefix + 'owners'
+
+    def _session_key(self, session_id):
+        return f"{self.prefix}session:{session_id}"
+
+    def _photos_key(self, session_id):
+        return f"{self.prefix}photos:{session_id}"
+
+    def _jobs_key(self, session_id):
+        return f"{self.prefix}jobs:{session_id}"
+
+    def _job_order_key(self, session_id):
+        return f"{self.prefix}job_order:{session_id}"
+
+    def create(self, session_id, now):
+        pipe = self.client.pipeline()
+        pipe.hsetnx(self._session_key(session_id), 'version', 0)
+        pipe.zadd(self._seen_key, {session_id: now})
+        pipe.execute()
+
+    def touch(self, session_id, now):
+        # xx: only sessions that still exist
+        self.client.zadd(self._seen_key, {session_id: now}, xx=True)
+
+    def version(self, session_id):
+        version = self.client.hget(self._session_key(session_id), 'version')
+        return int(version) if version is not None else None
+
+    def load(self, session_id):
+        pipe = self.client.pipeline()  # MULTI/EXEC, so the three reads agree
+        pipe.hmget(self._session_key(session_id), 'version', 'result_tag', 'result')
+        pipe.hvals(self._photos_key(session_id))
+        (version, tag, payload), states = pipe.execute()
+        if version is None:
+            return None
+        states = sorted((json.loads(state) for state in states), key=lambda state: state['uploaded_at'])
+        result = (tag.decode() if isinstance(tag, bytes) else tag, payload) if tag is not None else None
+        return int(version), states, result
+
+    def _update(self, session_id, write, bump=True):
+        """Run `write(pipe)` and bump the version atomically, if the session still exists"""
+        key = self._session_key(session_id)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    if not pipe.exists(key):
+                        pipe.unwatch()
+                        return None
+                    pipe.multi()
+                    write(pipe)
+                    if not bump:
+                        pipe.execute()
+                        return None
+                    pipe.hincrby(key, 'version', 1)
+                    return int(pipe.execute()[-1])
+                except WatchError:
+                    continue  # Changed between WATCH and EXEC
+
+    def save_photos(self, session_id, states):
+        key = self._photos_key(session_id)
+
+        def write(pipe):
+            if states:
+                pipe.hset(key, mapping={state['id']: json.dumps(state) for state in states})
+                pipe.hset(self._owners_key, mapping={state['id']: session_id for state in states})
+        return self._update(session_id, write)
+
+    def delete_photo(self, session_id, photo_id, updated=()):
+        key = self._photos_key(session_id)
+
+        def write(pipe):
+            pipe.hdel(key, photo_id)
+            pipe.hdel(self._owners_key, photo_id)
+            if updated:
+                pipe.hset(key, mapping={state['id']: json.dumps(state) for state in updated})
+        return self._update(session_id, write)
+
+    def save_result(self, session_id, tag, payload):
+        key = self._session_key(session_id)
+        return self._update(session_id, lambda pipe: pipe.hset(key, mapping={'result_tag': tag, 'result': payload}))
+
+    def save_job(self, session_id, job_id, state):
+        jobs_key, order_key = self._jobs_key(session_id), self._job_order_key(session_id)
+
+        def write(pipe):
+            pipe.hset(jobs_key, job_id, json.dumps(state))
+            pipe.zadd(order_key, {job_id: time.time()}, nx=True)  # nx: ordered by first save
+        # Job states aren't workspace state, so workers keep their loaded copies
+        self._update(session_id, write, bump=False)
+        stale = self.client.zrange(order_key, 0, -SESSION_JOB_HISTORY - 1)
+        if stale:
+            pipe = self.client.pipeline()
+            pipe.zrem(order_key, *stale)
+            pipe.hdel(jobs_key, *stale)
+            pipe.execute()
+
+    def load_job(self, session_id, job_id=None):
+        if job_id is None:
+            latest = self.client.zrange(self._job_order_key(session_id), -1, -1)
+            if not latest:
+                return None
+            job_id = latest[0]
+        state = self.client.hget(self._jobs_key(session_id), job_id)
+        return json.loads(state) if state is not None else None
+
+    def owner(self, photo_id):
+        session_id = self.client.hget(self._owners_key, photo_id)
+        return session_id.decode() if isinstance(session_id, bytes) else session_id
+
+    def idle(self, before):
+        return [session_id.decode() if isinstance(session_id, bytes) else session_id
+                for session_id in self.client.zrangebyscore(self._seen_key, '-inf', f"({before}")]
+
+    def drop(self, session_id, before=None):
+        seen = self.client.zscore(self._seen_key, session_id)
+        if before is not None and seen is not None and seen >= before:
+            return False
+        photo_ids = self.client.hkeys(self._photos_key(session_id))
+        pipe = self.client.pipeline()
+        pipe.delete(self._session_key(session_id), self._photos_key(session_id),
+                    self._jobs_key(session_id), self._job_order_key(session_id))
+        pipe.zrem(self._seen_key, session_id)
+        if photo_ids:
+            pipe.hdel(self._owners_key, *photo_ids)
+        return bool(pipe.execute()[0])
+
+    def __len__(self):
+        return self.client.zcard(self._seen_key)
+
+
+def build_backend(kind=None, url=None, root=None):
+    """A session backend by name; SQLite defaults to <root>/sessions.sqlite3"""
+    kind = kind or default_session_backend()
+    url = url or default_session_url()
+    if kind == MEMORY:
+        return MemoryBackend()
+    if kind == SQLITE:
+        return SQLiteBackend(url or os.path.join(root or '.', 'sessions.sqlite3'))
+    if kind == REDIS:
+        return RedisBackend(url)
+    raise ValueError(f"Unknown session backend: {kind}")
+
+
+class Workspace:
+    """One session's photos, duplicate index, latest results and upload directory"""
+    def __init__(self, session_id, directory):
+        self.id = session_id
+        self.directory = directory
+        self.photos = PhotoRegistry()
+        # Identical uploads share one file; exact and near duplicates skip the models
+        self.duplicates = DuplicateIndex()
+        self.results = None  # SerializedResults of the latest finished job
+        # IncrementalDBSCAN over the photos of the latest job, so sessions never share clusters
+        self.clusterer = None
+        self.bytes_used = 0  # Size of the distinct files the photos point at
+        self.version = 0  # Backend version this workspace reflects
+        self.touched = 0.0
+        self.lock = threading.Lock()  # Held while the photos change
+
+
+class SessionManager:
+    """
+    Session ids to workspaces, mirrored to `backend`. Changes go through
+    add_photo, remove_photo, save_photos and save_results so the backend
+    stays in step; a worker whose copy of a workspace falls behind the
+    backend's version reloads it on the next get().
+
+    `on_evict(session_id, photo_ids)` is called after an idle session is
+    dropped, for state kept outside the workspace (renditions, stored
+    embeddings). `secret` signs media tokens; a random key unless given.
+
+    Upload directories sit in `upload_root` when the backend is shared.
+    A memory backend only knows this process's sessions, so the process
+    claims a worker-N directory of its own under it (see
+    claim_directory) and sweeps nothing else for orphans.
+    """
+    def __init__(self, backend, upload_root, ttl=None, max_bytes=None, max_photos=None,
+                 loaded=DEFAULT_LOADED_SESSIONS, on_evict=None, secret=None):
+        self.backend = backend
+        self.secret = secret or secrets.token_bytes(32)
+        self.root = upload_root
+        self._upload_root = None
+        self._claim = None
+        self.ttl = default_session_ttl() if ttl is None else ttl
+        self.max_bytes = default_session_max_bytes() if max_bytes is None else max_bytes
+        self.max_photos = default_session_max_photos() if max_photos is None else max_photos
+        self.loaded = loaded
+        self.on_evict = on_evict
+        self._workspaces = OrderedDict()  # session id -> Workspace, least recently used first
+        self._lock = threading.Lock()
+        self._last_eviction = 0.0
+        self._evictor = None
+        os.makedirs(upload_root, exist_ok=True)
+
+    @property
+    def upload_root(self):
+        """Directory holding this process's session directories, claimed on first use so forked workers claim their own"""
+        with self._lock:
+            if self._upload_root is None:
+                if self.backend.persistent:
+                    self._upload_root = self.root
+                else:
+                    self._upload_root, self._claim = claim_directory(self.root, MEMORY)
+            return self._upload_root
+
+    def create(self):
+        """A new, empty session's workspace"""
+        session_id = new_session_id()
+        now = time.time()
+        self.backend.create(session_id, now)
+        workspace = Workspace(session_id, os.path.join(self.upload_root, session_id))
+        workspace.touched = now
+        self._keep(workspace)
+        return workspace
+
+    def get(self, session_id):
+        """The session's workspace, reloaded if another worker changed it; None for unknown or expired ids"""
+        if not valid_session_id(session_id):
+            return None
+        with self._lock:
+            workspace = self._workspaces.get(session_id)
+            if workspace is not None:
+                self._workspaces.move_to_end(session_id)
+        if workspace is None or self.backend.persistent:
+            version = self.backend.version(session_id)
+            if version is None:
+                self._forget(session_id)  # Evicted, possibly by another worker
+                return None
+            if workspace is None or workspace.version != version:
+                previous, workspace = workspace, self._load(session_id)
+                if workspace is None:
+                    return None
+                if previous is not None:
+                    # The clusterer syncs to whatever photos the next job brings
+                    workspace.clusterer = previous.clusterer
+        now = time.time()
+        if now - workspace.touched >= TOUCH_INTERVAL:
+            self.backend.touch(session_id, now)
+            workspace.touched = now
+        return workspace
+
+    def media_token(self, session_id, photo_id):
+        """Token that lets a URL fetch one photo's file and renditions without the session id"""
+        digest = hmac.new(self.secret, f"{session_id}:{photo_id}".encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:MEDIA_TOKEN_BYTES]).decode().rstrip('=')
+
+    def find_photo(self, photo_id, token):
+        """(workspace, record) of a photo in any session, given its media token; (None, None) otherwise"""
+        session_id = self.backend.owner(photo_id)
+        if session_id is None or not hmac.compare_digest(self.media_token(session_id, photo_id), token or ''):
+            return None, None
+        workspace = self.get(session_id)
+        record = workspace.photos.get(photo_id) if workspace is not None else None
+        return (workspace, record) if record is not None else (None, None)
+
+    def _load(self, session_id):
+        state = self.backend.load(session_id)
+        if state is None:
+            return None
+        version, photo_states, result = state
+        workspace = Workspace(session_id, os.path.join(self.upload_root, session_id))
+        workspace.version = version
+        stored = set()
+        for photo_state in photo_states:
+            record = PhotoRecord.from_state(photo_state)
+            workspace.duplicates.restore(record)
+            workspace.photos.add(record)
+            if record.filepath not in stored:
+                stored.add(record.filepath)
+                workspace.bytes_used += record.size or 0
+        if result is not None:
+            tag, payload = result
+            workspace.results = SerializedResults(json.loads(payload), version=tag)
+        self._keep(workspace)
+        return workspace
+
+    def _keep(self, workspace):
+        with self._lock:
+            self._workspaces[workspace.id] = workspace
+            self._workspaces.move_to_end(workspace.id)
+            # Only a backend that holds the state lets a workspace be unloaded
+            while self.backend.persistent and len(self._workspaces) > self.loaded:
+                self._workspaces.popitem(last=False)
+
+    def _forget(self, session_id):
+        with self._lock:
+            return self._workspaces.pop(session_id, None)
+
+    def _advance(self, workspace, version):
+        """Record the version a change moved the backend to; a gap means another worker changed it too"""
+        if version is not None and version == workspace.version + 1:
+            workspace.version = version
+        else:
+            workspace.version = -1  # Reloaded on the next get()
+
+    def check_quota(self, workspace, incoming_bytes=0, incoming_photos=1):
+        """Raise QuotaExceeded if the session can't take this much more"""
+        if len(workspace.photos) + incoming_photos > self.max_photos:
+            raise QuotaExceeded(f"Sessions are limited to {self.max_photos} photos")
+        if workspace.bytes_used + incoming_bytes > self.max_bytes:
+            raise QuotaExceeded(f"Sessions are limited to {self.max_bytes} bytes of uploads")
+
+    def add_photo(self, workspace, record):
+        """
+        Register a stored upload in the session, sharing the file of
+        identical content. QuotaExceeded leaves the file for the caller to
+        remove.
+        """
+        with workspace.lock:
+            shared = workspace.duplicates.holds(record.content_hash)
+            self.check_quota(workspace, 0 if shared else record.size)
+            workspace.duplicates.store(record)
+            if not shared:
+                workspace.bytes_used += record.size
+            workspace.photos.add(record)
+            self._advance(workspace, self.backend.save_photos(workspace.id, [record.to_state()]))
+        return record
+
+    def remove_photo(self, workspace, photo_id):
+        """Drop a photo and, once no other photo shares it, its file; the removed record, or None"""
+        with workspace.lock:
+            photo = workspace.photos.remove(photo_id)
+            if photo is None:
+                return None
+            # Copies left behind stand in for the deleted photo
+            successor = workspace.duplicates.reassign(photo, workspace.photos.get)
+            if workspace.duplicates.release(photo):
+                workspace.bytes_used -= photo.size or 0
+                if os.path.exists(photo.filepath):
+                    os.remove(photo.filepath)
+            updated = []
+            if successor is not None:
+                updated = [record.to_state() for record in workspace.photos
+                           if record is successor or record.duplicate_of == successor.id]
+            self._advance(workspace, self.backend.delete_photo(workspace.id, photo_id, updated))
+        return photo
+
+    def save_photos(self, workspace, records):
+        """Persist records changed in place, e.g. given perceptual hashes by a job"""
+        if not self.backend.persistent or not records:
+            return
+        with workspace.lock:
+            self._advance(workspace, self.backend.save_photos(workspace.id, [record.to_state() for record in records]))
+
+    def save_job(self, session_id, job_id, state):
+        """Share a job's to_dict() state with the other workers; nothing to share without a persistent backend"""
+        if self.backend.persistent:
+            self.backend.save_job(session_id, job_id, state)
+
+    def load_job(self, session_id, job_id=None):
+        """A job's state as some worker last saved it (the latest job's without job_id), or None"""
+        return self.backend.load_job(session_id, job_id) if self.backend.persistent else None
+
+    def save_results(self, workspace, results):
+        """Make `results` the session's latest and persist them"""
+        payload = results.body()[0] if self.backend.persistent else None
+        with workspace.lock:
+            workspace.results = results
+            self._advance(workspace, self.backend.save_result(workspace.id, results.version, payload))
+
+    def evict_idle(self, now=None):
+        """
+        Drop sessions idle for longer than the TTL with their uploads, at
+        most once per EVICTION_INTERVAL; returns how many were dropped.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if now - self._last_eviction < EVICTION_INTERVAL:
+                return 0
+            self._last_eviction = now
+        cutoff = now - self.ttl
+        evicted = 0
+        for session_id in self.backend.idle(cutoff):
+            state = self.backend.load(session_id) if self.backend.persistent else None
+            if not self.backend.drop(session_id, before=cutoff):
+                continue  # Seen again meanwhile
+            workspace = self._forget(session_id)
+            if workspace is not None:
+                workspace.clusterer = None  # A job still holding the workspace may not keep it either
+                photo_ids = [record.id for record in workspace.photos]
+            else:
+                photo_ids = [photo_state['id'] for photo_state in state[1]] if state else []
+            shutil.rmtree(os.path.join(self.upload_root, session_id), ignore_errors=True)
+            if self.on_evict is not None:
+                self.on_evict(session_id, photo_ids)
+            log_event('session_evicted', session=session_id, photos=len(photo_ids))
+            evicted += 1
+        self._sweep_orphans(cutoff)
+        return evicted
+
+    def start_eviction(self):
+        """Run evict_idle every EVICTION_INTERVAL on a daemon thread; started once per process, so call it after forking"""
+        if self._evictor is not None:
+            return
+        with self._lock:
+            if self._evictor is None:
+                self._evictor = threading.Thread(target=self._evict_forever, name='photorank-eviction', daemon=True)
+                self._evictor.start()
+
+    def _evict_forever(self):
+        while True:
+            time.sleep(EVICTION_INTERVAL)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                log_event('session_eviction_failed', logging.WARNING, error=str(e))
+
+    def _sweep_orphans(self, cutoff):
+        """
+        Remove upload directories of sessions the backend no longer knows,
+        e.g. after a restart; with a memory backend, only those in the
+        directory this process claimed.
+        """
+        for entry in os.scandir(self.upload_root):
+            try:
+                if (entry.is_dir() and valid_session_id(entry.name) and entry.stat().st_mtime < cutoff
+                        and self.backend.version(entry.name) is None):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self.backend)
+
+    def loaded_photos(self):
+        """Photo records held in memory across the loaded workspaces"""
+        with self._lock:
+            workspaces = list(self._workspaces.values())
+        return sum(len(workspace.photos) for workspace in workspaces)
@@ -0,0 +1,261 @@
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import Request, current_app
+
+from .dedup import HashingFile
+from .metrics import log_event, timed
+
+# Bytes read from a request body at a time
+CHUNK_SIZE = 1024 * 1024
+# Unfinished resumable uploads are dropped after a day without progress
+STALE_UPLOAD_SECONDS = 24 * 60 * 60
+
+
+class StreamingRequest(Request):
+    """
+    Request that writes multipart file parts straight to files in the
+    app's UPLOAD_SPOOL_FOLDER as they are parsed, instead of memory or a
+    system temp file, hashing the bytes on the way. A part is then moved
+    into place with a rename (save_upload), so memory stays flat however
+    large the batch is. Parts nobody claimed are removed by discard_spooled().
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool_dir = current_app.config.get('UPLOAD_SPOOL_FOLDER')
+        if not spool_dir:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        stream = HashingFile(tempfile.NamedTemporaryFile(dir=spool_dir, prefix='part-', delete=False))
+        if not hasattr(self, '_spooled'):
+            self._spooled = []
+        self._spooled.append(stream)
+        return stream
+
+    def discard_spooled(self):
+        for stream in getattr(self, '_spooled', ()):
+            stream.close()
+            try:
+                os.remove(stream.name)
+            except FileNotFoundError:
+                pass  # Claimed by save_upload
+
+
+def save_upload(file, path):
+    """
+    Move an uploaded FileStorage to `path`; a spooled part is renamed
+    rather than copied. Returns the SHA-256 of its content when the part
+    was hashed while spooling, else None.
+    """
+    stream = file.stream
+    name = getattr(stream, 'name', None)
+    spool_dir = current_app.config.get('UPLOAD_SPOOL_FOLDER')
+    if spool_dir and isinstance(name, str) and os.path.dirname(name) == spool_dir:
+        stream.close()
+        os.replace(name, path)
+        return stream.hexdigest() if isinstance(stream, HashingFile) else None
+    file.save(path)
+    return None
+
+
+class OffsetMismatch(Exception):
+    """A chunk was sent for an offset other than where the upload stands"""
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+class ResumableUploads:
+    """
+    Chunked, resumable uploads in the style of the tus protocol. A client
+    declares a file and its size, then appends chunks at the current
+    offset; after an interruption it asks for the offset and carries on
+    from there. The partial file's length is the offset, and it sits in
+    `root` next to a small metadata file, so uploads survive a restart.
+    """
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _paths(self, upload_id):
+        # Ids are uuid4 hex strings; anything else could escape the root
+        if len(upload_id) != 32 or not all(c in '0123456789abcdef' for c in upload_id):
+            return None, None
+        base = os.path.join(self.root, upload_id)
+        return base + '.part', base + '.json'
+
+    def _lock(self, upload_id):
+        with self._locks_guard:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    def create(self, filename, size, owner=None):
+        """Declare an upload; `owner` (a session id) is kept so only its session can continue it"""
+        if size < 0 or size > self.max_size:
+            raise ValueError(f"Uploads are limited to {self.max_size} bytes")
+        self.discard_stale()
+        upload_id = uuid.uuid4().hex
+        part_path, meta_path = self._paths(upload_id)
+        open(part_path, 'wb').close()
+        with open(meta_path, 'w') as f:
+            json.dump({'filename': filename, 'size': size, 'created': time.time(), 'owner': owner}, f)
+        return self.get(upload_id)
+
+    def get(self, upload_id):
+        """The upload's id, filename, size and current offset, or None"""
+        part_path, meta_path = self._paths(upload_id)
+        if part_path is None or not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta.update(id=upload_id, offset=os.path.getsize(part_path))
+        return meta
+
+    def append(self, upload_id, offset, stream):
+        """Write a chunk read from `stream` at `offset`; return the upload after the write"""
+        with self._lock(upload_id):
+            upload = self.get(upload_id)
+            if upload is None:
+                raise KeyError(upload_id)
+            if offset != upload['offset']:
+                raise OffsetMismatch(upload['offset'])
+            part_path, _ = self._paths(upload_id)
+            remaining = upload['size'] - offset
+            with open(part_path, 'ab') as f, timed('upload_write'):
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if len(chunk) > remaining:
+                        # Keep what fits so the client can see where it stands
+                        f.write(chunk[:remaining])
+                        raise ValueError("Chunk runs past the declared upload size")
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            return self.get(upload_id)
+
+    def finish(self, upload_id, path):
+        """Move a complete upload to `path` and forget it"""
+        with self._lock(upload_id):
+            part_path, meta_path = self._paths(upload_id)
+            os.replace(part_path, path)
+            os.remove(meta_path)
+        with self._locks_guard:
+            self._locks.pop(upload_id, None)
+
+    def abort(self, upload_id):
+        part_path, meta_path = self._paths(upload_id)
+        if part_path is None:
+            return False
+        found = False
+        for path in (part_path, meta_path):
+            try:
+                os.remove(path)
+                found = True
+            except FileNotFoundError:
+                pass
+        with self._locks_guard:
+            self._locks.pop(upload_id, None)
+        return found
+
+    def discard_stale(self, max_age=STALE_UPLOAD_SECONDS):
+        """Remove uploads that made no progress for `max_age` seconds"""
+        cutoff = time.time() - max_age
+        for name in os.listdir(self.root):
+            if name.endswith('.part'):
+                path = os.path.join(self.root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        self.abort(name[:-len('.part')])
+                except FileNotFoundError:
+                    pass
+
+
+class IngestQueue:
+    """
+    Background preprocessing for photos as soon as they land: duplicate
+    flagging against `dedup` (a DuplicateIndex, or the one the photo was
+    submitted with) and renditions first,
+    then, a batch at a time, `embed(records)` for the distinct photos
+    (typically filling the embedding cache so /process finds the work
+    already done). A single daemon thread drains the queue, so uploads
+    return right away.
+    """
+    def __init__(self, renditions, embed=None, dedup=None, batch_size=16):
+        self.renditions = renditions
+        self.embed = embed
+        self.dedup = dedup
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._queued = {}  # photo id -> how many submissions are waiting or running
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, record, dedup=None):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='photorank-ingest', daemon=True)
+                self._thread.start()
+            self._queued[record.id] = self._queued.get(record.id, 0) + 1
+        self._queue.put((record, dedup or self.dedup))
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def queued(self, photo_id):
+        """Whether a photo is still waiting for or going through preprocessing"""
+        with self._start_lock:
+            return photo_id in self._queued
+
+    def join(self):
+        """Block until every submitted photo has been preprocessed"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._process(batch)
+            finally:
+                with self._start_lock:
+                    for record, _ in batch:
+                        if self._queued[record.id] > 1:
+                            self._queued[record.id] -= 1
+                        else:
+                            del self._queued[record.id]
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _process(self, batch):
+        batch = [(record, dedup) for record, dedup in batch if os.path.exists(record.filepath)]  # Deleted meanwhile
+        for record, dedup in batch:
+            if dedup is not None:
+                try:
+                    with timed('dedup'):
+                        dedup.flag(record)
+                except Exception as e:
+                    # Left unhashed; /process flags it again before clustering
+                    log_event('dedup_failed', logging.WARNING, filename=record.filename, error=str(e))
+            try:
+                with timed('renditions'):
+                    self.renditions.generate(record)
+            except Exception as e:
+                # Served requests retry the generation
+                log_event('rendition_failed', logging.WARNING, filename=record.filename, error=str(e))
+        batch = [record for record, _ in batch if record.duplicate_of is None]
+        if self.embed is not None and batch:
+            try:
+                self.embed(batch)
+            except Exception as e:
+                log_event('ingest_embed_failed', logging.WARNING, photos=len(batch), error=str(e))
@@ -1,27 +1,21 @@
 import os
-from PIL import Image
-from pillow_heif import register_heif_opener
-from tqdm import tqdm
+from .image_io import LazyImage
 
-# Register HEIF opener
-register_heif_opener()
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.heic')
 
 def load_images(directory):
-    """Load all images from a directory"""
-    images = []
-    # Get list of image files first
-    image_files = [f for f in os.listdir(directory) 
-                  if f.lower().endswith(('.png', '.jpg', '.jpeg', '.heic'))]
-    
-    print("\nLoading images...")
-    for filename in tqdm(image_files, desc="Loading images"):
-        try:
-            image_path = os.path.join(directory, filename)
-            img = Image.open(image_path)
-            images.append((filename, img))
-        except Exception as e:
-            print(f"\nCould not load {filename}: {str(e)}")
-    return images
+    """Yield (filename, LazyImage) for each image in a directory
+
+    Nothing is opened here: each handle is decoded only while a classifier
+    processes it and closed again right after, so any number of photos can
+    be streamed through without holding file descriptors or pixels for all
+    of them. Files that turn out not to be images are skipped (and logged)
+    when they are processed.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                yield entry.name, LazyImage(entry.path)
 
 def display_clusters(cluster_groups):
     """Display clustering and ranking results"""
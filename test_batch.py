@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Batch runs: CPU pinning, and resuming from the checkpoint manifest
+"""
+import json
+import os
+
+import pytest
+
+from photorank import batch
+from photorank.batch import Manifest, walk_images, worker_cpus, write_failures
+
+SETTINGS = {'classifier': 'full', 'backend': 'eager', 'format': 'jsonl', 'roots': ['/archive']}
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_getaffinity'), reason="CPU affinity is Linux-only")
+def test_every_worker_gets_as_many_cpus_as_threads(monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3, 4, 5})
+    assert [sorted(worker_cpus(worker, 4)) for worker in range(3)] == [[0, 1, 2, 3], [0, 1, 4, 5], [2, 3, 4, 5]]
+    assert [sorted(worker_cpus(worker, 2)) for worker in range(4)] == [[0, 1], [2, 3], [4, 5], [0, 1]]
+    assert worker_cpus(0, 8) == {0, 1, 2, 3, 4, 5}
+
+
+def test_resume_skips_recorded_photos_and_retries_failures(tmp_path):
+    library = tmp_path / 'library'
+    library.mkdir()
+    for name in ('a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'notes.txt'):
+        (library / name).write_bytes(b'')
+    paths = list(walk_images([str(library)]))
+    assert [os.path.basename(path) for path in paths] == ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']
+
+    output = tmp_path / 'run'
+    (output / 'features').mkdir(parents=True)
+    manifest = Manifest(str(output))
+    manifest.start(SETTINGS)
+    manifest.record({'chunk': 0, 'paths': [paths[0]], 'failed': [paths[1]],
+                     'features': 'features/chunk-000000.npz', 'offset': 10})
+    # Chunk 1 wrote its features but was interrupted before its checkpoint line was complete
+    (output / 'features' / 'chunk-000000.npz').write_bytes(b'')
+    (output / 'features' / 'chunk-000001.npz').write_bytes(b'')
+    with open(manifest.path, 'a') as f:
+        f.write('{"chunk": 1, "paths": ["')
+
+    resumed = Manifest(str(output))
+    resumed.load()
+    assert resumed.mismatches(SETTINGS) == []
+    assert resumed.mismatches(dict(SETTINGS, roots=['/archive', '/more'], format='parquet')) == ['format', 'roots']
+    resumed.discard_unrecorded(str(output))
+    assert os.listdir(output / 'features') == ['chunk-000000.npz']
+    assert resumed.last_offset() == 10
+    assert [path for path in paths if path not in resumed.done_paths()] == paths[1:]
+
+    assert write_failures(str(output), resumed) == 1
+    with open(output / 'failures.jsonl') as f:
+        assert [json.loads(line)['path'] for line in f] == [paths[1]]
+    # A retry that succeeds clears the failure; new entries follow the torn line's removal
+    resumed.record({'chunk': 1, 'paths': [paths[1], paths[2]], 'failed': [paths[3]],
+                    'features': 'features/chunk-000001.npz', 'offset': 30})
+    reloaded = Manifest(str(output))
+    reloaded.load()
+    assert reloaded.failed_paths() == [paths[3]]
+    assert reloaded.done_paths() == set(paths[:3])
+
+
+def test_manifests_of_another_version_are_not_resumed(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    manifest.start(SETTINGS)
+    manifest.settings['version'] = batch.MANIFEST_VERSION - 1
+    assert manifest.mismatches(SETTINGS) == ['version']
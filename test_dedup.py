@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+DuplicateIndex reference counting, copy flagging and reassignment on delete
+"""
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from photorank.dedup import DuplicateIndex
+from photorank.photo_registry import PhotoRecord, PhotoRegistry
+
+
+def upload(tmp_path, registry, index, photo_id, content, perceptual_hash=None):
+    path = tmp_path / f"{photo_id}.jpg"
+    path.write_bytes(content)
+    record = PhotoRecord(photo_id, f"{photo_id}.jpg", str(path), size=len(content))
+    record.content_hash = content.hex()
+    record.perceptual_hash = perceptual_hash
+    index.store(record)
+    registry.add(record)
+    return record
+
+
+def delete(registry, index, photo_id):
+    record = registry.remove(photo_id)
+    index.reassign(record, registry.get)
+    if index.release(record):
+        os.remove(record.filepath)
+    return record
+
+
+def test_identical_uploads_share_one_file_until_the_last_is_deleted(tmp_path):
+    registry, index = PhotoRegistry(), DuplicateIndex(max_distance=3)
+    first = upload(tmp_path, registry, index, 'a', b'same')
+    second = upload(tmp_path, registry, index, 'b', b'same')
+    third = upload(tmp_path, registry, index, 'c', b'same')
+    assert second.filepath == third.filepath == first.filepath
+    assert second.duplicate_of == third.duplicate_of == 'a'
+    assert sorted(os.listdir(tmp_path)) == ['a.jpg']
+    assert index.holds(first.content_hash)
+
+    delete(registry, index, 'a')
+    # The earliest copy stands in for the deleted original and keeps the file alive
+    assert second.duplicate_of is None and third.duplicate_of == 'b'
+    assert os.path.exists(first.filepath)
+    delete(registry, index, 'b')
+    assert third.duplicate_of is None and os.path.exists(first.filepath)
+    delete(registry, index, 'c')
+    assert not os.path.exists(first.filepath)
+    assert not index.holds(first.content_hash)
+
+
+def test_near_duplicates_are_flagged_within_the_hamming_distance(tmp_path):
+    registry, index = PhotoRegistry(), DuplicateIndex(max_distance=3)
+    original = upload(tmp_path, registry, index, 'a', b'one', perceptual_hash=0b1111)
+    near = upload(tmp_path, registry, index, 'b', b'two', perceptual_hash=0b1000)
+    far = upload(tmp_path, registry, index, 'c', b'three', perceptual_hash=0b1111 << 20)
+    assert index.flag(original) is None
+    assert index.flag(near) == 'a'
+    assert index.flag(far) is None
+
+    distinct, copies = index.partition(registry.snapshot())
+    assert [record.id for record in distinct] == ['a', 'c']
+    assert copies == {'a': [near]}
+
+    delete(registry, index, 'a')
+    assert near.duplicate_of is None
+    # The promoted copy is matched against from now on
+    late = upload(tmp_path, registry, index, 'd', b'four', perceptual_hash=0b1001)
+    assert index.flag(late) == 'b'
+
+
+def jpeg(pixels, quality):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def test_promoted_exact_copy_is_matched_against(tmp_path):
+    pixels = np.kron(np.random.default_rng(0).integers(0, 255, (16, 16, 3)), np.ones((16, 16, 1))).astype(np.uint8)
+    registry, index = PhotoRegistry(), DuplicateIndex(max_distance=3)
+    # Deleted before ingest hashed it, and exact copies are never hashed
+    upload(tmp_path, registry, index, 'a', jpeg(pixels, 95))
+    copy = upload(tmp_path, registry, index, 'b', jpeg(pixels, 95))
+    delete(registry, index, 'a')
+    assert copy.duplicate_of is None and copy.perceptual_hash is not None
+    near = upload(tmp_path, registry, index, 'c', jpeg(pixels, 60))
+    assert index.flag(near) == 'b'
+
+    # A hashed original hands its hash to the copy that replaces it
+    other = tmp_path / 'other'
+    other.mkdir()
+    registry, index = PhotoRegistry(), DuplicateIndex(max_distance=3)
+    index.flag(upload(other, registry, index, 'a', b'one', perceptual_hash=0b1111))
+    copy = upload(other, registry, index, 'b', b'one')
+    delete(registry, index, 'a')
+    assert copy.perceptual_hash == 0b1111
+    assert index.flag(upload(other, registry, index, 'c', b'two', perceptual_hash=0b1110)) == 'b'
+
+
+def test_exact_copy_of_a_near_duplicate_belongs_to_the_original(tmp_path):
+    registry, index = PhotoRegistry(), DuplicateIndex(max_distance=3)
+    original = upload(tmp_path, registry, index, 'a', b'one', perceptual_hash=0)
+    near = upload(tmp_path, registry, index, 'b', b'two', perceptual_hash=1)
+    index.flag(original)
+    index.flag(near)
+    exact = upload(tmp_path, registry, index, 'c', b'two')
+    assert exact.duplicate_of == 'b'
+    distinct, copies = index.partition(registry.snapshot())
+    assert [record.id for record in distinct] == ['a']
+    assert [record.id for record in copies['a']] == ['b', 'c']
+
+
+def test_restore_rebuilds_counts_without_touching_files(tmp_path):
+    registry, index = PhotoRegistry(), DuplicateIndex(max_distance=3)
+    first = upload(tmp_path, registry, index, 'a', b'same', perceptual_hash=5)
+    index.flag(first)
+    upload(tmp_path, registry, index, 'b', b'same')
+
+    restored, rebuilt = PhotoRegistry(), DuplicateIndex(max_distance=3)
+    for record in registry.snapshot():
+        record = PhotoRecord.from_state(record.to_state())
+        rebuilt.restore(record)
+        restored.add(record)
+    assert delete(restored, rebuilt, 'a') is not None
+    assert os.path.exists(first.filepath)
+    delete(restored, rebuilt, 'b')
+    assert not os.path.exists(first.filepath)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Quality scores: sharpness measured on the reduced decode still ranks blur, in every mode
+"""
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+from photorank.embed_score import combine_quality_score
+from photorank.image_io import load_model_input
+from photorank.sharpness import SHARPNESS_MODES, SharpnessScorer
+
+
+def detailed_photo(size=(3840, 2560), seed=0):
+    """Random lines with hard edges, so detail reaches down to single pixels at full resolution"""
+    rng = np.random.default_rng(seed)
+    img = Image.new('RGB', size, (128, 128, 128))
+    draw = ImageDraw.Draw(img)
+    for _ in range(400):
+        x, y = int(rng.integers(0, size[0])), int(rng.integers(0, size[1]))
+        end = (x + int(rng.integers(-600, 600)), y + int(rng.integers(-600, 600)))
+        draw.line([(x, y), end], fill=tuple(int(v) for v in rng.integers(0, 256, 3)), width=int(rng.integers(2, 12)))
+    return img
+
+
+@pytest.mark.parametrize('mode', SHARPNESS_MODES)
+def test_blurred_copy_of_a_large_upload_scores_lower(mode, tmp_path):
+    sharp = detailed_photo()
+    scorer = SharpnessScorer(mode=mode)
+    normalized = []
+    for radius in (0, 2, 5):
+        path = str(tmp_path / f"blur{radius}.jpg")
+        (sharp.filter(ImageFilter.GaussianBlur(radius)) if radius else sharp).save(path, quality=90)
+        sharpness = scorer.score_image(load_model_input(path))
+        # The sharpness share of the score, 0-1
+        normalized.append(combine_quality_score(0.0, sharpness, scorer.midpoint) / 3.0)
+    assert normalized[0] > normalized[1] > normalized[2]
+    # Not clipped: the sharp original keeps room above it
+    assert normalized[0] < 0.9
+
+
+def test_sharpness_never_saturates():
+    values = [0.0, 100.0, 1000.0, 1200.0, 5000.0, 50000.0]
+    scores = [combine_quality_score(0.0, value) for value in values]
+    assert scores[0] == 0.0 and all(a < b for a, b in zip(scores, scores[1:])) and scores[-1] < 3.0
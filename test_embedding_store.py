@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+EmbeddingStore round trips for each row dtype, compaction and reopening, and
+EmbeddingCache and EmbeddingStore instances sharing one root
+"""
+import os
+
+import numpy as np
+import pytest
+
+from photorank.embedding_cache import EmbeddingCache
+from photorank.embedding_store import COMPACT_MIN_TOMBSTONES, FLOAT16, FLOAT32, INT8, EmbeddingStore
+from photorank.neighbor_index import normalize_rows
+
+DIM = 64
+# Largest error in any component of a decoded unit row
+TOLERANCE = {FLOAT32: 1e-6, FLOAT16: 1e-3, INT8: 2e-2}
+
+
+def unit_vectors(count, seed=0):
+    return normalize_rows(np.random.default_rng(seed).normal(size=(count, DIM)))
+
+
+@pytest.mark.parametrize('dtype', [FLOAT32, FLOAT16, INT8])
+def test_rows_round_trip_and_survive_reopening(dtype, tmp_path):
+    store = EmbeddingStore(str(tmp_path), 'model', DIM, dtype=dtype, capacity=4)
+    vectors = unit_vectors(10)
+    ids = [f"p{i}" for i in range(10)]
+    store.put(ids, vectors * 3)  # Rows are normalized on the way in
+    assert store.get(ids).dtype == np.float32
+    assert np.abs(store.get(ids) - vectors).max() < TOLERANCE[dtype]
+    assert np.abs(store.get(ids[::-1]) - vectors[::-1]).max() < TOLERANCE[dtype]
+    store.close()
+
+    reopened = EmbeddingStore(str(tmp_path), 'model', DIM, dtype=dtype)
+    assert reopened.ids() == ids
+    assert np.abs(reopened.get(ids) - vectors).max() < TOLERANCE[dtype]
+    assert reopened.nearest(vectors[3], 1) == [('p3', pytest.approx(1.0, abs=1e-3))]
+    with pytest.raises(KeyError):
+        reopened.get(['missing'])
+    reopened.close()
+    # A store of another dtype starts empty rather than misreading the rows
+    assert len(EmbeddingStore(str(tmp_path), 'model', DIM, dtype=FLOAT32 if dtype != FLOAT32 else INT8)) == 0
+
+
+@pytest.mark.parametrize('dtype', [FLOAT32, FLOAT16, INT8])
+def test_update_only_writes_new_and_changed_rows(dtype, tmp_path):
+    store = EmbeddingStore(str(tmp_path), 'model', DIM, dtype=dtype)
+    vectors = unit_vectors(5)
+    ids = [f"p{i}" for i in range(5)]
+    assert store.update(ids, vectors) == 5
+    assert store.update(ids, vectors) == 0
+    assert store.count == 5
+
+    changed = vectors.copy()
+    changed[1] = unit_vectors(1, seed=1)[0]
+    assert store.update(ids + ['p5'], np.vstack([changed, unit_vectors(1, seed=2)])) == 2
+    assert store.count == 7 and len(store) == 6
+    assert np.abs(store.get(['p1']) - changed[1]).max() < TOLERANCE[dtype]
+
+
+@pytest.mark.parametrize('dtype', [FLOAT32, FLOAT16, INT8])
+def test_flush_compacts_tombstones(dtype, tmp_path):
+    store = EmbeddingStore(str(tmp_path), 'model', DIM, dtype=dtype)
+    count = 2 * COMPACT_MIN_TOMBSTONES + 10
+    vectors = unit_vectors(count)
+    ids = [f"p{i}" for i in range(count)]
+    store.put(ids, vectors)
+    kept = list(range(0, count, 3))
+    store.delete([ids[i] for i in range(count) if i not in set(kept)])
+    store.flush()
+    assert store.count == len(kept) == len(store)
+    assert store.ids() == [ids[i] for i in kept]
+    assert np.abs(store.get(store.ids()) - vectors[kept]).max() < TOLERANCE[dtype]
+    store.close()
+
+    reopened = EmbeddingStore(str(tmp_path), 'model', DIM, dtype=dtype)
+    assert reopened.ids() == [ids[i] for i in kept]
+    assert np.abs(reopened.get([ids[kept[-1]]])[0] - vectors[kept[-1]]).max() < TOLERANCE[dtype]
+    assert [photo_id for photo_id, _ in reopened.nearest(vectors[kept[5]], 3)][0] == ids[kept[5]]
+
+
+def test_deletes_are_logged_instead_of_rewriting_the_index(tmp_path):
+    store = EmbeddingStore(str(tmp_path), 'model', DIM)
+    vectors = unit_vectors(4)
+    ids = ['a', 'b', 'c', 'd']
+    store.put(ids, vectors)
+    store.flush()
+    index_path = os.path.join(store.directory, 'index.json')
+    with open(index_path) as f:
+        index = f.read()
+    store.delete(['a'])
+    store.flush()
+    store.delete(['c', 'missing'])
+    store.flush()
+    with open(index_path) as f:
+        assert f.read() == index
+    store.close()
+
+    reopened = EmbeddingStore(str(tmp_path), 'model', DIM)
+    assert reopened.ids() == ['b', 'd']
+    # Putting a deleted id back rewrites the index, and the log no longer applies
+    reopened.put(['a'], vectors[:1])
+    reopened.delete(['b', 'd'])
+    reopened.flush()
+    reopened.close()
+    assert EmbeddingStore(str(tmp_path), 'model', DIM).ids() == ['a']
+
+
+def test_instances_sharing_a_root_keep_their_own_files(tmp_path):
+    first = EmbeddingStore(str(tmp_path), 'model', DIM)
+    second = EmbeddingStore(str(tmp_path), 'model', DIM)
+    assert first.directory != second.directory
+    vectors = unit_vectors(2)
+    first.put(['x'], vectors[:1])
+    second.put(['y'], vectors[1:])
+    first.close()
+    second.close()
+    # A restarted worker takes over the files of the one before it
+    reopened = EmbeddingStore(str(tmp_path), 'model', DIM)
+    assert reopened.directory == first.directory and reopened.ids() == ['x']
+    assert np.abs(reopened.get(['x'])[0] - vectors[0]).max() < TOLERANCE[FLOAT32]
+
+
+def test_caches_sharing_a_root_never_serve_each_others_vectors(tmp_path):
+    first = EmbeddingCache(str(tmp_path), 'model', DIM)
+    second = EmbeddingCache(str(tmp_path), 'model', DIM)
+    vectors = unit_vectors(2)
+    first.put('X', vectors[0], 0.1, 10.0, 1.0)
+    second.put('Y', vectors[1], 0.2, 20.0, 2.0)
+    first.flush()
+    second.flush()
+    assert np.array_equal(first.get('X')[0], vectors[0]) and second.get('X') is None
+    first.close()
+    second.close()
+    reopened = [EmbeddingCache(str(tmp_path), 'model', DIM) for _ in range(2)]
+    assert sorted(key for cache in reopened for key in cache.entries) == ['X', 'Y']
+    assert np.array_equal(reopened[0].get('X')[0], vectors[0])
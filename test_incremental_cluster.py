@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+IncrementalDBSCAN against sklearn's DBSCAN over random insert/remove sequences
+"""
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from photorank.incremental_cluster import NOISE, IncrementalDBSCAN
+from photorank.neighbor_index import normalize_rows
+
+EPS = 0.15
+MIN_SAMPLES = 3
+
+
+def random_points(rng, count, dim=8, centers=6):
+    """Points scattered around a few directions, so clusters form, merge and split"""
+    centres = rng.normal(size=(centers, dim))
+    points = centres[rng.integers(0, centers, count)] + rng.normal(scale=0.35, size=(count, dim))
+    return normalize_rows(points)
+
+
+def assert_matches_sklearn(clusterer, keys, vectors, labels):
+    expected = DBSCAN(eps=EPS, min_samples=MIN_SAMPLES, metric='cosine').fit(vectors)
+    core = np.zeros(len(keys), dtype=bool)
+    core[expected.core_sample_indices_] = True
+    # Noise is the same set of points
+    np.testing.assert_array_equal(labels == NOISE, expected.labels_ == -1)
+    # Core points fall into the same clusters, up to renaming
+    pairs = set(zip(labels[core].tolist(), expected.labels_[core].tolist()))
+    assert len(pairs) == len({a for a, _ in pairs}) == len({b for _, b in pairs})
+    # A border point may join any cluster it is reachable from, so only check it sits next to one of its cores
+    similarity = vectors @ vectors.T
+    for idx in np.flatnonzero(~core & (labels != NOISE)):
+        near_cores = np.flatnonzero(core & (1 - similarity[idx] <= EPS + 1e-6))
+        assert labels[idx] in set(labels[near_cores].tolist()), keys[idx]
+
+
+def test_sync_matches_sklearn_over_random_changes():
+    rng = np.random.default_rng(4)
+    pool = random_points(rng, 400)
+    clusterer = IncrementalDBSCAN(eps=EPS, min_samples=MIN_SAMPLES)
+    present = set()
+    for step in range(300):
+        available = [idx for idx in range(len(pool)) if idx not in present]
+        insert = rng.choice(available, size=min(len(available), rng.integers(1, 12)), replace=False)
+        remove = rng.choice(sorted(present), size=min(len(present), rng.integers(0, 8)), replace=False) \
+            if present else []
+        present = (present | set(insert.tolist())) - set(np.asarray(remove).tolist())
+        ids = sorted(present)
+        keys = [f"p{idx}" for idx in ids]
+        labels = clusterer.sync(keys, pool[ids])
+        assert_matches_sklearn(clusterer, keys, pool[ids], labels)
+
+
+def test_noise_joins_a_cluster_when_a_neighbour_becomes_core():
+    # b and c sit within eps of a only; once d arrives a becomes core and they are its border points
+    a = np.array([1.0, 0.0, 0.0])
+    b = normalize_rows([1.0, 0.3, 0.0])[0]
+    c = normalize_rows([1.0, -0.3, 0.0])[0]
+    d = normalize_rows([1.0, 0.0, 0.3])[0]
+    clusterer = IncrementalDBSCAN(eps=0.05, min_samples=4)
+    assert clusterer.sync(['a', 'b', 'c'], [a, b, c]).tolist() == [NOISE] * 3
+    labels = clusterer.sync(['a', 'b', 'c', 'd'], [a, b, c, d])
+    assert NOISE not in labels.tolist() and len(set(labels.tolist())) == 1
+
+
+def test_labels_stay_stable_when_an_unrelated_photo_arrives():
+    rng = np.random.default_rng(1)
+    vectors = random_points(rng, 120)
+    keys = [f"p{idx}" for idx in range(len(vectors))]
+    clusterer = IncrementalDBSCAN(eps=EPS, min_samples=MIN_SAMPLES)
+    before = clusterer.sync(keys[:-1], vectors[:-1])
+    after = clusterer.sync(keys, vectors)
+    moved = np.flatnonzero(before != after[:-1])
+    # Only points near the new one can change cluster
+    assert all(1 - vectors[idx] @ vectors[-1] <= EPS or before[idx] == NOISE for idx in moved)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+Perceptual hash popcount and Hamming index lookups
+"""
+import numpy as np
+
+from photorank.perceptual import HammingIndex, _popcount_bytes, popcount
+
+
+def test_popcount_fallback_matches_bit_counts():
+    values = np.random.default_rng(0).integers(0, 2 ** 63, size=(7, 9), dtype=np.uint64)
+    values[0, 0], values[0, 1] = 0, np.iinfo(np.uint64).max
+    expected = np.array([[bin(int(v)).count('1') for v in row] for row in values])
+    assert np.array_equal(_popcount_bytes(values), expected)
+    # Non-contiguous views are counted too
+    assert np.array_equal(_popcount_bytes(values[:, ::2]), expected[:, ::2])
+    assert np.array_equal(popcount(values), expected)
+
+
+def test_hamming_index_finds_the_closest_live_hash():
+    index = HammingIndex()
+    index.add('a', 0b1111)
+    index.add('b', 0b1)
+    assert index.nearest(0b0, 2) == 'b'
+    index.remove('b')
+    assert index.nearest(0b0, 2) is None
+    assert index.nearest(0b0, 4) == 'a'
+    assert index.nearest(0b1111, 0, exclude='a') is None
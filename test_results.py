@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Serialized clustering results: full bodies, cursor paging and compression
+"""
+import gzip
+import json
+
+import pytest
+
+from photorank.results import CLUSTERS, GZIP, UNCLUSTERED, SerializedResults, StaleCursor
+
+RESULT = {
+    'clusters': [{'id': n, 'photos': [{'id': f"p{n}", 'filename': f"{n}.jpg" * 40}]} for n in range(7)],
+    'unclustered': [{'id': 'u0'}, {'id': 'u1'}],
+}
+
+
+def test_full_body_matches_the_result():
+    results = SerializedResults(RESULT, version='job1')
+    body, etag, encoding = results.body()
+    assert json.loads(body) == RESULT and encoding is None
+    assert etag.startswith('job1-')
+    # Cached, and a section asked for without a limit still gets the complete body
+    assert results.body(section=UNCLUSTERED) == (body, etag, None)
+
+
+def test_cursors_page_through_each_section():
+    results = SerializedResults(RESULT, version='job1')
+    for section in (CLUSTERS, UNCLUSTERED):
+        seen, cursor = [], None
+        while True:
+            page = json.loads(results.body(section=section, cursor=cursor, limit=3)[0])
+            assert (page['clusterCount'], page['unclusteredCount']) == (7, 2)
+            seen.extend(page[section])
+            cursor = page['nextCursor']
+            if cursor is None:
+                break
+        assert seen == RESULT[section]
+
+
+def test_stale_and_malformed_cursors_are_refused():
+    old = SerializedResults(RESULT, version='job1')
+    cursor = json.loads(old.body(limit=2)[0])['nextCursor']
+    new = SerializedResults(RESULT, version='job2')
+    with pytest.raises(StaleCursor):
+        new.body(cursor=cursor, limit=2)
+    with pytest.raises(ValueError):
+        new.body(cursor='!!!', limit=2)
+    with pytest.raises(ValueError):
+        new.body(section='everything')
+
+
+def test_compressed_bodies_get_their_own_etag():
+    results = SerializedResults(RESULT, version='job1')
+    plain, etag, _ = results.body()
+    compressed, gzip_etag, encoding = results.body(encoding=GZIP)
+    assert encoding == GZIP and gzip.decompress(compressed) == plain
+    assert gzip_etag == f"{etag}-{GZIP}"
+    # Small pages are not worth compressing
+    assert results.body(section=UNCLUSTERED, limit=1, encoding=GZIP)[2] is None
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+SessionManager quotas, TTL eviction, media tokens and reloads across workers
+"""
+import os
+import time
+
+import pytest
+
+from photorank.jobs import COMPLETED, JobQueue
+from photorank.photo_registry import PhotoRecord
+from photorank.results import SerializedResults
+from photorank import sessions
+from photorank.sessions import (SESSION_JOB_HISTORY, MemoryBackend, QuotaExceeded, SessionManager,
+                                SQLiteBackend)
+
+
+def add(manager, workspace, photo_id, content):
+    os.makedirs(workspace.directory, exist_ok=True)
+    path = os.path.join(workspace.directory, f"{photo_id}.jpg")
+    with open(path, 'wb') as f:
+        f.write(content)
+    record = PhotoRecord(photo_id, f"{photo_id}.jpg", path, size=len(content))
+    record.content_hash = content.hex()
+    return manager.add_photo(workspace, record)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBackend()
+    return SQLiteBackend(str(tmp_path / 'sessions.sqlite3'))
+
+
+def test_sessions_are_isolated(backend, tmp_path):
+    manager = SessionManager(backend, str(tmp_path / 'up'))
+    first, second = manager.create(), manager.create()
+    add(manager, first, 'a', b'one')
+    assert manager.get(first.id).photos.get('a') is not None
+    assert manager.get(second.id).photos.get('a') is None
+    assert manager.get('../' + 'x' * 29) is None
+
+
+def test_photo_and_byte_quotas(backend, tmp_path):
+    manager = SessionManager(backend, str(tmp_path / 'up'), max_photos=3, max_bytes=10)
+    workspace = manager.create()
+    add(manager, workspace, 'a', b'12345')
+    # Identical content is stored once, so it takes no more of the byte quota
+    add(manager, workspace, 'b', b'12345')
+    with pytest.raises(QuotaExceeded):
+        add(manager, workspace, 'c', b'123456')
+    os.remove(os.path.join(workspace.directory, 'c.jpg'))
+    add(manager, workspace, 'c', b'12345')
+    with pytest.raises(QuotaExceeded):
+        add(manager, workspace, 'd', b'1')
+    os.remove(os.path.join(workspace.directory, 'd.jpg'))
+    assert len(workspace.photos) == 3 and workspace.bytes_used == 5
+    manager.remove_photo(workspace, 'a')
+    manager.remove_photo(workspace, 'b')
+    manager.remove_photo(workspace, 'c')
+    assert workspace.bytes_used == 0 and os.listdir(workspace.directory) == []
+
+
+def test_idle_sessions_are_evicted_with_their_files(backend, tmp_path):
+    evicted = []
+    manager = SessionManager(backend, str(tmp_path / 'up'), ttl=60,
+                             on_evict=lambda session_id, photo_ids: evicted.append((session_id, photo_ids)))
+    idle, active = manager.create(), manager.create()
+    add(manager, idle, 'a', b'one')
+    add(manager, active, 'b', b'two')
+    idle.clusterer = object()
+    now = time.time() + 120
+    backend.touch(active.id, now)
+    assert manager.evict_idle(now=now) == 1
+    assert evicted == [(idle.id, ['a'])]
+    assert idle.clusterer is None
+    assert not os.path.exists(idle.directory) and os.path.exists(active.directory)
+    assert manager.get(idle.id) is None and manager.get(active.id) is not None
+    assert backend.owner('a') is None and backend.owner('b') == active.id
+    # Sweeps are rate limited
+    assert manager.evict_idle(now=now + 1) == 0
+
+
+def test_eviction_runs_in_the_background(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, 'EVICTION_INTERVAL', 0.01)
+    manager = SessionManager(MemoryBackend(), str(tmp_path / 'up'), ttl=0)
+    manager.create()
+    manager.start_eviction()
+    manager.start_eviction()
+    deadline = time.time() + 5
+    while len(manager) and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(manager) == 0
+
+
+def test_media_tokens_open_one_photo_of_one_session(backend, tmp_path):
+    manager = SessionManager(backend, str(tmp_path / 'up'), secret=b'key')
+    first, second = manager.create(), manager.create()
+    add(manager, first, 'a', b'one')
+    add(manager, second, 'b', b'two')
+    workspace, record = manager.find_photo('a', manager.media_token(first.id, 'a'))
+    assert workspace.id == first.id and record.id == 'a'
+    assert manager.find_photo('a', manager.media_token(second.id, 'a')) == (None, None)
+    assert manager.find_photo('b', manager.media_token(first.id, 'a')) == (None, None)
+    assert manager.find_photo('a', None) == (None, None)
+
+
+def test_sqlite_sessions_reload_in_another_worker(tmp_path):
+    path, root = str(tmp_path / 'sessions.sqlite3'), str(tmp_path / 'up')
+    worker, other = SessionManager(SQLiteBackend(path), root), SessionManager(SQLiteBackend(path), root)
+    workspace = worker.create()
+    add(worker, workspace, 'a', b'same')
+    add(worker, workspace, 'b', b'same')
+    add(worker, workspace, 'c', b'other')
+    worker.save_results(workspace, SerializedResults({'clusters': [{'id': 0}], 'unclustered': []}, version='job'))
+
+    loaded = other.get(workspace.id)
+    assert [record.id for record in loaded.photos] == ['a', 'b', 'c']
+    assert loaded.photos.get('b').duplicate_of == 'a'
+    assert loaded.bytes_used == workspace.bytes_used
+    assert loaded.results.version == 'job' and loaded.results.cluster_count == 1
+
+    clusterer = workspace.clusterer = object()
+    other.remove_photo(loaded, 'a')
+    # The first worker's copy is behind now and is reloaded
+    reloaded = worker.get(workspace.id)
+    assert reloaded is not workspace and reloaded.clusterer is clusterer
+    assert [(record.id, record.duplicate_of) for record in reloaded.photos] == [('b', None), ('c', None)]
+    assert os.path.exists(reloaded.photos.get('b').filepath)
+
+
+def test_sqlite_jobs_are_visible_to_every_worker(tmp_path):
+    path, root = str(tmp_path / 'sessions.sqlite3'), str(tmp_path / 'up')
+    worker, other = SessionManager(SQLiteBackend(path), root), SessionManager(SQLiteBackend(path), root)
+    workspace = worker.create()
+    queue = JobQueue(on_change=lambda job: worker.save_job(job.owner, job.id, job.to_dict()))
+    job = queue.submit(lambda job: job.progress('embed', 1, 1), owner=workspace.id)
+    queue.executor.shutdown(wait=True)
+
+    state = other.load_job(workspace.id, job.id)
+    assert state == job.to_dict() and state['status'] == COMPLETED
+    assert other.load_job(workspace.id) == state
+    assert other.load_job(other.create().id, job.id) is None
+
+    for number in range(SESSION_JOB_HISTORY + 1):
+        worker.save_job(workspace.id, f"job-{number}", {'jobId': f"job-{number}"})
+    assert other.load_job(workspace.id)['jobId'] == f"job-{SESSION_JOB_HISTORY}"
+    assert other.load_job(workspace.id, job.id) is None  # Only the newest are kept
+    assert other.load_job(workspace.id, 'job-1') is not None
+
+    worker.backend.drop(workspace.id)
+    assert other.load_job(workspace.id, 'job-1') is None
+    worker.save_job(workspace.id, 'late', {'jobId': 'late'})  # Finished after the session was dropped
+    assert other.load_job(workspace.id) is None
+
+
+def test_memory_jobs_stay_in_the_worker(tmp_path):
+    manager = SessionManager(MemoryBackend(), str(tmp_path / 'up'))
+    workspace = manager.create()
+    manager.save_job(workspace.id, 'job', {'jobId': 'job'})
+    assert manager.load_job(workspace.id) is None
+
+
+def test_memory_workers_sweep_only_their_own_directories(tmp_path):
+    root = str(tmp_path / 'up')
+    worker, other = SessionManager(MemoryBackend(), root, ttl=60), SessionManager(MemoryBackend(), root, ttl=60)
+    workspace = worker.create()
+    add(worker, workspace, 'a', b'one')
+    assert worker.upload_root != other.upload_root
+    os.utime(workspace.directory, (0, 0))
+    other.evict_idle(now=time.time())
+    assert os.path.exists(workspace.directory)
+
+    # A restarted worker takes over the directory and removes what its predecessor left
+    claimed = worker.upload_root
+    worker._claim.close()
+    restarted = SessionManager(MemoryBackend(), root, ttl=60)
+    assert restarted.upload_root == claimed
+    restarted.evict_idle(now=time.time())
+    assert not os.path.exists(workspace.directory)
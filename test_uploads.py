@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Resumable uploads: offsets, size limits, restarts and stale uploads
+"""
+import io
+import os
+import time
+
+import pytest
+
+from photorank.uploads import OffsetMismatch, ResumableUploads
+
+
+def test_chunks_append_at_the_current_offset(tmp_path):
+    uploads = ResumableUploads(str(tmp_path), max_size=100)
+    upload = uploads.create('a.jpg', 10, owner='session')
+    assert upload['offset'] == 0 and upload['owner'] == 'session'
+    assert uploads.append(upload['id'], 0, io.BytesIO(b'12345'))['offset'] == 5
+    # A retried chunk, or one that skips ahead, is refused with the offset to resume from
+    for offset in (0, 7):
+        with pytest.raises(OffsetMismatch) as mismatch:
+            uploads.append(upload['id'], offset, io.BytesIO(b'12345'))
+        assert mismatch.value.offset == 5
+    assert uploads.append(upload['id'], 5, io.BytesIO(b'67890'))['offset'] == 10
+
+    target = str(tmp_path / 'a.jpg')
+    uploads.finish(upload['id'], target)
+    assert open(target, 'rb').read() == b'1234567890'
+    assert uploads.get(upload['id']) is None
+
+
+def test_chunks_past_the_declared_size_keep_what_fits(tmp_path):
+    uploads = ResumableUploads(str(tmp_path), max_size=100)
+    upload = uploads.create('a.jpg', 8)
+    uploads.append(upload['id'], 0, io.BytesIO(b'12345'))
+    with pytest.raises(ValueError):
+        uploads.append(upload['id'], 5, io.BytesIO(b'67890'))
+    assert uploads.get(upload['id'])['offset'] == 8
+    with pytest.raises(ValueError):
+        uploads.append(upload['id'], 8, io.BytesIO(b'9'))
+    assert uploads.get(upload['id'])['offset'] == 8
+
+
+def test_sizes_and_ids_are_checked(tmp_path):
+    uploads = ResumableUploads(str(tmp_path), max_size=100)
+    for size in (-1, 101):
+        with pytest.raises(ValueError):
+            uploads.create('a.jpg', size)
+    assert uploads.get('../' + '0' * 29) is None
+    assert not uploads.abort('../' + '0' * 29)
+    with pytest.raises(KeyError):
+        uploads.append('0' * 32, 0, io.BytesIO(b'1'))
+
+
+def test_uploads_survive_a_restart_until_they_go_stale(tmp_path):
+    upload = ResumableUploads(str(tmp_path), max_size=100).create('a.jpg', 10)
+    ResumableUploads(str(tmp_path), max_size=100).append(upload['id'], 0, io.BytesIO(b'123'))
+    restarted = ResumableUploads(str(tmp_path), max_size=100)
+    assert restarted.get(upload['id'])['offset'] == 3
+
+    old = time.time() - 3600
+    os.utime(tmp_path / f"{upload['id']}.part", (old, old))
+    restarted.discard_stale(max_age=60)
+    assert restarted.get(upload['id']) is None and os.listdir(tmp_path) == []